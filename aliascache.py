@@ -0,0 +1,53 @@
+"""
+Builds the alias tables that randomgen.RandomGen uses to sample
+binomial(n, 1/2) random variates for large n, and saves them to an
+on-disk cache (see randomgen.AliasTableCache), so that later processes
+load them instead of rebuilding them.
+
+Usage: python aliascache.py DIRECTORY FIRST LAST [STEP]
+
+Builds the tables for every power-of-two row number from FIRST to LAST,
+or, if STEP is given, for every STEP-th row number from FIRST to LAST.
+Rows less than 32 are skipped, since the binomial samplers never load
+them from the cache, as are rows for which no table can be built.
+Use the cache by setting the RANDOMGEN_ALIASCACHE environment variable
+to DIRECTORY, or by calling randomgen.RandomGen.setaliascache(DIRECTORY).
+
+Written by Peter O.
+Any copyright to this work is released to the Public Domain.
+In case this is not possible, this work is also
+licensed under Creative Commons Zero (CC0):
+https://creativecommons.org/publicdomain/zero/1.0/
+"""
+
+import sys
+import time
+from randomgen import AliasTableCache
+
+def warm(path, first, last, step=None):
+    """Builds the tables for the given rows (see the module
+    documentation) in the cache at 'path', printing the time
+    each one took.  Returns the list of rows built."""
+    if step == None:
+        rows = [1 << k for k in range(last.bit_length()) if first <= (1 << k) <= last]
+    else:
+        rows = list(range(first, last + 1, step))
+    cache = AliasTableCache(path)
+    built = []
+    for n in rows:
+        t = time.perf_counter()
+        if cache.warm([n]):
+            built.append(n)
+            print("row %d: built in %.2fs" % (n, time.perf_counter() - t))
+    return built
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5):
+        print(__doc__.strip().split("\n\n")[1])
+        sys.exit(1)
+    warm(
+        sys.argv[1],
+        int(sys.argv[2]),
+        int(sys.argv[3]),
+        int(sys.argv[4]) if len(sys.argv) > 4 else None,
+    )
@@ -1,8 +1,123 @@
+import array
+import collections
 import math
 import random
 from fractions import Fraction
+from bitsource import BitSource, FractionDigits, _FIRSTZERO
+from instrument import Instrumented
+
+class BernsteinCache:
+    """Bounded cache of the Bernstein coefficients used by
+    Bernoulli.simulate and lorentz.simulate, which can be shared
+    across calls and across factory functions.  Each entry is the
+    k-th coefficient of a degree-n polynomial, rounded down (for
+    lower polynomials) or up (for upper polynomials) to a multiple
+    of 1/(choose(n,k)*2^n), and stored as the numerator of that
+    multiple.  Entries are keyed by the function giving the
+    coefficients, so that they're reused only when the same function
+    object is passed again.  The cache also holds rows of the
+    integer weights choose(n-m, k-j) used to elevate degree-m
+    coefficients to degree n.
+    - maxsize: Maximum number of entries kept; the least recently
+      used entries are removed first."""
+
+    def __init__(self, maxsize=1 << 16):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key):
+        ret = self.entries.get(key)
+        if ret != None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return ret
+
+    def _put(self, key, value):
+        self.misses += 1
+        if self.maxsize > 0:
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def coeff(self, func, n, k, scaled):
+        """Gets the numerator of the rounded k-th coefficient for
+        degree n given by 'func', calculating it with
+        scaled(func, n, k, choose(n,k)*2^n) if it isn't cached."""
+        key = (func, scaled, n, k)
+        ret = self._get(key)
+        if ret == None:
+            ret = self._put(key, scaled(func, n, k, math.comb(n, k) << n))
+        return ret
+
+    def weights(self, n, m, k):
+        """Gets the row [j0, [choose(n-m, k-j) for j in j0..min(m,k)]],
+        where j0 = max(0, k-(n-m)) is the first j with a nonzero
+        weight.  The weights, divided by choose(n,k), are the
+        probabilities of j ones among the first m of n flips with
+        k ones."""
+        key = (None, None, n, m, k)
+        ret = self._get(key)
+        if ret == None:
+            j0 = max(0, k - (n - m))
+            ret = self._put(
+                key, [j0, [math.comb(n - m, k - j) for j in range(j0, min(m, k) + 1)]]
+            )
+        return ret
 
-class Bernoulli:
+    def bounds(self, fbelow, fabove, below, above, degree, lastdegree, ones):
+        """Given the number of ones among the first 'degree' flips,
+        returns the lower and upper coefficients for 'degree', and the
+        degree-'lastdegree' coefficients averaged over the ways the
+        ones can fall within the first 'lastdegree' flips (or None
+        if 'lastdegree' is 0), all as Fractions.  'below' and 'above'
+        calculate numerators of rounded coefficients (see 'coeff')."""
+        c = math.comb(degree, ones)
+        l = Fraction(self.coeff(fbelow, degree, ones, below), c << degree)
+        u = Fraction(self.coeff(fabove, degree, ones, above), c << degree)
+        if lastdegree == 0:
+            return [l, u, None, None]
+        # The common denominator of the averages is choose(degree,ones)*2^lastdegree
+        j0, w = self.weights(degree, lastdegree, ones)
+        lsn = 0
+        usn = 0
+        for i in range(len(w)):
+            lsn += self.coeff(fbelow, lastdegree, j0 + i, below) * w[i]
+            usn += self.coeff(fabove, lastdegree, j0 + i, above) * w[i]
+        return [l, u, Fraction(lsn, c << lastdegree), Fraction(usn, c << lastdegree)]
+
+    def stats(self):
+        """ Returns a dictionary with 'hits', 'misses' and 'size'. """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+    def clear(self):
+        """ Empties this cache and resets its statistics. """
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+# Cache used by default by Bernoulli.simulate and lorentz.simulate
+BERNSTEINCACHE = BernsteinCache()
+
+# Fractions used often enough to precompile for zero_or_one
+_ONEFOURTH = FractionDigits(1, 4)
+_FIVENINTHS = FractionDigits(5, 9)
+
+def _fb2n(fbelow, a, b, v=1):
+    if b > a:
+        raise ValueError
+    return int(Fraction(fbelow(a, b)) * v)
+
+def _fa2n(fabove, a, b, v=1):
+    if b > a:
+        raise ValueError
+    mv = Fraction(fabove(a, b)) * v
+    imv = int(mv)
+    return imv if mv == imv else imv + 1
+
+class Bernoulli(Instrumented):
     """This class contains methods that generate Bernoulli random numbers,
        (either 1 or heads with a given probability, or 0 or tails otherwise).
        This class also includes implementations of so-called "Bernoulli factories", algorithms
@@ -40,13 +155,25 @@ class Bernoulli:
     arXiv:1407.5770v1  [stat.CO]
     """
 
-    def __init__(self):
-        """ Creates a new instance of the Bernoulli class."""
-        self.r = random.Random()
-        self.rbit = -1
+    def __init__(self, bits=None):
+        """Creates a new instance of the Bernoulli class.
+        'bits' is the source of random bits: a bitsource.BitSource
+        (which can be shared with other random generators, such as
+        randomgen.RandomGen) or an RNG such as 'random.Random'.
+        If None, a new BitSource is used."""
+        self.r = bits
         self.totalbits = 0
         self.debug = False
 
+    @property
+    def r(self):
+        # The source of random bits, a BitSource
+        return self.bits
+
+    @r.setter
+    def r(self, value):
+        self.bits = value if isinstance(value, BitSource) else BitSource(value)
+
     def _algorithm_a(self, f, m, c):
         # B(p) -> B(c*p*(1-(c*p)^(m-1))/(1-(c*p)^m)), or the "gambler's ruin" walk
         # (Huber 2016)
@@ -96,31 +223,41 @@ class Bernoulli:
                 break  # Can't catch up
         return 0
 
-    def zero_or_one(self, px, py):
-        """ Returns 1 at probability px/py, 0 otherwise. """
-        if py <= 0:
-            raise ValueError
-        if px == py:
-            return 1
-        z = px
-        while True:
-            z = z * 2
-            if z >= py:
-                if self.randbit() == 0:
-                    return 1
-                z = z - py
-            elif z == 0 or self.randbit() == 0:
-                return 0
+    def zero_or_one(self, px, py=None):
+        """Returns 1 at probability px/py, 0 otherwise.  'px' can
+        instead be a bitsource.FractionDigits (with 'py' omitted),
+        which is faster if the same fraction is used many times.
+        See bitsource.BitSource.zero_or_one."""
+        b = self.bits
+        bc = b.bitcount
+        if bc >= 8:
+            # Fast path: the result is decided by the next 8 bits
+            if py == None:
+                e = px.table[b.curbit & 255]
+                if e != 0:
+                    k = e >> 1
+                    b.curbit >>= k
+                    b.bitcount = bc - k
+                    self.totalbits += k
+                    return e & 1
+            elif 0 < px < py and isinstance(px, int) and isinstance(py, int):
+                k = _FIRSTZERO[b.curbit & 255]
+                if k != 0:
+                    # Remainder after the first k-1 digits of px/py
+                    r = (px << (k - 1)) % py
+                    if r != 0:
+                        b.curbit >>= k
+                        b.bitcount = bc - k
+                        self.totalbits += k
+                        return 1 if (r << 1) >= py else 0
+        ret, used = b._zero_or_one(px, py)
+        self.totalbits += used
+        return ret
 
     def randbit(self):
         """ Generates a random bit that is 1 or 0 with equal probability. """
-        if self.rbit < 0 or self.rbit >= 32:
-            self.rbit = 0
-            self.rvalue = self.r.randint(0, (1 << 32) - 1)
-        ret = (self.rvalue >> self.rbit) & 1
-        self.rbit += 1
         self.totalbits += 1
-        return ret
+        return self.bits.randbit()
 
     def rndint(self, maxInclusive):
         if maxInclusive < 0:
@@ -129,6 +266,9 @@ class Bernoulli:
             return 0
         if maxInclusive == 1:
             return self.randbit()
+        if maxInclusive & (maxInclusive + 1) == 0:
+            # Power of 2 minus 1
+            return self._randbits(maxInclusive.bit_length())
         # Lumbroso's fast dice roller method
         x = 1
         y = 0
@@ -142,12 +282,27 @@ class Bernoulli:
                 y = y - maxInclusive - 1
 
     def _randbits(self, count):
-        ret = 0
-        for i in range(count):
-            ret = (ret << 1) + self.randbit()
-        return ret
+        self.totalbits += count
+        return self.bits.randbits(count)
 
     def fill_geometric_bag(self, bag, precision=53):
+        if not isinstance(bag, list):
+            # Packed geometric bag (betadist.PSRN)
+            lb = min(bag.length, precision)
+            ret = bag.bits >> (bag.length - lb)
+            unset = bag.unset >> (bag.length - lb)
+            pos = lb - 1
+            while unset != 0:
+                # Unsampled digits, first to last, are
+                # filled in but not stored in the bag
+                if (unset >> pos) & 1 != 0:
+                    unset ^= 1 << pos
+                    ret |= self.randbit() << pos
+                pos -= 1
+            if lb < precision:
+                diff = precision - lb
+                ret = (ret << diff) | self._randbits(diff)
+            return ret / (1 << precision)
         ret = 0
         lb = min(len(bag), precision)
         for i in range(lb):
@@ -168,12 +323,15 @@ class Bernoulli:
         - u: List that holds the binary expansion, from left to right, of the uniformly-
           distributed random number.  Each element of the list is 0, 1, or None (meaning
           the digit is not yet known).  The list may be expanded as necessary to put
-          a new digit in the appropriate place in the binary expansion.
+          a new digit in the appropriate place in the binary expansion.  'u' can
+          instead be a betadist.PSRN, which holds the digits packed into an integer.
         """
         r = 0
         c = 0
         while self.randbit() == 0:
             r += 1
+        if not isinstance(u, list):
+            return u.digit(self, r)
         while len(u) <= r:
             u.append(None)
         if u[r] == None:
@@ -245,16 +403,16 @@ class Bernoulli:
         Reference: Flajolet et al. 2010.
         """
         t = 0
-        while self.zero_or_one(1, 4) == 0:
+        while self.zero_or_one(_ONEFOURTH) == 1:
             t += 1
-        while self.zero_or_one(1, 4) == 0:
+        while self.zero_or_one(_ONEFOURTH) == 1:
             t += 1
-        if self.zero_or_one(5, 9):
+        if self.zero_or_one(_FIVENINTHS):
             t += 1
         if t == 0:
             return 1
         for i in range(3):
-            s = sum(self.randbit() for j in t * 2)
+            s = sum(self.randbit() for j in range(t * 2))
             if s != t:
                 return 0
         return 1
@@ -264,6 +422,8 @@ class Bernoulli:
         (given as an incomplete binary expansion that is built up
          as necessary) is less than the given fraction (in the interval [0, 1])
          expressed as a numerator and denominator."""
+        if not isinstance(bag, list):
+            return bag.less_fraction(self, num, den)
         a = num
         if num == 0:
             return 0
@@ -1134,18 +1294,12 @@ class Bernoulli:
         return self.linear(f, c, eps=Fraction(1) - m)
 
     def _fb2(self, fbelow, a, b, v=1):
-        if b > a:
-            raise ValueError
-        return Fraction(int(Fraction(fbelow(a, b)) * v), v)
+        return Fraction(_fb2n(fbelow, a, b, v), v)
 
     def _fa2(self, fabove, a, b, v=1):
-        if b > a:
-            raise ValueError
-        mv = Fraction(fabove(a, b)) * v
-        imv = int(mv)
-        return Fraction(imv, v) if mv == imv else Fraction(imv + 1, v)
+        return Fraction(_fa2n(fabove, a, b, v), v)
 
-    def simulate(self, coin, fbelow, fabove, fbound, nextdegree=None):
+    def simulate(self, coin, fbelow, fabove, fbound, nextdegree=None, cache=None):
         """Simulates a general factory function defined by two
         sequences of polynomials that converge from above and below.
         - coin(): Function that returns 1 or 0 with a fixed probability.
@@ -1160,7 +1314,9 @@ class Bernoulli:
            must return an integer greater than n.
            Optional.  If not given, the first degree is 1 and the next degree is n*2
            (so that for each power of 2 as well as 1, a polynomial of that degree
-           must be specified)."""
+           must be specified).
+         - cache: BernsteinCache holding the coefficients calculated so far.
+           Optional.  If not given, uses the shared cache BERNSTEINCACHE."""
         ones = 0
         lastdegree = 0
         l = Fraction(0)
@@ -1173,77 +1329,458 @@ class Bernoulli:
             if fb[0] >= 0 and fb[1] <= 1:
                 break
             degree = nextdegree(degree) if nextdegree != None else degree * 2
-        startdegree = degree
-        fba = {}
-        faa = {}
+        cache = BERNSTEINCACHE if cache == None else cache
         ret = []
         while True:
             for i in range(degree - lastdegree):
                 if coin() == 1:
                     ones += 1
-            c = math.comb(degree, ones)
-            md = degree
-            l = self._fb2(fbelow, degree, ones, c << md)
-            u = self._fa2(fabove, degree, ones, c << md)
-            if False:
-                fba[(degree, ones)] = l
-                faa[(degree, ones)] = u
-            ls = Fraction(0)
-            us = Fraction(1)
-            if degree > startdegree:
-                nh = math.comb(degree, ones)
-                md = lastdegree
-                combs = [
-                    Fraction(
-                        math.comb(degree - lastdegree, ones - j)
-                        * math.comb(lastdegree, j),
-                        nh,
-                    )
-                    for j in range(0, min(lastdegree, ones) + 1)
-                ]
-                if False:  # Correctness check
-                    for j in range(0, min(lastdegree, ones) + 1):
-                        fb = self._fb2(
-                            fbelow, lastdegree, j, math.comb(lastdegree, j) << md
-                        )
-                        if (lastdegree, j) in fba:
-                            # print(fb)
-                            if fba[(lastdegree, j)] != fb:
-                                raise ValueError
-                        fa = self._fa2(
-                            fabove, lastdegree, j, math.comb(lastdegree, j) << md
-                        )
-                        if (lastdegree, j) in faa:
-                            # print(fa)
-                            if faa[(lastdegree, j)] != fa:
-                                raise ValueError
-                ls = sum(
-                    self._fb2(fbelow, lastdegree, j, math.comb(lastdegree, j) << md)
-                    * combs[j]
-                    for j in range(0, min(lastdegree, ones) + 1)
-                )
-                us = sum(
-                    self._fa2(fabove, lastdegree, j, math.comb(lastdegree, j) << md)
-                    * combs[j]
-                    for j in range(0, min(lastdegree, ones) + 1)
-                )
+            l, u, ls, us = cache.bounds(
+                fbelow, fabove, _fb2n, _fa2n, degree, lastdegree, ones
+            )
+            if lastdegree > 0:
                 if ls > l:
                     # print([lastdegree,degree,ones,"ls",float(ls),"l",float(l)])
                     raise ValueError
                 if us < u:
                     # print([lastdegree,degree,ones,"us",float(us),"u",float(u)])
                     raise ValueError
+            else:
+                ls = Fraction(0)
+                us = Fraction(1)
             m = (ut - lt) / (us - ls)
             lt = lt + (l - ls) * m
             ut = ut - (us - u) * m
             # print([ret,"lt",float(lt),"ut",float(ut),"l",float(l),"u",float(u)])
             if self._uniform_less(ret, lt):
                 return 1
-            if not self.uniform_less(ret, ut):
+            if not self._uniform_less(ret, ut):
                 return 0
             lastdegree = degree
             degree = nextdegree(degree) if nextdegree != None else degree * 2
 
+class FactoryExpression:
+    """An expression tree of Bernoulli factory transforms, which can be
+    compiled into a standalone Python function that flips the output
+    coin.  Unlike composing lambdas around the Bernoulli class's
+    methods, the generated function has every layer inlined into a
+    single body, and draws its random bits 64 at a time.
+
+    The tree is given as nested tuples (or lists), where each node is
+    one of the following:
+    - "coin" or ("coin",): The input coin.
+    - A number in [0, 1], or ("const", c): A coin with that probability.
+    - ("complement", e): 1 - e.
+    - ("product", e1, e2): e1 * e2.
+    - ("logistic", e, cx, cy): c*e/(1+c*e), where c = cx/cy.
+    - ("exp_minus", e): exp(-e).
+    - ("power", e, ax, ay): e^(ax/ay).
+    - ("twocoin", e1, e2, c1, c2, beta): c1*e1*beta / (beta*(c1*e1+c2*e2) -
+      (beta-1)*(c1+c2)), with beta in (0, 1].
+    - ("linear", e, cx, cy, eps): (cx/cy)*e.  If cx/cy > 1, the generated
+      code calls Bernoulli.linear for this node.
+
+    The parameters have the same meaning as in the Bernoulli methods of the
+    same name.  The probability() method gives the probability of heads
+    expected from the tree, and simulate() flips the output coin using
+    the Bernoulli methods instead, so that both can be checked against
+    the compiled function.
+
+    Example:
+
+    >>> from bernoulli import FactoryExpression
+    >>> import random
+    >>> fe = FactoryExpression(("exp_minus", ("product", "coin", ("complement", "coin"))))
+    >>> f = fe.compile()
+    >>> coin = lambda: 1 if random.random() < 0.3 else 0
+    >>> print(sum(f(coin) for i in range(10000)) / 10000, fe.probability(0.3))
+    """
+
+    def __init__(self, expr):
+        self.expr = FactoryExpression._normalize(expr)
+
+    @staticmethod
+    def _normalize(e):
+        # Converts a tree to one made of tuples with
+        # Fraction parameters, and checks it
+        if e == "coin":
+            return ("coin",)
+        if isinstance(e, (int, float, Fraction)):
+            e = ("const", e)
+        op = e[0]
+        norm = FactoryExpression._normalize
+        if op == "coin":
+            return ("coin",)
+        if op == "const":
+            c = Fraction(e[1])
+            if c < 0 or c > 1:
+                raise ValueError
+            return ("const", c)
+        if op == "complement" or op == "exp_minus":
+            return (op, norm(e[1]))
+        if op == "product":
+            return (op, norm(e[1]), norm(e[2]))
+        if op == "logistic":
+            c = Fraction(e[2] if len(e) > 2 else 1, e[3] if len(e) > 3 else 1)
+            if c <= 0:
+                raise ValueError
+            return (op, norm(e[1]), c)
+        if op == "power":
+            a = Fraction(e[2], e[3] if len(e) > 3 else 1)
+            if a < 0:
+                raise ValueError
+            return (op, norm(e[1]), a)
+        if op == "twocoin":
+            c1 = Fraction(e[3] if len(e) > 3 else 1)
+            c2 = Fraction(e[4] if len(e) > 4 else 1)
+            beta = Fraction(e[5] if len(e) > 5 else 1)
+            if c1 <= 0 or c2 <= 0 or beta <= 0 or beta > 1:
+                raise ValueError
+            return (op, norm(e[1]), norm(e[2]), c1, c2, beta)
+        if op == "linear":
+            c = Fraction(e[2], e[3] if len(e) > 3 else 1)
+            eps = Fraction(e[4] if len(e) > 4 else Fraction(5, 100))
+            if c < 0:
+                raise ValueError
+            return (op, norm(e[1]), c, eps)
+        raise ValueError("unknown transform: %s" % (op,))
+
+    def probability(self, p, expr=None):
+        """Calculates the probability of heads of the output coin, given
+        the probability of heads 'p' of the input coin (as a float)."""
+        e = self.expr if expr == None else expr
+        op = e[0]
+        if op == "coin":
+            return p
+        if op == "const":
+            return float(e[1])
+        x = self.probability(p, e[1])
+        if op == "complement":
+            return 1 - x
+        if op == "exp_minus":
+            return math.exp(-x)
+        if op == "product":
+            return x * self.probability(p, e[2])
+        if op == "logistic":
+            return float(e[2]) * x / (1 + float(e[2]) * x)
+        if op == "power":
+            return x ** float(e[2])
+        if op == "twocoin":
+            y = self.probability(p, e[2])
+            c1, c2, beta = float(e[3]), float(e[4]), float(e[5])
+            return c1 * x * beta / (beta * (c1 * x + c2 * y) - (beta - 1) * (c1 + c2))
+        if op == "linear":
+            return float(e[2]) * x
+        raise ValueError
+
+    def simulate(self, bern, coin, expr=None):
+        """Flips the output coin by calling the methods of the Bernoulli
+        object 'bern', as a reference for the compiled function.
+        - coin(): Input coin; returns 1 or 0."""
+        e = self.expr if expr == None else expr
+        op = e[0]
+        sub = lambda i: (lambda: self.simulate(bern, coin, e[i]))
+        if op == "coin":
+            return coin()
+        if op == "const":
+            return bern.zero_or_one(e[1].numerator, e[1].denominator)
+        if op == "complement":
+            return bern.complement(sub(1))
+        if op == "exp_minus":
+            return bern.exp_minus(sub(1))
+        if op == "product":
+            return bern.product(sub(1), sub(2))
+        if op == "logistic":
+            return bern.logistic(sub(1), e[2].numerator, e[2].denominator)
+        if op == "power":
+            return bern.power(sub(1), e[2].numerator, e[2].denominator)
+        if op == "twocoin":
+            return bern.twocoin(sub(1), sub(2), e[3], e[4], e[5])
+        if op == "linear":
+            return bern.linear(sub(1), e[2].numerator, e[2].denominator, e[3])
+        raise ValueError
+
+    def codegen(self, name="sample_factory"):
+        """Generates standalone Python code for a function called 'name'
+        that takes the input coin (a function returning 1 or 0) and
+        returns 1 or 0 with the probability given by this expression.
+        Idea from Leydold, et al., "An Automatic Code Generator for
+        Nonuniform Random Variate Generation", 2001.
+        - name: Function name.  Default: 'sample_factory'."""
+        self._lines = []
+        self._subs = []
+        self._count = 0
+        self._name = name
+        self._usesbern = False
+        self._tables = []
+        body = self._function(name, self.expr)
+        ret = "import random\nfrom fractions import Fraction\n"
+        if self._usesbern:
+            ret += "import bernoulli\n\nBERN_%s = bernoulli.Bernoulli()\n" % (name,)
+        ret += "\n"
+        for table in self._tables:
+            ret += table + "\n"
+        for sub in self._subs:
+            ret += sub + "\n"
+        ret += body
+        return ret
+
+    def compile(self, name="sample_factory"):
+        """Generates the code given by codegen() and returns the
+        resulting function."""
+        ns = {}
+        exec(self.codegen(name), ns)
+        return ns[name]
+
+    def _function(self, fname, expr):
+        lines = self._lines
+        self._lines = []
+        self._emit(0, "BITS_%s = [0, 0]" % (fname,))
+        self._emit(0, "")
+        self._emit(0, "def %s(coin):" % (fname,))
+        self._emit(1, "bw, nb = BITS_%s" % (fname,))
+        self._compile(1, expr, "ret")
+        self._emit(1, "BITS_%s[0] = bw" % (fname,))
+        self._emit(1, "BITS_%s[1] = nb" % (fname,))
+        self._emit(1, "return ret")
+        ret = "\n".join(self._lines) + "\n"
+        self._lines = lines
+        return ret
+
+    def _emit(self, indent, line):
+        self._lines.append("    " * indent + line if line else "")
+
+    def _var(self, prefix):
+        self._count += 1
+        return "%s%d" % (prefix, self._count)
+
+    def _bit(self, ind, target):
+        # Draws a random bit from the 64-bit buffer 'bw'
+        self._emit(ind, "if nb == 0:")
+        self._emit(ind + 1, "bw = random.getrandbits(64)")
+        self._emit(ind + 1, "nb = 64")
+        self._emit(ind, "%s = bw & 1" % (target,))
+        self._emit(ind, "bw >>= 1")
+        self._emit(ind, "nb -= 1")
+
+    def _zero_or_one(self, ind, c, target):
+        # Same as Bernoulli.zero_or_one: decided by a lookup
+        # in the precompiled table of bitsource.FractionDigits if
+        # there's a zero among the next 8 bits, or one bit at a
+        # time otherwise
+        if c == 0 or c == 1:
+            self._emit(ind, "%s = %d" % (target, int(c)))
+            return
+        z = self._var("z")
+        b = self._var("b")
+        e = self._var("e")
+        px, py = c.numerator, c.denominator
+        table = "ZO%d_%s" % (len(self._tables), self._name)
+        self._tables.append("%s = %r" % (table, FractionDigits(px, py).table))
+        self._emit(ind, "if nb < 8:")
+        self._emit(ind + 1, "bw |= random.getrandbits(64) << nb")
+        self._emit(ind + 1, "nb += 64")
+        self._emit(ind, "%s = %s[bw & 255]" % (e, table))
+        self._emit(ind, "if %s != 0:" % (e,))
+        self._emit(ind + 1, "%s = %s & 1" % (target, e))
+        self._emit(ind + 1, "bw >>= %s >> 1" % (e,))
+        self._emit(ind + 1, "nb -= %s >> 1" % (e,))
+        self._emit(ind, "else:")
+        ind += 1
+        self._emit(ind, "%s = %d" % (z, px))
+        self._emit(ind, "while True:")
+        self._emit(ind + 1, "%s <<= 1" % (z,))
+        self._emit(ind + 1, "if %s == 0:" % (z,))
+        self._emit(ind + 2, "%s = 0" % (target,))
+        self._emit(ind + 2, "break")
+        self._bit(ind + 1, b)
+        self._emit(ind + 1, "if %s >= %d:" % (z, py))
+        self._emit(ind + 2, "if %s == 0:" % (b,))
+        self._emit(ind + 3, "%s = 1" % (target,))
+        self._emit(ind + 3, "break")
+        self._emit(ind + 2, "%s -= %d" % (z, py))
+        self._emit(ind + 1, "elif %s == 0:" % (b,))
+        self._emit(ind + 2, "%s = 0" % (target,))
+        self._emit(ind + 2, "break")
+
+    def _uniform_less(self, ind, ub, uc, q, target):
+        # Sets 'target' to 1 if a uniform random number, whose first
+        # 'uc' bits are given by 'ub' and whose remaining bits are
+        # drawn as needed, is less than the Fraction 'q', or 0 otherwise
+        b = self._var("b")
+        self._emit(ind, "while True:")
+        self._emit(
+            ind + 1,
+            "if (%s + 1) * %s.denominator <= %s.numerator << %s:" % (ub, q, q, uc),
+        )
+        self._emit(ind + 2, "%s = 1" % (target,))
+        self._emit(ind + 2, "break")
+        self._emit(
+            ind + 1, "if %s * %s.denominator >= %s.numerator << %s:" % (ub, q, q, uc)
+        )
+        self._emit(ind + 2, "%s = 0" % (target,))
+        self._emit(ind + 2, "break")
+        self._bit(ind + 1, b)
+        self._emit(ind + 1, "%s = (%s << 1) | %s" % (ub, ub, b))
+        self._emit(ind + 1, "%s += 1" % (uc,))
+
+    def _compile(self, ind, e, target):
+        # Emits code that sets 'target' to the result of flipping
+        # the coin given by the node 'e'
+        op = e[0]
+        if op == "coin":
+            self._emit(ind, "%s = coin()" % (target,))
+        elif op == "const":
+            self._zero_or_one(ind, e[1], target)
+        elif op == "complement":
+            self._compile(ind, e[1], target)
+            self._emit(ind, "%s ^= 1" % (target,))
+        elif op == "product":
+            self._compile(ind, e[1], target)
+            self._emit(ind, "if %s == 1:" % (target,))
+            self._compile(ind + 1, e[2], target)
+        elif op == "logistic":
+            c = e[2]
+            t = self._var("t")
+            self._emit(ind, "while True:")
+            self._zero_or_one(ind + 1, Fraction(c.denominator, c.numerator + c.denominator), t)
+            self._emit(ind + 1, "if %s == 1:" % (t,))
+            self._emit(ind + 2, "%s = 0" % (target,))
+            self._emit(ind + 2, "break")
+            self._compile(ind + 1, e[1], t)
+            self._emit(ind + 1, "if %s == 1:" % (t,))
+            self._emit(ind + 2, "%s = 1" % (target,))
+            self._emit(ind + 2, "break")
+        elif op == "exp_minus":
+            t, u, l, uw = self._var("t"), self._var("u"), self._var("l"), self._var("uw")
+            n, fac, ub, uc = self._var("n"), self._var("fac"), self._var("ub"), self._var("uc")
+            self._emit(ind, "%s = Fraction(1)" % (u,))
+            self._emit(ind, "%s = Fraction(0)" % (l,))
+            self._emit(ind, "%s = 1" % (uw,))
+            self._emit(ind, "%s = 1" % (n,))
+            self._emit(ind, "%s = 1" % (fac,))
+            self._emit(ind, "%s = 0" % (ub,))
+            self._emit(ind, "%s = 0" % (uc,))
+            self._emit(ind, "while True:")
+            self._emit(ind + 1, "if %s != 0:" % (uw,))
+            self._compile(ind + 2, e[1], t)
+            self._emit(ind + 2, "%s *= %s" % (uw, t))
+            self._emit(ind + 1, "if %s %% 2 == 0:" % (n,))
+            self._emit(ind + 2, "%s = %s + Fraction(%s, %s)" % (u, l, uw, fac))
+            self._emit(ind + 1, "else:")
+            self._emit(ind + 2, "%s = %s - Fraction(%s, %s)" % (l, u, uw, fac))
+            self._uniform_less(ind + 1, ub, uc, l, t)
+            self._emit(ind + 1, "if %s == 1:" % (t,))
+            self._emit(ind + 2, "%s = 1" % (target,))
+            self._emit(ind + 2, "break")
+            self._uniform_less(ind + 1, ub, uc, u, t)
+            self._emit(ind + 1, "if %s == 0:" % (t,))
+            self._emit(ind + 2, "%s = 0" % (target,))
+            self._emit(ind + 2, "break")
+            self._emit(ind + 1, "%s += 1" % (n,))
+            self._emit(ind + 1, "%s *= %s" % (fac, n))
+        elif op == "power":
+            a = e[2]
+            if a == 0:
+                self._emit(ind, "%s = 1" % (target,))
+            elif a == 1:
+                self._compile(ind, e[1], target)
+            elif a > 1:
+                # Same decomposition as Bernoulli.power: the integer part
+                # less 1 as repeated flips, and 1 plus the fractional
+                # part in two pieces less than 1
+                xf = a.numerator // a.denominator
+                nx = a.numerator % a.denominator
+                parts = []
+                if nx > 0:
+                    xf -= 1
+                    nx += a.denominator
+                    parts = [nx // 2, nx - nx // 2]
+                factors = [("power", e[1], Fraction(x, a.denominator)) for x in parts]
+                factors += [e[1] for i in range(xf)]
+                self._compile(ind, factors[0], target)
+                for i in range(1, len(factors)):
+                    self._emit(ind + i - 1, "if %s == 1:" % (target,))
+                    self._compile(ind + i, factors[i], target)
+            else:
+                # Algorithm from Mendo 2019
+                t, i = self._var("t"), self._var("i")
+                self._emit(ind, "%s = 1" % (i,))
+                self._emit(ind, "while True:")
+                self._compile(ind + 1, e[1], t)
+                self._emit(ind + 1, "if %s == 1:" % (t,))
+                self._emit(ind + 2, "%s = 1" % (target,))
+                self._emit(ind + 2, "break")
+                # zero_or_one(ax, ay*i), with a denominator known only at run time
+                z, b = self._var("z"), self._var("b")
+                self._emit(ind + 1, "%s = %d" % (z, a.numerator))
+                self._emit(ind + 1, "%s = %d * %s" % (t, a.denominator, i))
+                self._emit(ind + 1, "while True:")
+                self._emit(ind + 2, "%s <<= 1" % (z,))
+                self._emit(ind + 2, "if %s == 0:" % (z,))
+                self._emit(ind + 3, "%s = -1" % (z,))
+                self._emit(ind + 3, "break")
+                self._bit(ind + 2, b)
+                self._emit(ind + 2, "if %s >= %s:" % (z, t))
+                self._emit(ind + 3, "if %s == 0:" % (b,))
+                self._emit(ind + 4, "break")
+                self._emit(ind + 3, "%s -= %s" % (z, t))
+                self._emit(ind + 2, "elif %s == 0:" % (b,))
+                self._emit(ind + 3, "%s = -1" % (z,))
+                self._emit(ind + 3, "break")
+                self._emit(ind + 1, "if %s >= 0:" % (z,))
+                self._emit(ind + 2, "%s = 0" % (target,))
+                self._emit(ind + 2, "break")
+                self._emit(ind + 1, "%s += 1" % (i,))
+        elif op == "twocoin":
+            c1, c2, beta = e[3], e[4], e[5]
+            t = self._var("t")
+            self._emit(ind, "while True:")
+            if beta != 1:
+                self._zero_or_one(ind + 1, beta, t)
+                self._emit(ind + 1, "if %s == 0:" % (t,))
+                self._emit(ind + 2, "%s = 0" % (target,))
+                self._emit(ind + 2, "break")
+            self._zero_or_one(ind + 1, c1 / (c1 + c2), t)
+            self._emit(ind + 1, "if %s == 1:" % (t,))
+            self._compile(ind + 2, e[1], t)
+            self._emit(ind + 2, "if %s == 1:" % (t,))
+            self._emit(ind + 3, "%s = 1" % (target,))
+            self._emit(ind + 3, "break")
+            self._emit(ind + 1, "else:")
+            self._compile(ind + 2, e[2], t)
+            self._emit(ind + 2, "if %s == 1:" % (t,))
+            self._emit(ind + 3, "%s = 0" % (target,))
+            self._emit(ind + 3, "break")
+        elif op == "linear":
+            c = e[2]
+            if c <= 1:
+                self._zero_or_one(ind, c, target)
+                if c != 0:
+                    self._emit(ind, "if %s == 1:" % (target,))
+                    self._compile(ind + 1, e[1], target)
+            else:
+                # Huber's algorithm for c > 1 is left to Bernoulli.linear,
+                # which flips a separately compiled function for the input
+                sub = self._var(self._name + "_sub")
+                self._subs.append(self._function(sub, e[1]))
+                self._usesbern = True
+                self._emit(
+                    ind,
+                    "%s = BERN_%s.linear(lambda: %s(coin), %d, %d, Fraction(%d, %d))"
+                    % (
+                        target,
+                        self._name,
+                        sub,
+                        c.numerator,
+                        c.denominator,
+                        e[3].numerator,
+                        e[3].denominator,
+                    ),
+                )
+        else:
+            raise ValueError
+
 def _multinom(n, x):
     # Use "ymulticoeff" algorithm found in https://github.com/leolca/bincoeff#multicoeff
     num = 1
@@ -1358,14 +1895,23 @@ class DiceEnterprise:
     >>> coin=lambda: 1 if random.random() < 0.60 else 0
     >>> print([ent.next(coin) for i in range(100)])
 
+    If 'doubling' is True (the default), coupling from the past
+    goes back 1, 2, 4, 8, ... steps, reusing the coin flips and
+    uniform numbers already drawn, so that a run needing T steps
+    makes O(T) ladder updates; otherwise it goes back one step
+    at a time and replays the whole history after each step
+    (O(T^2) updates).  After each call to 'next', the 'updates'
+    attribute holds the number of ladder updates that call made.
     """
 
-    def __init__(self):
+    def __init__(self, doubling=True):
         self.ladder = []
         self.optladder = []
         self.bern = Bernoulli()
         self.vmatrix = None
         self._dirty = True
+        self.doubling = doubling
+        self.updates = 0
 
     def append_poly(self, result, poly):
         """
@@ -1672,7 +2218,10 @@ class DiceEnterprise:
             self._dirty = False
             self._autoaugment()
             self._compile_ladder()
-        if len(self.ladder[0][1]) == 2:
+        self.updates = 0
+        if self.doubling:
+            s = self._doublingcftp(coin)
+        elif len(self.ladder[0][1]) == 2:
             s = self._monotoniccftp(coin)
         else:
             s = self._cftp(coin)
@@ -1738,10 +2287,51 @@ class DiceEnterprise:
                 fr1 = n
             self.optladder[i] = [fr1, fr2, fr3]
             # print(self.optladder)
+        self._compile_transitions()
         return self
 
+    def _compile_transitions(self):
+        # Builds a compact form of the ladder's transition table
+        # for _doublingcftp.  For each state i and input b, the
+        # entries trstart[i*nb+b] through trstart[i*nb+b+1]-1 of the
+        # integer arrays 'trtarget' give the states that can follow,
+        # and the same entries of 'trnum' and 'trden' give the
+        # cumulative probabilities of moving to those states, as
+        # numerators and denominators (kept in lists since they
+        # can be arbitrarily large).
+        k = len(self.ladder)
+        univ = self._is_univariate()
+        nb = 2 if univ else len(self.neighbors[0])
+        trstart = array.array("l", [0])
+        trtarget = array.array("l")
+        trnum = []
+        trden = []
+        for i in range(k):
+            for b in range(nb):
+                if univ:
+                    # Heads moves down, tails moves up
+                    fr = self.optladder[i][0] if b == 1 else self.optladder[i][1]
+                    j = i - 1 if b == 1 else i + 1
+                    if j >= 0 and j < k and fr != 0:
+                        fr = fr if isinstance(fr, Fraction) else Fraction(fr)
+                        trtarget.append(j)
+                        trnum.append(fr.numerator)
+                        trden.append(fr.denominator)
+                else:
+                    for v, j in zip(self.optladder[i][0][b], self.neighbors[i][b]):
+                        trtarget.append(j)
+                        trnum.append(v[0])
+                        trden.append(v[1])
+                trstart.append(len(trtarget))
+        self.trstates = nb
+        self.trstart = trstart
+        self.trtarget = trtarget
+        self.trnum = trnum
+        self.trden = trden
+
     def _monotonicladderupdate(self, i, b, u):
         # Update function for univariate ladders (coins-to-dice)
+        self.updates += 1
         # Heads case
         if i > 0 and b == 1 and self.bern._uniform_less(u, self.optladder[i][0]):
             return i - 1
@@ -1755,6 +2345,7 @@ class DiceEnterprise:
         return i
 
     def _ladderupdate(self, i, b, u):
+        self.updates += 1
         vs = self.optladder[i][0][b]
         n = self.neighbors[i][b]
         for v, j in zip(vs, n):
@@ -1762,6 +2353,45 @@ class DiceEnterprise:
                 return j
         return i
 
+    def _compactupdate(self, i, b, u):
+        # Same as _monotonicladderupdate or _ladderupdate, but
+        # uses the compact transition table
+        self.updates += 1
+        pos = i * self.trstates + b
+        for t in range(self.trstart[pos], self.trstart[pos + 1]):
+            if self.bern._uniform_less_nd(u, self.trnum[t], self.trden[t]):
+                return self.trtarget[t]
+        return i
+
+    def _doublingcftp(self, coin):
+        # Coupling from the past, going back 1, 2, 4, ... steps.
+        # bs[t] and us[t] are the coin flip and uniform number
+        # used t+1 steps before time 0; they're kept from one
+        # pass to the next.
+        k = len(self.ladder)
+        monotonic = self._is_univariate()
+        bs = []
+        us = []
+        steps = 1
+        while True:
+            while len(bs) < steps:
+                bs.append(coin())
+                us.append([])  # Uniform random number to be filled on demand
+            if monotonic:
+                # The ladder's update preserves the order of states,
+                # so only the lowest and highest states are tracked
+                states = [0, k - 1]
+            else:
+                states = [x for x in range(k)]
+            for t in range(steps - 1, -1, -1):
+                states = [self._compactupdate(s, bs[t], us[t]) for s in states]
+                if len(states) > 1 and not monotonic:
+                    # Track only distinct states
+                    states = list(set(states))
+            if self._allsame(states):
+                return [self.optladder[states[0]][2], self.ladder[states[0]][2]]
+            steps *= 2
+
     def _allsame(self, states):
         for i in range(len(states) - 1):
             if states[i] != states[i + 1]:
@@ -8,7 +8,9 @@ import random
 import bernoulli
 import randomgen
 import math
+import weakref
 from fractions import Fraction
+from instrument import Instrumented
 
 def betabin(k, psi, rho, cpsi, m=5):
     ret = math.comb(m - 1, k - 1)
@@ -199,8 +201,243 @@ def exchangeable_bernoulli(p, d, lamda=None):
 
 ###################
 
+class PSRN:
+    """A partially-sampled random number (PSRN) in base 2 whose
+    digits after the point are packed into one integer, rather
+    than stored one list item per digit.
+    - sign: 1 or -1.
+    - ipart: Integer part, 0 or greater.
+    - bits: Digits after the point, as an integer whose most
+      significant of 'length' bits is the first digit.
+    - length: Number of digit positions after the point.
+    - unset: Bit mask, aligned like 'bits', of the positions whose
+      digit is not sampled yet (their bits in 'bits' are 0).
+    The psrn_* functions accept PSRN objects as well as
+    the list form [sign, ipart, digits], where 'digits' is a list
+    of 0, 1, or None; fromlist and tolist convert between the two."""
+
+    __slots__ = ("sign", "ipart", "bits", "length", "unset")
+
+    def __init__(self, sign=1, ipart=0, bits=0, length=0, unset=0):
+        self.sign = sign
+        self.ipart = ipart
+        self.bits = bits
+        self.length = length
+        self.unset = unset
+
+    @staticmethod
+    def fromlist(psrn):
+        """ Creates a PSRN object from the list form of a base-2 PSRN. """
+        bits = 0
+        unset = 0
+        for d in psrn[2]:
+            bits <<= 1
+            unset <<= 1
+            if d == None:
+                unset |= 1
+            else:
+                bits |= d
+        return PSRN(psrn[0], psrn[1], bits, len(psrn[2]), unset)
+
+    def tolist(self):
+        """ Returns this PSRN in list form. """
+        digits = [0 for i in range(self.length)]
+        for i in range(self.length):
+            pos = self.length - 1 - i
+            if (self.unset >> pos) & 1 != 0:
+                digits[i] = None
+            else:
+                digits[i] = (self.bits >> pos) & 1
+        return [self.sign, self.ipart, digits]
+
+    def copy(self):
+        return PSRN(self.sign, self.ipart, self.bits, self.length, self.unset)
+
+    def __repr__(self):
+        return "PSRN.fromlist(%s)" % (self.tolist(),)
+
+    def fill(self, rg):
+        """ Samples all unsampled digits up to this PSRN's length. """
+        unset = self.unset
+        if unset == 0:
+            return
+        count = bin(unset).count("1")
+        r = _psrn_randbits(rg, count)
+        if count == self.length:
+            self.bits = r
+        else:
+            # Deposit the random bits at the unset positions
+            bits = self.bits
+            while unset != 0:
+                low = unset & -unset
+                if r & 1 != 0:
+                    bits |= low
+                r >>= 1
+                unset ^= low
+            self.bits = bits
+        self.unset = 0
+
+    def extend(self, rg, count):
+        """ Samples 'count' more digits at the end of this PSRN. """
+        self.bits = (self.bits << count) | _psrn_randbits(rg, count)
+        self.unset <<= count
+        self.length += count
+
+    def fraction_int(self):
+        """Returns the integer part and sampled digits of this
+        PSRN (whose digits must all be sampled) as one integer,
+        that is, the PSRN's lower bound times 2^length."""
+        return (self.ipart << self.length) | self.bits
+
+    # The following methods let a PSRN serve as a geometric bag
+    # (Flajolet et al. 2010), as Bernoulli.geometric_bag and related
+    # methods accept in place of a list of digits.  They look only
+    # at the digits after the point and sample digits one at a time
+    # with 'rg.randbit()', in the same order as the list form does.
+
+    def clear(self):
+        """ Forgets all digits after the point. """
+        self.bits = 0
+        self.length = 0
+        self.unset = 0
+
+    def prefix(self):
+        """ Returns the number of digits sampled before the first unsampled one. """
+        return self.length - self.unset.bit_length()
+
+    def digit(self, rg, i):
+        """Gets the digit at position 'i' after the point (starting
+        at 0), sampling it if necessary and extending this PSRN's
+        length (with unsampled digits) to include it."""
+        if i >= self.length:
+            k = i + 1 - self.length
+            self.bits <<= k
+            self.unset = (self.unset << k) | ((1 << k) - 1)
+            self.length = i + 1
+        pos = self.length - 1 - i
+        if (self.unset >> pos) & 1 != 0:
+            self.unset ^= 1 << pos
+            if rg.randbit() != 0:
+                self.bits |= 1 << pos
+        return (self.bits >> pos) & 1
+
+    def less_fraction(self, rg, num, den):
+        """Returns 1 if the number whose digits after the point are
+        this PSRN's is less than num/den (in [0, 1]), or 0 otherwise.
+        The digits sampled so far are compared all at once; further
+        digits are sampled only while they don't decide the result."""
+        if num == 0:
+            return 0
+        if num == den:
+            return 1
+        length = self.length
+        m = length - self.unset.bit_length()
+        if m > 0:
+            p = self.bits >> (length - m)
+            q, num = divmod(num << m, den)
+            if p != q:
+                return 1 if p < q else 0
+        i = m
+        while num != 0:
+            num <<= 1
+            d = 1 if num >= den else 0
+            if d == 1:
+                num -= den
+            if i < length:
+                pos = length - 1 - i
+                if (self.unset >> pos) & 1 != 0:
+                    self.unset ^= 1 << pos
+                    if rg.randbit() != 0:
+                        self.bits |= 1 << pos
+                mybit = (self.bits >> pos) & 1
+            else:
+                mybit = self.digit(rg, i)
+                length = self.length
+            if mybit != d:
+                return d
+            i += 1
+        # The fraction's expansion ended, and the digits
+        # equal it so far
+        return 0
+
+    def less_real(self, rg, x):
+        """Returns 1 if the number whose digits after the point are
+        this PSRN's is less than the Real number x (in [0, 1]), or 0
+        otherwise.  Digits are sampled only while the approximations
+        of x don't decide the result."""
+        n = max(1, self.prefix())
+        while True:
+            for i in range(self.prefix(), n):
+                self.digit(rg, i)
+            p = self.bits >> (self.length - n)
+            # x.ev(n) is within 1 of x*2^n
+            e = x.ev(n)
+            if p + 2 <= e:
+                return 1
+            if p >= e + 1:
+                return 0
+            n += 1
+
+def _psrn_randbits(rg, count):
+    # Random integer with 'count' bits from 'rg', which may be
+    # a RandomGen or any object with an 'rndint' method
+    if count <= 0:
+        return 0
+    if isinstance(rg, randomgen.RandomGen):
+        return rg.randbits(count)
+    return rg.rndint((1 << count) - 1)
+
+def _psrn_ispacked(*psrns):
+    for p in psrns:
+        if isinstance(p, PSRN):
+            return True
+    return False
+
+def _psrn_pack(*psrns):
+    # PSRN objects for the given PSRNs in either form
+    return [p if isinstance(p, PSRN) else PSRN.fromlist(p) for p in psrns]
+
+def _psrn_unpack(orig, packed):
+    # Copies digits sampled in the PSRN objects back to
+    # the PSRNs among 'orig' in list form, keeping
+    # the identity of their digit lists
+    for i in range(len(orig)):
+        o = orig[i]
+        if not isinstance(o, PSRN):
+            lst = packed[i].tolist()
+            o[0] = lst[0]
+            o[1] = lst[1]
+            o[2][:] = lst[2]
+
+def _psrn_align(rg, p1, p2):
+    # Samples all digits of two PSRN objects and gives them
+    # the same length
+    p1.fill(rg)
+    p2.fill(rg)
+    if p1.length < p2.length:
+        p1.extend(rg, p2.length - p1.length)
+    elif p2.length < p1.length:
+        p2.extend(rg, p1.length - p2.length)
+    return p1.length
+
+def _psrn_fromint(sign, v, count, digits=2, packed=False):
+    # PSRN with the given sign whose integer part and
+    # fractional digits are the base-'digits' digits of v,
+    # the last 'count' of which come after the point
+    if packed:
+        return PSRN(sign, v >> count, v & ((1 << count) - 1), count)
+    ret = [sign, 0, [0 for i in range(count)]]
+    for i in range(count):
+        ret[2][count - 1 - i] = v % digits
+        v //= digits
+    ret[1] = v
+    return ret
+
 def psrn_complement(x):
     # NOTE: Assumes digits is 2
+    if isinstance(x, PSRN):
+        x.bits = ~(x.bits | x.unset) & ((1 << x.length) - 1)
+        return x
     for i in range(len(x[2])):
         if x[2][i] != None:
             x[2][i] = 1 - x[2][i]
@@ -210,6 +447,19 @@ def psrn_new_01():
     return [1, 0, []]
 
 def psrn_fill(rg, psrn, precision=53, digits=2):
+    if isinstance(psrn, PSRN):
+        if psrn.sign != -1 and psrn.sign != 1:
+            raise ValueError
+        psrn.fill(rg)
+        if psrn.length < precision + 1:
+            psrn.extend(rg, precision + 1 - psrn.length)
+        af = psrn.bits >> (psrn.length - (precision + 1))
+        if af & 1 != 0:
+            # round up
+            return (
+                psrn.sign * (((af >> 1) + 1) + (psrn.ipart << precision))
+            ) / (1 << precision)
+        return psrn.sign * ((af >> 1) + (psrn.ipart << precision)) / (1 << precision)
     af = 0
     afrac = psrn[2]
     asign = psrn[0]
@@ -389,9 +639,21 @@ def psrn_in_range_positive(rg, bmin, bmax, digits=2):
         return a
 
 def psrn_sample(rg, psrn, digits=2):
+    if isinstance(psrn, PSRN):
+        p = PSRN(1, 0, psrn.bits, psrn.length, psrn.unset)
+        ret = psrn_less(rg, PSRN(), p)
+        psrn.bits = p.bits
+        psrn.length = p.length
+        psrn.unset = p.unset
+        return ret
     return psrn_less(rg, psrn_new_01(), [1, 0, psrn[2]], digits)
 
 def psrn_less(rg, psrn1, psrn2, digits=2):
+    if digits == 2 and _psrn_ispacked(psrn1, psrn2):
+        packed = _psrn_pack(psrn1, psrn2)
+        ret = _psrn_less_packed(rg, packed[0], packed[1])
+        _psrn_unpack([psrn1, psrn2], packed)
+        return ret
     if psrn1[0] == None or psrn1[1] == None or psrn2[0] == None or psrn2[1] == None:
         raise ValueError
     if psrn1[0] != psrn2[0]:
@@ -430,7 +692,32 @@ def psrn_less(rg, psrn1, psrn2, digits=2):
             return 0
         index += 1
 
+def _psrn_less_packed(rg, a, b):
+    if a.sign != b.sign:
+        return 1 if a.sign < 0 else 0
+    if a.sign >= 0:
+        if a.ipart < b.ipart:
+            return 1
+        if a.ipart > b.ipart:
+            return 0
+    if a.sign < 0:
+        if a.ipart < b.ipart:
+            return 0
+        if a.ipart > b.ipart:
+            return 1
+    # Compare the digits a word at a time, sampling
+    # more digits of both in growing chunks while they're equal
+    _psrn_align(rg, a, b)
+    chunk = 4
+    while a.bits == b.bits:
+        a.extend(rg, chunk)
+        b.extend(rg, chunk)
+        chunk = min(64, chunk * 2)
+    return 1 if a.bits < b.bits else 0
+
 def psrn_less_than_fraction(rg, psrn, rat, digits=2):
+    if digits == 2 and isinstance(psrn, PSRN):
+        return _psrn_less_than_fraction_packed(rg, psrn, rat)
     if (psrn[0] != -1 and psrn[0] != 1) or psrn[1] == None:
         raise ValueError
     rat = rat if isinstance(rat, Fraction) else Fraction(rat)
@@ -493,26 +780,80 @@ def psrn_less_than_fraction(rg, psrn, rat, digits=2):
         pt *= digits
         index += 1
 
+def _psrn_less_than_fraction_packed(rg, psrn, rat):
+    if (psrn.sign != -1 and psrn.sign != 1) or psrn.ipart == None:
+        raise ValueError
+    rat = rat if isinstance(rat, Fraction) else Fraction(rat)
+    bs = -1 if rat < 0 else 1
+    num = abs(rat.numerator)
+    den = abs(rat.denominator)
+    bi = num // den
+    num -= den * bi
+    if psrn.sign != bs:
+        return 1 if psrn.sign < 0 else 0
+    if psrn.sign > 0:
+        if psrn.ipart < bi:
+            return 1
+        if psrn.ipart > bi:
+            return 0
+    else:
+        if psrn.ipart > bi:
+            return 1
+        if psrn.ipart < bi:
+            return 0
+    if num == 0:
+        # Is an integer
+        return 0 if psrn.sign > 0 else 1
+    # Compare the PSRN's digits with as many binary digits
+    # of num/den, a word at a time
+    psrn.fill(rg)
+    chunk = 4
+    while True:
+        length = psrn.length
+        d2 = (num << length) // den
+        if psrn.bits < d2:
+            return 1 if psrn.sign > 0 else 0
+        if psrn.bits > d2:
+            return 0 if psrn.sign > 0 else 1
+        if (num << length) == d2 * den:
+            # Remaining digits of num/den are all zeros
+            return 0 if psrn.sign > 0 else 1
+        psrn.extend(rg, chunk)
+        chunk = min(64, chunk * 2)
+
 def psrn_reciprocal(rg, psrn1, digits=2):
     """Generates the reciprocal of a partially-sampled random number.
     psrn1: List containing the sign, integer part, and fractional part
         of the first PSRN.  Fractional part is a list of digits
         after the point, starting with the first.
     digits: Digit base of PSRNs' digits.  Default is 2, or binary."""
-    if psrn1[0] == None or psrn1[1] == None:
-        raise ValueError
-    for i in range(len(psrn1[2])):
-        psrn1[2][i] = rg.rndint(digits - 1) if psrn1[2][i] == None else psrn1[2][i]
-    digitcount = len(psrn1[2])
-    frac1 = psrn1[1]
-    for i in range(digitcount):
-        frac1 = frac1 * digits + psrn1[2][i]
-    while frac1 == 0:
-        # Avoid degenerate cases
-        d1 = rg.rndint(digits - 1)
-        psrn1[2].append(d1)
-        frac1 = frac1 * digits + d1
-        digitcount += 1
+    packed = digits == 2 and isinstance(psrn1, PSRN)
+    if packed:
+        if psrn1.sign == None or psrn1.ipart == None:
+            raise ValueError
+        psrn1.fill(rg)
+        while psrn1.fraction_int() == 0:
+            # Avoid degenerate cases
+            psrn1.extend(rg, 1)
+        digitcount = psrn1.length
+        frac1 = psrn1.fraction_int()
+        sign1 = psrn1.sign
+    else:
+        if psrn1[0] == None or psrn1[1] == None:
+            raise ValueError
+        for i in range(len(psrn1[2])):
+            psrn1[2][i] = rg.rndint(digits - 1) if psrn1[2][i] == None else psrn1[2][i]
+        digitcount = len(psrn1[2])
+        frac1 = psrn1[1]
+        for i in range(digitcount):
+            frac1 = frac1 * digits + psrn1[2][i]
+        while frac1 == 0:
+            # Avoid degenerate cases
+            d1 = rg.rndint(digits - 1)
+            psrn1[2].append(d1)
+            frac1 = frac1 * digits + d1
+            digitcount += 1
+        sign1 = psrn1[0]
     while True:
         dcount = digitcount
         ddc = digits ** dcount
@@ -543,14 +884,7 @@ def psrn_reciprocal(rg, psrn1, digits=2):
                 #   "rvxf",float(rvxf),float(rvxf2),"rvd",float(rvd),
                 #   "sl",float((rvd*rvd)/(rvlarge*rvlarge)),float((rvd*rvd)/(rvsmall*rvsmall))])
                 if rvxf2 < (rvd * rvd) / (rvlarge * rvlarge):
-                    cpsrn = [1, 0, [0 for i in range(dcount)]]
-                    cpsrn[0] = psrn1[0]
-                    sret = rv
-                    for i in range(dcount):
-                        cpsrn[2][dcount - 1 - i] = sret % digits
-                        sret //= digits
-                    cpsrn[1] = sret
-                    return cpsrn
+                    return _psrn_fromint(sign1, rv, dcount, digits, packed)
                 elif rvxf > (rvd * rvd) / (rvsmall * rvsmall):
                     break
             elif rvsmall > large or rvlarge < small:
@@ -716,37 +1050,54 @@ if False:
     exit()
 
 def psrn_multiply_b(rg, psrn1, psrn2, digits=2, testing=False):
-    if psrn1[0] == None or psrn1[1] == None or psrn2[0] == None or psrn2[1] == None:
-        raise ValueError
-    for i in range(len(psrn1[2])):
-        psrn1[2][i] = rg.rndint(digits - 1) if psrn1[2][i] == None else psrn1[2][i]
-    for i in range(len(psrn2[2])):
-        psrn2[2][i] = rg.rndint(digits - 1) if psrn2[2][i] == None else psrn2[2][i]
-    while len(psrn1[2]) < len(psrn2[2]):
-        psrn1[2].append(rg.rndint(digits - 1))
-    while len(psrn1[2]) > len(psrn2[2]):
-        psrn2[2].append(rg.rndint(digits - 1))
-    digitcount = len(psrn1[2])
-    if len(psrn2[2]) != digitcount:
-        raise ValueError
-    # Perform multiplication
-    frac1 = psrn1[1]
-    frac2 = psrn2[1]
-    for i in range(digitcount):
-        frac1 = frac1 * digits + psrn1[2][i]
-    for i in range(digitcount):
-        frac2 = frac2 * digits + psrn2[2][i]
+    packed = digits == 2 and _psrn_ispacked(psrn1, psrn2)
+    if packed:
+        orig = [psrn1, psrn2]
+        psrn1, psrn2 = _psrn_pack(psrn1, psrn2)
+        digitcount = _psrn_align(rg, psrn1, psrn2)
+        while psrn1.fraction_int() == 0 or psrn2.fraction_int() == 0:
+            # Avoid degenerate cases
+            psrn1.extend(rg, 1)
+            psrn2.extend(rg, 1)
+            digitcount += 1
+        _psrn_unpack(orig, [psrn1, psrn2])
+        frac1 = psrn1.fraction_int()
+        frac2 = psrn2.fraction_int()
+        sign1 = psrn1.sign
+        sign2 = psrn2.sign
+    else:
+        if psrn1[0] == None or psrn1[1] == None or psrn2[0] == None or psrn2[1] == None:
+            raise ValueError
+        for i in range(len(psrn1[2])):
+            psrn1[2][i] = rg.rndint(digits - 1) if psrn1[2][i] == None else psrn1[2][i]
+        for i in range(len(psrn2[2])):
+            psrn2[2][i] = rg.rndint(digits - 1) if psrn2[2][i] == None else psrn2[2][i]
+        while len(psrn1[2]) < len(psrn2[2]):
+            psrn1[2].append(rg.rndint(digits - 1))
+        while len(psrn1[2]) > len(psrn2[2]):
+            psrn2[2].append(rg.rndint(digits - 1))
+        digitcount = len(psrn1[2])
+        if len(psrn2[2]) != digitcount:
+            raise ValueError
+        # Perform multiplication
+        frac1 = psrn1[1]
+        frac2 = psrn2[1]
+        for i in range(digitcount):
+            frac1 = frac1 * digits + psrn1[2][i]
+        for i in range(digitcount):
+            frac2 = frac2 * digits + psrn2[2][i]
+        while frac1 == 0 or frac2 == 0:
+            # Avoid degenerate cases
+            d1 = rg.rndint(digits - 1)
+            psrn1[2].append(d1)
+            d2 = rg.rndint(digits - 1)
+            psrn2[2].append(d2)
+            frac1 = frac1 * digits + d1
+            frac2 = frac2 * digits + d2
+            digitcount += 1
+        sign1 = psrn1[0]
+        sign2 = psrn2[0]
     zero = False  # (frac1 == 0 and frac2 != 0) or (frac2 == 0 and frac1 != 0)
-    # print(["before",frac1,frac2,zero])
-    while frac1 == 0 or frac2 == 0:
-        # Avoid degenerate cases
-        d1 = rg.rndint(digits - 1)
-        psrn1[2].append(d1)
-        d2 = rg.rndint(digits - 1)
-        psrn2[2].append(d2)
-        frac1 = frac1 * digits + d1
-        frac2 = frac2 * digits + d2
-        digitcount += 1
     # print(["after",frac1,frac2])
     small = frac1 * frac2
     mid1 = frac1 * (frac2 + 1)
@@ -756,7 +1107,7 @@ def psrn_multiply_b(rg, psrn1, psrn2, digits=2, testing=False):
     midmax = max(mid1, mid2)
     dc2 = digitcount * 2
     cpsrn = [1, 0, [0 for i in range(dc2)]]
-    cpsrn[0] = psrn1[0] * psrn2[0]
+    cpsrn[0] = sign1 * sign2
     iters = 0
     while True:
         iters += 1
@@ -788,7 +1139,7 @@ def psrn_multiply_b(rg, psrn1, psrn2, digits=2, testing=False):
                     cpsrn[2][idx] = psrn[2][i]
                 cpsrn[1] = sret
                 # if iters>100:print(iters)
-                return cpsrn
+                return PSRN.fromlist(cpsrn) if packed else cpsrn
         else:
             # Middle, or uniform, part of product density
             if not zero:
@@ -798,13 +1149,8 @@ def psrn_multiply_b(rg, psrn1, psrn2, digits=2, testing=False):
                 else:
                     if _log_1n(rg, frac2) == 0:
                         continue
-            sret = small + rv
-            for i in range(dc2):
-                cpsrn[2][dc2 - 1 - i] = sret % digits
-                sret //= digits
-            cpsrn[1] = sret
             # if iters>100:print(iters)
-            return cpsrn
+            return _psrn_fromint(cpsrn[0], small + rv, dc2, digits, packed)
 
 def psrn_multiply_by_fraction(rg, psrn1, fraction, digits=2):
     """Multiplies a partially-sampled random number by a fraction.
@@ -813,18 +1159,28 @@ def psrn_multiply_by_fraction(rg, psrn1, fraction, digits=2):
         after the point, starting with the first.
     fraction: Fraction to multiply by.
     digits: Digit base of PSRNs' digits.  Default is 2, or binary."""
-    if psrn1[0] == None or psrn1[1] == None:
-        raise ValueError
+    packed = digits == 2 and isinstance(psrn1, PSRN)
     fraction = Fraction(fraction)
-    for i in range(len(psrn1[2])):
-        psrn1[2][i] = rg.rndint(digits - 1) if psrn1[2][i] == None else psrn1[2][i]
-    digitcount = len(psrn1[2])
-    # Perform multiplication
-    frac1 = psrn1[1]
     fracsign = -1 if fraction < 0 else 1
     absfrac = abs(fraction)
-    for i in range(digitcount):
-        frac1 = frac1 * digits + psrn1[2][i]
+    if packed:
+        if psrn1.sign == None or psrn1.ipart == None:
+            raise ValueError
+        psrn1.fill(rg)
+        digitcount = psrn1.length
+        frac1 = psrn1.fraction_int()
+        sign1 = psrn1.sign
+    else:
+        if psrn1[0] == None or psrn1[1] == None:
+            raise ValueError
+        for i in range(len(psrn1[2])):
+            psrn1[2][i] = rg.rndint(digits - 1) if psrn1[2][i] == None else psrn1[2][i]
+        digitcount = len(psrn1[2])
+        # Perform multiplication
+        frac1 = psrn1[1]
+        for i in range(digitcount):
+            frac1 = frac1 * digits + psrn1[2][i]
+        sign1 = psrn1[0]
     while True:
         dcount = digitcount
         ddc = digits ** dcount
@@ -837,14 +1193,7 @@ def psrn_multiply_by_fraction(rg, psrn1, fraction, digits=2):
             rvsmall = Fraction(rv, ddc)
             rvlarge = Fraction(rv + 1, ddc)
             if rvsmall >= small and rvlarge < large:
-                cpsrn = [1, 0, [0 for i in range(dcount)]]
-                cpsrn[0] = psrn1[0] * fracsign
-                sret = rv
-                for i in range(dcount):
-                    cpsrn[2][dcount - 1 - i] = sret % digits
-                    sret //= digits
-                cpsrn[1] = sret
-                return cpsrn
+                return _psrn_fromint(sign1 * fracsign, rv, dcount, digits, packed)
             elif rvsmall > large or rvlarge < small:
                 break
             else:
@@ -860,30 +1209,43 @@ def psrn_add(rg, psrn1, psrn2, digits=2):
     psrn2: List containing the sign, integer part, and fractional part
         of the second PSRN.
     digits: Digit base of PSRNs' digits.  Default is 2, or binary."""
-    if psrn1[0] == None or psrn1[1] == None or psrn2[0] == None or psrn2[1] == None:
-        raise ValueError
-    for i in range(len(psrn1[2])):
-        psrn1[2][i] = rg.rndint(digits - 1) if psrn1[2][i] == None else psrn1[2][i]
-    for i in range(len(psrn2[2])):
-        psrn2[2][i] = rg.rndint(digits - 1) if psrn2[2][i] == None else psrn2[2][i]
-    while len(psrn1[2]) < len(psrn2[2]):
-        psrn1[2].append(rg.rndint(digits - 1))
-    while len(psrn1[2]) > len(psrn2[2]):
-        psrn2[2].append(rg.rndint(digits - 1))
-    digitcount = len(psrn1[2])
-    if len(psrn2[2]) != digitcount:
-        raise ValueError
-    # Perform addition
-    frac1 = psrn1[1]
-    frac2 = psrn2[1]
-    for i in range(digitcount):
-        frac1 = frac1 * digits + psrn1[2][i]
-    for i in range(digitcount):
-        frac2 = frac2 * digits + psrn2[2][i]
-    small = frac1 * psrn1[0] + frac2 * psrn2[0]
-    mid1 = frac1 * psrn1[0] + (frac2 + 1) * psrn2[0]
-    mid2 = (frac1 + 1) * psrn1[0] + frac2 * psrn2[0]
-    large = (frac1 + 1) * psrn1[0] + (frac2 + 1) * psrn2[0]
+    packed = digits == 2 and _psrn_ispacked(psrn1, psrn2)
+    if packed:
+        orig = [psrn1, psrn2]
+        psrn1, psrn2 = _psrn_pack(psrn1, psrn2)
+        digitcount = _psrn_align(rg, psrn1, psrn2)
+        _psrn_unpack(orig, [psrn1, psrn2])
+        frac1 = psrn1.fraction_int()
+        frac2 = psrn2.fraction_int()
+        sign1 = psrn1.sign
+        sign2 = psrn2.sign
+    else:
+        if psrn1[0] == None or psrn1[1] == None or psrn2[0] == None or psrn2[1] == None:
+            raise ValueError
+        for i in range(len(psrn1[2])):
+            psrn1[2][i] = rg.rndint(digits - 1) if psrn1[2][i] == None else psrn1[2][i]
+        for i in range(len(psrn2[2])):
+            psrn2[2][i] = rg.rndint(digits - 1) if psrn2[2][i] == None else psrn2[2][i]
+        while len(psrn1[2]) < len(psrn2[2]):
+            psrn1[2].append(rg.rndint(digits - 1))
+        while len(psrn1[2]) > len(psrn2[2]):
+            psrn2[2].append(rg.rndint(digits - 1))
+        digitcount = len(psrn1[2])
+        if len(psrn2[2]) != digitcount:
+            raise ValueError
+        # Perform addition
+        frac1 = psrn1[1]
+        frac2 = psrn2[1]
+        for i in range(digitcount):
+            frac1 = frac1 * digits + psrn1[2][i]
+        for i in range(digitcount):
+            frac2 = frac2 * digits + psrn2[2][i]
+        sign1 = psrn1[0]
+        sign2 = psrn2[0]
+    small = frac1 * sign1 + frac2 * sign2
+    mid1 = frac1 * sign1 + (frac2 + 1) * sign2
+    mid2 = (frac1 + 1) * sign1 + frac2 * sign2
+    large = (frac1 + 1) * sign1 + (frac2 + 1) * sign2
     minv = min(small, mid1, mid2, large)
     maxv = max(small, mid1, mid2, large)
     # Difference is expected to be a multiple of two
@@ -910,16 +1272,9 @@ def psrn_add(rg, psrn1, psrn2, digits=2):
         else:
             # Middle, or uniform, part of sum density
             sret = minv + rv
-            cpsrn = [1, 0, [0 for i in range(digitcount)]]
             if sret < 0:
-                sret += 1
-                cpsrn[0] = -1
-            sret = abs(sret)
-            for i in range(digitcount):
-                cpsrn[2][digitcount - 1 - i] = sret % digits
-                sret //= digits
-            cpsrn[1] = sret
-            return cpsrn
+                return _psrn_fromint(-1, -(sret + 1), digitcount, digits, packed)
+            return _psrn_fromint(1, sret, digitcount, digits, packed)
         if side == 0:  # Left side
             pw = rv
             b = midmin - minv
@@ -933,19 +1288,10 @@ def psrn_add(rg, psrn1, psrn2, digits=2):
             if y < lowerbound:
                 # Success
                 sret = start * (digits ** newdigits) + pw
-                cpsrn = [1, 0, [0 for i in range(digitcount + newdigits)]]
+                dc = digitcount + newdigits
                 if sret < 0:
-                    sret += 1
-                    cpsrn[0] = -1
-                sret = abs(sret)
-                for i in range(digitcount + newdigits):
-                    idx = (digitcount + newdigits) - 1 - i
-                    while idx >= len(cpsrn[2]):
-                        cpsrn[2].append(None)
-                    cpsrn[2][idx] = sret % digits
-                    sret //= digits
-                cpsrn[1] = sret
-                return cpsrn
+                    return _psrn_fromint(-1, -(sret + 1), dc, digits, packed)
+                return _psrn_fromint(1, sret, dc, digits, packed)
             elif y > lowerbound + 1:  # Greater than upper bound
                 # Rejected
                 break
@@ -955,7 +1301,12 @@ def psrn_add(rg, psrn1, psrn2, digits=2):
             newdigits += 1
 
 def psrn_add_fraction(rg, psrn, fraction, digits=2):
-    if psrn[0] == None or psrn[1] == None:
+    packed = digits == 2 and isinstance(psrn, PSRN)
+    if packed:
+        sign1, ipart1, length1 = psrn.sign, psrn.ipart, psrn.length
+    else:
+        sign1, ipart1, length1 = psrn[0], psrn[1], len(psrn[2])
+    if sign1 == None or ipart1 == None:
         raise ValueError
     fraction = Fraction(fraction)
     fracsign = -1 if fraction < 0 else 1
@@ -964,44 +1315,31 @@ def psrn_add_fraction(rg, psrn, fraction, digits=2):
     isinteger = absfrac.denominator == 1
     # Special cases
     # positive+pos. integer or negative+neg. integer
-    if ((fracsign < 0) == (psrn[0] < 0)) and isinteger and len(psrn[2]) == 0:
-        return [fracsign, psrn[1] + int(absfrac), []]
+    if ((fracsign < 0) == (sign1 < 0)) and isinteger and length1 == 0:
+        return _psrn_fromint(fracsign, ipart1 + int(absfrac), 0, digits, packed)
     # PSRN has no fractional part, fraction is integer
-    if (
-        isinteger
-        and psrn[0] == 1
-        and psrn[1] == 0
-        and len(psrn[2]) == 0
-        and fracsign < 0
-    ):
-        return [fracsign, int(absfrac) - 1, []]
-    if (
-        isinteger
-        and psrn[0] == 1
-        and psrn[1] == 0
-        and len(psrn[2]) == 0
-        and fracsign > 0
-    ):
-        return [fracsign, int(absfrac), []]
+    if isinteger and sign1 == 1 and ipart1 == 0 and length1 == 0 and fracsign < 0:
+        return _psrn_fromint(fracsign, int(absfrac) - 1, 0, digits, packed)
+    if isinteger and sign1 == 1 and ipart1 == 0 and length1 == 0 and fracsign > 0:
+        return _psrn_fromint(fracsign, int(absfrac), 0, digits, packed)
     if fraction == 0:  # Special case of 0
-        return [psrn[0], psrn[1], [x for x in psrn[2]]]
+        return psrn.copy() if packed else [psrn[0], psrn[1], [x for x in psrn[2]]]
     # End special cases
-    for i in range(len(psrn[2])):
-        psrn[2][i] = rg.rndint(digits - 1) if psrn[2][i] == None else psrn[2][i]
-    digitcount = len(psrn[2])
-    # Perform addition
-    frac1 = psrn[1]
-    frac2 = int(absfrac)
-    fraction = absfrac - frac2
-    for i in range(digitcount):
-        frac1 = frac1 * digits + psrn[2][i]
-    for i in range(digitcount):
-        digit = int(fraction * digits)
-        fraction = (fraction * digits) - digit
-        frac2 = frac2 * digits + digit
+    if packed:
+        psrn.fill(rg)
+        digitcount = psrn.length
+        frac1 = psrn.fraction_int()
+    else:
+        for i in range(len(psrn[2])):
+            psrn[2][i] = rg.rndint(digits - 1) if psrn[2][i] == None else psrn[2][i]
+        digitcount = len(psrn[2])
+        # Perform addition
+        frac1 = psrn[1]
+        for i in range(digitcount):
+            frac1 = frac1 * digits + psrn[2][i]
     ddc = digits ** digitcount
-    small = Fraction(frac1 * psrn[0], ddc) + origfrac
-    large = Fraction((frac1 + 1) * psrn[0], ddc) + origfrac
+    small = Fraction(frac1 * sign1, ddc) + origfrac
+    large = Fraction((frac1 + 1) * sign1, ddc) + origfrac
     minv = min(small, large)
     maxv = max(small, large)
     while True:
@@ -1020,18 +1358,10 @@ def psrn_add_fraction(rg, psrn, fraction, digits=2):
             rvstartbound = mind if minv < 0 else mind + 1
             rvendbound = maxd - 1 if maxv < 0 else maxd
             if rvs > rvstartbound and rvs < rvendbound:
-                sret = rvs
-                cpsrn = [1, 0, [0 for i in range(digitcount + newdigits)]]
-                if sret < 0:
-                    sret += 1
-                    cpsrn[0] = -1
-                sret = abs(sret)
-                for i in range(digitcount + newdigits):
-                    idx = (digitcount + newdigits) - 1 - i
-                    cpsrn[2][idx] = sret % digits
-                    sret //= digits
-                cpsrn[1] = sret
-                return cpsrn
+                dc = digitcount + newdigits
+                if rvs < 0:
+                    return _psrn_fromint(-1, -(rvs + 1), dc, digits, packed)
+                return _psrn_fromint(1, rvs, dc, digits, packed)
             elif rvs <= rvstartbound:
                 rvd = Fraction(rvs + 1, ddc)
                 if rvd <= minv:
@@ -1081,7 +1411,7 @@ def psrnexpo(rg):
 
 ###################
 
-def geobagcompare(bag, f):
+def geobagcompare(bag, f, rg=None):
     """Returns 1 with probability f(U), where U is the value that
       the given geometric bag turns out to hold, or 0 otherwise.
       This method samples bits from the geometric bag as necessary.
@@ -1089,7 +1419,8 @@ def geobagcompare(bag, f):
        that holds a list of bits from left to
        right starting with the bit immediately after the binary point.
        An item can contain the value None, which indicates an
-       unsampled bit.
+       unsampled bit.  Can also be a PSRN, whose digits after the
+       point are used.
     - f: Function to run, which takes one parameter, namely a 'float'.
       Currently, this method assumes f is strictly increasing or strictly decreasing.
       Note that this may suffer rounding and other approximation
@@ -1099,7 +1430,20 @@ def geobagcompare(bag, f):
       here, and would probably have the function use arbitrary-precision
       rational or floating-point numbers rather than the fixed-precision
       'float' type of Python, which usually has 53 bits of precision.
+    - rg: Object with a 'randbit' method, such as a RandomGen or
+      Bernoulli object, that supplies the random bits.  If None, a new
+      RandomGen is used.
     """
+    if rg == None:
+        rg = randomgen.RandomGen()
+    if isinstance(bag, PSRN):
+        digits = bag.tolist()[2]
+        ret = geobagcompare(digits, f, rg)
+        p = PSRN.fromlist([bag.sign, bag.ipart, digits])
+        bag.bits = p.bits
+        bag.length = p.length
+        bag.unset = p.unset
+        return ret
     k = 1
     v = 0
     prec = 1 << k
@@ -1151,7 +1495,18 @@ def geobagcompare(bag, f):
             iprec = 1 << i
 
 def _bern_power(bern, bag, num, den, bagfactory):
-    if len(bag) >= 4 and bag[0] == 0 and bag[1] == 0 and bag[2] == 0 and bag[3] == 0:
+    if isinstance(bag, PSRN):
+        # First four digits sampled and zero
+        small = bag.length >= 4 and (bag.bits | bag.unset) >> (bag.length - 4) == 0
+    else:
+        small = (
+            len(bag) >= 4
+            and bag[0] == 0
+            and bag[1] == 0
+            and bag[2] == 0
+            and bag[3] == 0
+        )
+    if small:
         # If the geometric bag is known to hold a very small number, use
         # a different approach than the power Bernoulli factory, which converges
         # very slowly as the input number approaches 0, when num/den
@@ -1159,12 +1514,13 @@ def _bern_power(bern, bag, num, den, bagfactory):
         # NOTE: Calculating "**(num/den)" requires floating-point arithmetic,
         # and so does geobagcompare, at the moment.
         # This is only a performance optimization.
-        return geobagcompare(bag, lambda x: x ** (num / den))
+        return geobagcompare(bag, lambda x: x ** (num / den), bern)
     else:
         return bern.power(bagfactory, num, den)
 
 def _power_of_uniform_greaterthan1(bern, power, complement=False, precision=53):
     return psrn_fill(
+        bern,
         _power_of_uniform_greaterthan1_geobag(bern, power, complement),
         precision=precision,
     )
@@ -1191,22 +1547,21 @@ def _power_of_uniform_greaterthan1_geobag(bern, power, complement=False):
     # affect the correctness of this algorithm.
     probx = (2.0 ** (-i - 1)) ** powerrest
     epsdividend = Fraction(probx) * 255 / 256
-    bag = psrn_new_01()
-    gb = lambda: bern.geometric_bag(bag[2])
-    bf = lambda: _bern_power(
-        bern, bag[2], powerrest.numerator, powerrest.denominator, gb
-    )
+    # Geometric bag, packed
+    bag = PSRN()
+    gb = lambda: bern.geometric_bag(bag)
+    bf = lambda: _bern_power(bern, bag, powerrest.numerator, powerrest.denominator, gb)
     # print(i)
     while True:
-        # Limit sampling to the chosen interval
-        bag[2].clear()
-        for k in range(i - 1):
-            bag[2].append(0)
-        bag[2].append(1)
+        # Limit sampling to the chosen interval: i-1 zeros, then a one
+        bag.bits = 1
+        bag.length = i
+        bag.unset = 0
         # Simulate epsdividend / x**(1-1/power)
         if bern.eps_div(bf, epsdividend) == 1:
             # Flip all bits if complement is true
-            return psrn_complement(bag) if complement else bag
+            ret = bag.tolist()
+            return psrn_complement(ret) if complement else ret
 
 def powerOfUniform(b, px, py, precision=53):
     """Generates a power of a uniform random number.
@@ -1219,10 +1574,136 @@ def powerOfUniform(b, px, py, precision=53):
     # is in (0, 1].
     return betadist(b, py, px, 1, 1, precision)
 
-def betadist(b, ax=1, ay=1, bx=1, by=1, precision=53):
-    return psrn_fill(betadist_geobag(b, ax, ay, bx, by), precision=precision)
+def betadist(b, ax=1, ay=1, bx=1, by=1, precision=53, table=None):
+    tab = _betatable(ax, ay, bx, by, table)
+    if tab != None:
+        return tab.sample(b, precision)
+    return psrn_fill(b, betadist_geobag(b, ax, ay, bx, by), precision=precision)
+
+class BetaTable:
+    """Table for sampling from the beta(a, b) distribution, with a and
+    b both 1 or greater, that resolves most variates with one lookup and
+    a few random bits.  [0, 1] is split into 2^depth equal cells; a cell
+    is chosen with probability proportional to an integer upper bound of
+    the beta density x^(a-1)*(1-x)^(b-1) on that cell, and a uniform
+    number in the cell is accepted with probability equal to the density
+    divided by that bound.  The acceptance test compares a uniform PSRN
+    with rational lower and upper bounds of that probability kept for
+    each cell, and only if the PSRN falls between them is the test
+    finished with exact Real arithmetic, so the variates are exactly
+    beta-distributed.  Tables keep only integers and Fractions, so they
+    can be pickled and reused.
+    - ax, ay: Numerator and denominator of a.
+    - bx, by: Numerator and denominator of b.
+    - depth: Base-2 logarithm of the number of cells.
+    - precision: Number of bits in the integer bounds.
+    """
+
+    def __init__(self, ax=1, ay=1, bx=1, by=1, depth=8, precision=32):
+        self.a = Fraction(ax, ay)
+        self.b = Fraction(bx, by)
+        if self.a < 1 or self.b < 1:
+            raise ValueError("a and b must be 1 or greater")
+        self.depth = depth
+        self.precision = precision
+        n = 1 << depth
+        # For each cell: upper bound of the density times
+        # 2^precision (at least 2 more than its approximation),
+        # and lower bound of the density times 2^precision
+        self.upper = [0 for i in range(n)]
+        self.lower = [0 for i in range(n)]
+        for j in range(n):
+            x0 = Fraction(j, n)
+            x1 = Fraction(j + 1, n)
+            self.upper[j] = self._bound(x1, x0).ev(precision) + 2
+            self.lower[j] = max(0, self._bound(x0, x1).ev(precision) - 1)
+        self.dice = randomgen.FastLoadedDiceRoller(self.upper)
+
+    def _bound(self, x, y):
+        # The Real number x^(a-1)*(1-y)^(b-1), which is an upper
+        # bound of the density on [y, x] or a lower bound on [x, y]
+        ret = RealFraction(1)
+        if self.a != 1:
+            if x == 0:
+                return RealFraction(0)
+            ret = RealPow(RealFraction(x), self.a - 1)
+        if self.b != 1:
+            if y == 1:
+                return RealFraction(0)
+            ret = ret * RealPow(RealFraction(1 - y), self.b - 1)
+        return ret
+
+    def _accept(self, rg, x, v, w):
+        # Decides exactly whether the uniform PSRN v is less than
+        # the density at the uniform PSRN x times 2^precision/w,
+        # sampling digits of both until their intervals decide it
+        prec = self.precision
+        while True:
+            xl = Fraction(x.bits, 1 << x.length)
+            xh = xl + Fraction(1, 1 << x.length)
+            vl = Fraction(v.bits * w, 1 << (v.length + self.precision))
+            vh = vl + Fraction(w, 1 << (v.length + self.precision))
+            # v*w/2^precision compared with lower and upper bounds
+            # of the density on x's interval
+            if vh <= Fraction(self._bound(xl, xh).ev(prec) - 1, 1 << prec):
+                return True
+            if vl >= Fraction(self._bound(xh, xl).ev(prec) + 1, 1 << prec):
+                return False
+            x.extend(rg, 1)
+            v.fill(rg)
+            v.extend(rg, 1)
+            prec += 2
+
+    def sample_geobag(self, rg):
+        """Generates a beta-distributed random number as a PSRN in list
+        form, like betadist_geobag.
+        - rg: Object with 'randbit' and 'rndint' methods, such as a
+          Bernoulli or RandomGen object."""
+        return self._sample(rg).tolist()
+
+    def _sample(self, rg):
+        # Same as sample_geobag, but returns a PSRN object
+        depth = self.depth
+        while True:
+            j = self.dice.next(rg)
+            w = self.upper[j]
+            v = PSRN()
+            if v.less_fraction(rg, self.lower[j], w) == 1:
+                x = PSRN(1, 0, j, depth)
+            elif v.less_fraction(rg, w - 1, w) == 0:
+                continue
+            else:
+                x = PSRN(1, 0, j, depth)
+                if not self._accept(rg, x, v, w):
+                    continue
+            return x
+
+    def sample(self, rg, precision=53):
+        """ Generates a beta-distributed random number with the given number of bits after the point. """
+        return psrn_fill(rg, self._sample(rg), precision=precision)
+
+# BetaTable objects built by betadist_geobag, keyed by (a, b)
+_betatables = {}
+
+def _betatable(ax, ay, bx, by, table):
+    # The BetaTable to use for the given 'table' argument of
+    # betadist_geobag, or None if none is to be used
+    if table == None or table is False:
+        return None
+    afrac = Fraction(ax, ay)
+    bfrac = Fraction(bx, by)
+    if isinstance(table, BetaTable):
+        if table.a != afrac or table.b != bfrac:
+            raise ValueError("table is for different shape parameters")
+        return table
+    if afrac < 1 or bfrac < 1 or (afrac == 1 and bfrac == 1):
+        return None
+    key = (afrac, bfrac)
+    if not key in _betatables:
+        _betatables[key] = BetaTable(ax, ay, bx, by)
+    return _betatables[key]
 
-def betadist_geobag(b, ax=1, ay=1, bx=1, by=1):
+def betadist_geobag(b, ax=1, ay=1, bx=1, by=1, table=None):
     """Generates a beta-distributed random number with arbitrary
      (user-defined) precision.  Currently, this sampler only works if (ax/ay) and
      (bx/by) are both 1 or greater, or if one of these parameters is
@@ -1231,7 +1712,15 @@ def betadist_geobag(b, ax=1, ay=1, bx=1, by=1):
     - ax, ay: Numerator and denominator of first shape parameter.
     - bx, by: Numerator and denominator of second shape parameter.
     - precision: Number of bits after the point that the result will contain.
+    - table: If True, and both shape parameters are 1 or greater, uses a
+      BetaTable for those parameters, built on first use and kept for
+      later calls.  Can also be a BetaTable built (or unpickled) by the
+      caller for the same parameters.  If None (the default), the
+      Bernoulli factory method is used.
     """
+    tab = _betatable(ax, ay, bx, by, table)
+    if tab != None:
+        return tab.sample_geobag(b)
     # Beta distribution for alpha>=1 and beta>=1
     bag = psrn_new_01()
     afrac = Fraction(ax) if ay == 1 else Fraction(ax, ay)
@@ -1262,16 +1751,18 @@ def betadist_geobag(b, ax=1, ay=1, bx=1, by=1):
         arest = afrac - aintpart
         # Generalized rejection method, p. 47
         while True:
-            bag = betadist_geobag(b, aintpart, 1, bintpart, 1)
-            gb = lambda: b.geometric_bag(bag[2])
-            gbcomp = lambda: b.geometric_bag(bag[2]) ^ 1
+            bag = PSRN.fromlist(betadist_geobag(b, aintpart, 1, bintpart, 1))
+            gb = lambda: b.geometric_bag(bag)
+            gbcomp = lambda: b.geometric_bag(bag) ^ 1
             if b.power(gbcomp, brest) == 1 and b.power(gb, arest) == 1:
-                return bag
+                return bag.tolist()
     # Create a "geometric bag" to hold a uniform random
-    # number (U), described by Flajolet et al. 2010
-    gb = lambda: b.geometric_bag(bag[2])
+    # number (U), described by Flajolet et al. 2010,
+    # with its digits packed into a PSRN
+    bag = PSRN()
+    gb = lambda: b.geometric_bag(bag)
     # Complement of "geometric bag"
-    gbcomp = lambda: b.geometric_bag(bag[2]) ^ 1
+    gbcomp = lambda: b.geometric_bag(bag) ^ 1
     bp1 = lambda: (
         1 if b.power(gbcomp, bpower) == 1 and b.power(gb, apower) == 1 else 0
     )
@@ -1279,10 +1770,10 @@ def betadist_geobag(b, ax=1, ay=1, bx=1, by=1):
         # Create a uniform random number (U) bit-by-bit, and
         # accept it with probability U^(a-1)*(1-U)^(b-1), which
         # is the unnormalized PDF of the beta distribution
-        bag[2].clear()
+        bag.clear()
         if bp1() == 1:
             # Accepted
-            return bag
+            return bag.tolist()
 
 #####################
 
@@ -1768,7 +2259,10 @@ def _peres(bits, output):
     _peres(u, output)
     _peres(v, output)
 
-class _BitFetchingRandomGen:
+class _BitFetchingRandomGen(Instrumented):
+    # Takes the same arguments as randomgen.RandomGen, so
+    # that it can share a bitsource.BitSource with other
+    # random generators
     def __init__(self, *args):
         self.rg = randomgen.RandomGen(*args)
         self.fetchedbits = 0
@@ -1780,6 +2274,15 @@ class _BitFetchingRandomGen:
         self.queue = []
         self.recycled = []
 
+    @property
+    def totalbits(self):
+        # Bits handed out, whether fresh or recycled
+        return self.totalfetchedbits
+
+    @totalbits.setter
+    def totalbits(self, value):
+        self.totalfetchedbits = value
+
     def extract(self, bits, output):
         _peres(bits, output)
 
@@ -1989,8 +2492,123 @@ def lah(n, k):
 # application that has its own PRNG that's not
 # shared with other tasks).
 #
+# EVALUATION CACHE:
+#
+# Every Real* node keeps the best approximation its `ev()`
+# calculated so far, and answers `ev(m)` requests for a
+# lower `m` by rounding that approximation (which stays
+# strictly within 1/2^m of the exact result).  In addition,
+# constructing a Real* node with the same class and the
+# same arguments (Real* arguments compared by identity) as
+# a node that is still alive returns that node
+# ("hash-consing"), so that shared subexpressions are
+# evaluated once.  Rand* classes and nodes created with
+# `consistent=True` are not cached this way.  See
+# realCacheStats() and realCacheEnable().
+#
+
+_realcache = {
+    "ev": True,
+    "hashcons": True,
+    "evhits": 0,
+    "evmisses": 0,
+    "nodehits": 0,
+    "nodemisses": 0,
+}
+_realnodes = weakref.WeakValueDictionary()
+
+def realCacheStats():
+    """Returns a dictionary of statistics on the evaluation cache
+    and node sharing of Real* objects: 'evhits' and 'evmisses'
+    (ev() calls answered from a node's best approximation, or not),
+    'nodehits' and 'nodemisses' (Real* constructions that returned
+    an existing node, or not), the hit rates 'evhitrate' and
+    'nodehitrate', and 'nodes' (number of shared nodes alive)."""
+    ret = {k: _realcache[k] for k in ["evhits", "evmisses", "nodehits", "nodemisses"]}
+    evtotal = ret["evhits"] + ret["evmisses"]
+    nodetotal = ret["nodehits"] + ret["nodemisses"]
+    ret["evhitrate"] = ret["evhits"] / evtotal if evtotal > 0 else 0
+    ret["nodehitrate"] = ret["nodehits"] / nodetotal if nodetotal > 0 else 0
+    ret["nodes"] = len(_realnodes)
+    return ret
+
+def realCacheReset():
+    """ Resets the statistics given by realCacheStats(). """
+    for k in ["evhits", "evmisses", "nodehits", "nodemisses"]:
+        _realcache[k] = 0
+
+def realCacheEnable(ev=True, hashcons=True):
+    """Turns on or off the evaluation cache ('ev') and the sharing
+    of structurally identical nodes ('hashcons') for Real* objects.
+    Both are on by default."""
+    _realcache["ev"] = ev
+    _realcache["hashcons"] = hashcons
+
+def _realnodekey(a):
+    return a if isinstance(a, Real) else (type(a), a)
+
+def _cachedev(ev):
+    # Wraps a Real* class's ev() method with the
+    # evaluation cache
+    def cachedev(self, n):
+        if not _realcache["ev"] or getattr(self, "consistent", False):
+            return ev(self, n)
+        bestn = self._evbestn
+        if bestn != None and n <= bestn:
+            _realcache["evhits"] += 1
+            if n == bestn:
+                return self._evbestv
+            # Round to nearest; the result is within 1/2^(bestn-n+1)
+            # plus 1/2 ulp of the exact value, so it's still
+            # strictly within 1 ulp
+            d = bestn - n
+            return (self._evbestv + (1 << (d - 1))) >> d
+        _realcache["evmisses"] += 1
+        ret = ev(self, n)
+        if self._evbestn == None or n > self._evbestn:
+            self._evbestn = n
+            self._evbestv = ret
+        return ret
+
+    return cachedev
+
+class _RealMeta(type):
+    # Metaclass of Real* classes that installs the evaluation
+    # cache and node sharing described above
+    def __init__(cls, name, bases, ns):
+        type.__init__(cls, name, bases, ns)
+        if "ev" in ns and cls._evcache:
+            cls.ev = _cachedev(ns["ev"])
+
+    def __call__(cls, *args, **kwargs):
+        if not (_realcache["hashcons"] and cls._hashcons):
+            return type.__call__(cls, *args, **kwargs)
+        try:
+            key = (
+                cls,
+                tuple(_realnodekey(a) for a in args),
+                tuple(sorted(kwargs.items())),
+            )
+            node = _realnodes.get(key)
+        except TypeError:
+            # Unhashable argument
+            return type.__call__(cls, *args, **kwargs)
+        if node != None:
+            _realcache["nodehits"] += 1
+            return node
+        _realcache["nodemisses"] += 1
+        node = type.__call__(cls, *args, **kwargs)
+        _realnodes[key] = node
+        return node
+
+class Real(metaclass=_RealMeta):
+    # Whether ev() results are cached (see "EVALUATION CACHE" above)
+    _evcache = True
+    # Whether nodes with the same arguments are shared
+    _hashcons = True
+    _evbestn = None
+    _evbestv = 0
 
-class Real:
     def ev(self, n):
         raise NotImplementedError
 
@@ -3115,6 +3733,9 @@ class RandPSRN(Real):
     # Constructive real operation
     # that takes a positive uniform PSRN with base-2
     # fractional digits as input.
+    _evcache = False
+    _hashcons = False
+
     def __init__(self, a):
         self.psrn = a
 
@@ -3142,6 +3763,9 @@ _realbits = 0
 
 class RandUniform(Real):
     # Random uniform real number in the interval (0, 1).
+    _evcache = False
+    _hashcons = False
+
     def __init__(self):
         self.bits = 0
         self.count = 0
@@ -3168,6 +3792,9 @@ class RandUniform(Real):
         return ret
 
 class RealFraction(Real):
+    # Cheap to evaluate
+    _evcache = False
+
     def __init__(self, a, b=None):
         if isinstance(a, Real):
             raise ValueError
@@ -3298,6 +3925,9 @@ class RealFraction(Real):
         return fracEV(self.num, self.den, n)
 
 class RealNegate(Real):
+    # Cheap to evaluate
+    _evcache = False
+
     def __init__(self, a):
         self.a = a if isinstance(a, Real) else RealFraction(a)
 
@@ -3872,6 +4502,129 @@ class RealLn(Real):
                 return cinf
             nv += 4
 
+# Precision schedule and statistics for realIsLess, realIsLessOrEqual,
+# realFloor and realIsNegative.  These functions evaluate their
+# arguments at increasing precisions until the approximations
+# settle the comparison.
+_realcompare = {
+    "schedule": "adaptive",
+    "start": 3,
+    "step": 3,
+    "comparisons": 0,
+    "evaluations": 0,
+    "bits": 0,
+    "maxbits": 0,
+    "lastevaluations": 0,
+    "lastbits": 0,
+}
+
+def realCompareSchedule(schedule="adaptive", start=3, step=3):
+    """Sets how realIsLess, realIsLessOrEqual, realFloor and
+    realIsNegative raise the precision of their approximations.
+    'schedule' is one of the following:
+    - "linear": Add 'step' bits each time (the method used
+      in earlier versions).
+    - "doubling": Double the number of bits each time.
+    - "adaptive": Estimate the number of bits needed from the
+      gap between the two approximations just calculated, and
+      double the number of bits if there is no gap.
+    'start' is the number of bits of the first approximation."""
+    if schedule not in ["linear", "doubling", "adaptive"]:
+        raise ValueError("unknown schedule")
+    if start < 1 or step < 1:
+        raise ValueError
+    _realcompare["schedule"] = schedule
+    _realcompare["start"] = start
+    _realcompare["step"] = step
+
+def realCompareStats():
+    """Returns a dictionary of statistics on comparisons made by
+    realIsLess, realIsLessOrEqual, realFloor and realIsNegative
+    that had to evaluate Real* objects: 'comparisons', 'evaluations'
+    (calls to ev()), 'bits' (sum of the precisions requested
+    in those calls), 'maxbits' (greatest precision requested), and
+    'lastevaluations' and 'lastbits' (the same figures for the last
+    comparison only)."""
+    return dict(
+        (k, _realcompare[k])
+        for k in [
+            "comparisons",
+            "evaluations",
+            "bits",
+            "maxbits",
+            "lastevaluations",
+            "lastbits",
+        ]
+    )
+
+def realCompareReset():
+    """ Resets the statistics given by realCompareStats(). """
+    for k in [
+        "comparisons",
+        "evaluations",
+        "bits",
+        "maxbits",
+        "lastevaluations",
+        "lastbits",
+    ]:
+        _realcompare[k] = 0
+
+def _realcomparestart():
+    _realcompare["comparisons"] += 1
+    _realcompare["lastevaluations"] = 0
+    _realcompare["lastbits"] = 0
+    return _realcompare["start"]
+
+def _realcompareev(a, n):
+    _realcompare["evaluations"] += 1
+    _realcompare["lastevaluations"] += 1
+    _realcompare["bits"] += n
+    _realcompare["lastbits"] += n
+    if n > _realcompare["maxbits"]:
+        _realcompare["maxbits"] = n
+    return a.ev(n)
+
+def _realcomparenext(n, gap=0):
+    # Gets the next precision to try.  'gap' is the difference
+    # between the two approximations at precision 'n'; a decision
+    # needs a difference of at least 2 (at most 3 units of which
+    # can be error), so that a gap with bit length k calls for
+    # about 4 - k more bits.
+    schedule = _realcompare["schedule"]
+    if schedule == "linear":
+        return n + _realcompare["step"]
+    if schedule == "adaptive" and gap > 0:
+        return n + max(1, 4 - gap.bit_length())
+    return n * 2
+
+def _realrational(a):
+    # Numerator and denominator of 'a' if it's a rational
+    # number, or None otherwise
+    if isinstance(a, int):
+        return (a, 1)
+    if isinstance(a, Fraction):
+        return (a.numerator, a.denominator)
+    if isinstance(a, RealFraction):
+        return (a.num, a.den)
+    return None
+
+def _realIsLessRational(a, num, den):
+    # Compares a Real* object 'a' with the rational number num/den.
+    # Returns True if a < num/den and False if a > num/den (as
+    # with realIsLess in general, this doesn't end if they're equal).
+    # The scaled rational number is compared exactly instead of
+    # being approximated.
+    n = _realcomparestart()
+    while True:
+        aa = _realcompareev(a, n)
+        # a is strictly between (aa-1)/2^n and (aa+1)/2^n
+        qn = num << n
+        if (aa + 1) * den <= qn:
+            return True
+        if (aa - 1) * den >= qn:
+            return False
+        n = _realcomparenext(n, abs(aa - qn // den))
+
 def realFloor(a):
     if isinstance(a, RealFraction):
         # NOTE: Python's "//" operator does floor division
@@ -3879,14 +4632,16 @@ def realFloor(a):
     if isinstance(a, Fraction):
         # NOTE: Python's "//" operator does floor division
         return a.numerator // a.denominator
-    n = 2
+    n = _realcomparestart()
     while True:
-        av = a.ev(n)
+        av = _realcompareev(a, n)
         mask = (1 << n) - 1
         avfrac = av & mask
         if avfrac != 0 and avfrac != mask:
             return av // (1 << n)
-        n += 2
+        # The gap between the approximations and the integers
+        # says nothing about the precision needed here
+        n = _realcomparenext(n)
 
 def realCeiling(a):
     if isinstance(a, RealFraction):
@@ -3898,7 +4653,7 @@ def realIsLessOrEqual(a, b):
     a = a if isinstance(a, Real) else RealFraction(a)
     b = b if isinstance(b, Real) else RealFraction(b)
     if isinstance(a, RealFraction) and isinstance(b, RealFraction):
-        return Fraction(a.num, a.den) <= Fraction(b.num, b.den)
+        return a.num * b.den <= b.num * a.den
     return realIsLess(a, b)
 
 def realIsLess(a, b):
@@ -3913,22 +4668,30 @@ def realIsLess(a, b):
     if isinstance(a, Fraction) and isinstance(b, RealFraction):
         return Fraction(b.num, b.den) > a
     if isinstance(a, RealFraction) and isinstance(b, RealFraction):
-        return Fraction(a.num, a.den) < Fraction(b.num, b.den)
+        return a.num * b.den < b.num * a.den
     a = a if isinstance(a, Real) else RealFraction(a)
     b = b if isinstance(b, Real) else RealFraction(b)
-    n = 3
+    # Fast path: compare against a rational number
+    # exactly, evaluating only the other side
+    q = _realrational(b)
+    if q != None:
+        return _realIsLessRational(a, q[0], q[1])
+    q = _realrational(a)
+    if q != None:
+        return not _realIsLessRational(b, q[0], q[1])
+    n = _realcomparestart()
     # print(["a",a])
     # print(["b",b])
     # print([a.disp(),b.disp()])
     while True:
-        aa = a.ev(n)
-        bb = b.ev(n)
+        aa = _realcompareev(a, n)
+        bb = _realcompareev(b, n)
         # print([n,a,b,aa,bb])
         if bb + 2 <= aa:
             return False
         if bb - 2 >= aa:
             return True
-        n += 3
+        n = _realcomparenext(n, abs(aa - bb))
 
 def realIsGreater(a, b):
     return realIsLess(b, a)
@@ -3938,15 +4701,15 @@ def realIsNegative(a):
         return a.isNegative()
     except:
         pass
-    n = 3
+    n = _realcomparestart()
     while True:
-        aa = a.ev(n)
+        aa = _realcompareev(a, n)
         # 'bb' gives a lower bound; hence 1 rather than 2
         if 1 <= aa:
             return False
         if -2 >= aa:
             return True
-        n += 2
+        n = _realcomparenext(n, abs(aa))
 
 class RealSqrt(Real):
     def __init__(self, a):
@@ -4207,6 +4970,9 @@ def realGamma(ml):
     return ret
 
 class RandUniformIntFrac(Real):
+    _evcache = False
+    _hashcons = False
+
     def __init__(self, i, f):
         if i < 0:
             raise ValueError
@@ -4220,6 +4986,9 @@ class RandUniformIntFrac(Real):
         return (self.i << n) + self.f.ev(n)
 
 class RandUniformNegIntFrac(Real):
+    _evcache = False
+    _hashcons = False
+
     def __init__(self, i, f):
         if i < 0:
             raise ValueError
@@ -1,6 +1,10 @@
+import array
+import collections
 import random
 import randomgen
 import math
+import time
+from bitsource import BitSource
 from fractions import Fraction
 from betadist import (
     logbinco,
@@ -13,13 +17,106 @@ from betadist import (
     realIsLess,
 )
 
+# Largest n for which ln(n!) is kept in the log-factorial table
+_LOGFACTABLEMAX = 1 << 20
+
 class BinomialSampler:
-    def __init__(self, rg=None):
-        self.rg = randomgen.RandomGen() if rg == None else rg
+    """Sampler of binomial(n, 1/2) random variates.
+
+    If 'fast' is True (the default), each acceptance test is first
+    decided, where possible, by comparing 53 random bits against
+    floating-point bounds of the acceptance probability, which
+    are widened to cover the floating-point error; only tests that
+    these bounds don't settle use exact Real* arithmetic.  Either
+    way the variates have the exact binomial(n, 1/2) distribution.
+
+    'cachesize' is the maximum number of values of n whose sampling
+    information is kept (least recently used first out), and
+    'tablesize' the maximum number of log binomial coefficients
+    kept for each such n.
+
+    'rg' is a randomgen.RandomGen, or a bitsource.BitSource to share
+    with other random generators; if None, a new RandomGen is used.
+    """
+
+    def __init__(self, rg=None, fast=True, cachesize=16, tablesize=1024):
+        if rg == None or isinstance(rg, BitSource):
+            rg = randomgen.RandomGen(rg)
+        self.rg = rg
         self.logcache = {}
-        self.binomialinfo = {}
-        self.bits = 0
-        self.curbit = -1
+        self.binomialinfo = collections.OrderedDict()
+        self.cachesize = cachesize
+        self.tablesize = tablesize
+        self.fast = fast
+        # logfac[i] is ln(i!), extended as needed
+        self.logfac = array.array("d", [0.0, 0.0])
+        self.floattests = 0
+        self.exacttests = 0
+
+    def _logfactorial(self, n):
+        # Floating-point approximation of ln(n!)
+        if n >= _LOGFACTABLEMAX:
+            return math.lgamma(n + 1)
+        lf = self.logfac
+        while len(lf) <= n:
+            lf.append(math.lgamma(len(lf) + 1))
+        return lf[n]
+
+    def _floatbounds(self, n2, rv, m, k):
+        # Lower and upper bounds of the acceptance probability
+        # exp(logbinco(n2, rv) + ln(m) + ln(2)*(k-n2-2)), or None
+        # if floating-point arithmetic can't be used for them
+        if n2 > (1 << 52):
+            return None
+        r = rv
+        s = n2 - rv
+        if min(r, s) < 64:
+            t1 = self._logfactorial(n2)
+            t2 = self._logfactorial(r)
+            t3 = self._logfactorial(s)
+            t4 = math.log(m)
+            t5 = math.log(2) * (k - n2 - 2)
+            lp = t1 - t2 - t3 + t4 + t5
+            # Generous bound on the error of lgamma, log and the
+            # sums above: 2^8 ulps of each term's magnitude
+            terms = abs(t1) + abs(t2) + abs(t3) + abs(t4) + abs(t5)
+            err = terms * 2.0 ** -44 + 2.0 ** -40
+        else:
+            # Differences of large log factorials lose too much
+            # precision; use Stirling's formula for
+            # ln(n!/(r!*s!)) - n*ln(2) instead, written in terms of
+            # x = (r - s)/n.  Its remainder delta(z) for ln(z!)
+            # satisfies 1/(12z) - 1/(360z^3) < delta(z) < 1/(12z).
+            x = (r - s) / n2
+            t1 = -(n2 / 2) * ((1 + x) * math.log1p(x) + (1 - x) * math.log1p(-x))
+            t2 = 0.5 * math.log(n2 / (2 * math.pi * r * s))
+            t3 = 1 / (12 * n2) - 1 / (12 * r) - 1 / (12 * s)
+            t4 = math.log(m)
+            t5 = math.log(2) * (k - 2)
+            lp = t1 + t2 + t3 + t4 + t5
+            terms = abs(t1) + abs(t2) + abs(t3) + abs(t4) + abs(t5)
+            err = (
+                terms * 2.0 ** -44
+                + (n2 / 2) * abs(x) * 2.0 ** -44
+                + 1 / (360 * n2 ** 3)
+                + 1 / (360 * r ** 3)
+                + 1 / (360 * s ** 3)
+                + 2.0 ** -40
+            )
+        lo = math.exp(lp - err) * (1 - 2.0 ** -50) if lp - err < 700 else 2.0
+        hi = math.exp(lp + err) * (1 + 2.0 ** -50) if lp + err < 700 else 2.0
+        return (lo, hi)
+
+    def _binomialinfo(self, n2):
+        bi = self.binomialinfo.get(n2)
+        if bi == None:
+            bi = [BinomialSampler._roughSqrt(n2), collections.OrderedDict()]
+            self.binomialinfo[n2] = bi
+            while len(self.binomialinfo) > self.cachesize:
+                self.binomialinfo.popitem(last=False)
+        else:
+            self.binomialinfo.move_to_end(n2)
+        return bi
 
     def _logint(self, n):
         if not n in self.logcache:
@@ -27,15 +124,10 @@ class BinomialSampler:
         return self.logcache[n]
 
     def _randbit(self):
-        if self.rg != None:
-            return self.rg.randbit()
-        if self.curbit == -1 or self.curbit >= 64:
-            self.bits = random.randint(0, (1 << 64) - 1)
-            self.curbit = 0
-        r = self.bits & 1
-        self.bits >>= 1
-        self.curbit += 1
-        return r
+        return self.rg.randbit()
+
+    def _randbits(self, n):
+        return self.rg.randbits(n)
 
     def _roughSqrt(x):
         """Returns a number m such that m is in the
@@ -73,34 +165,67 @@ class BinomialSampler:
             n2 -= 1
             if n2 == 0:
                 return ret
-        if not n2 in self.binomialinfo:
-            bm = BinomialSampler._roughSqrt(n2)
-            bi = [bm, {}]
-            self.binomialinfo[n2] = bi
         halfn = n2 // 2
-        m = self.binomialinfo[n2][0]
-        bincos = self.binomialinfo[n2][1]
+        m, bincos = self._binomialinfo(n2)
         while True:
             pos = self._randbit() == 0
             k = 0
             while self._randbit() == 0:
                 k += 1
-            r = k * m + (
-                self.rg.rndint(m - 1) if self.rg != None else random.randint(0, m - 1)
-            )
+            r = k * m + self.rg.rndint(m - 1)
             rv = halfn + r if pos else halfn - r - 1
             if rv >= 0 and rv <= n2:
                 # psrn = psrnexpo(self.rg)
                 # psrn[0] = -1  # Negate
-                if not (rv in bincos):
-                    bincos[rv] = None
-                if bincos[rv] == None:
-                    # Calculate log of acceptance probability on demand
-                    bincos[rv] = (
-                        logbinco(n2, rv)
-                        + self._logint(m)
-                        + self._logint(2) * (k - n2 - 2)
-                    )
-                h = RealLn(RandUniform())
-                if realIsLess(h, bincos[rv]):
+                u = RandUniform()
+                bounds = self._floatbounds(n2, rv, m, k) if self.fast else None
+                if bounds != None:
+                    # Squeeze test: the uniform number lies in
+                    # [ubits/2^53, (ubits+1)/2^53)
+                    ubits = self._randbits(53)
+                    if (ubits + 1) <= bounds[0] * 2.0 ** 53:
+                        self.floattests += 1
+                        return rv
+                    if ubits > bounds[1] * 2.0 ** 53:
+                        self.floattests += 1
+                        continue
+                    u.bits = ubits
+                    u.count = 53
+                self.exacttests += 1
+                lb = bincos.get(rv)
+                if lb == None:
+                    # Calculate log binomial coefficient on demand
+                    lb = logbinco(n2, rv) + self._logint(m)
+                    bincos[rv] = lb
+                    while len(bincos) > self.tablesize:
+                        bincos.popitem(last=False)
+                else:
+                    bincos.move_to_end(rv)
+                # Log of acceptance probability; the term depending on
+                # k is added here since k varies from trial to trial
+                lp = lb + self._logint(2) * (k - n2 - 2)
+                h = RealLn(u)
+                if realIsLess(h, lp):
                     return rv
+
+def bench_binomial(ns=None, count=1000):
+    """Prints binomial(n, 1/2) variates per second, with and
+    without floating-point squeeze tests, for n = 10^3, ..., 10^12."""
+    if ns == None:
+        ns = [10 ** i for i in range(3, 13)]
+    for n in ns:
+        rates = []
+        for fast in [False, True]:
+            bs = BinomialSampler(randomgen.RandomGen(random.Random(n)), fast=fast)
+            c = count if fast else max(1, count // 10)
+            t = time.perf_counter()
+            for i in range(c):
+                bs.sample(n)
+            rates.append(c / (time.perf_counter() - t))
+        print(
+            "n=%-14d exact %10.1f/s  fast %10.1f/s  (%.1fx)"
+            % (n, rates[0], rates[1], rates[1] / rates[0])
+        )
+
+if __name__ == "__main__":
+    bench_binomial()
@@ -0,0 +1,344 @@
+"""
+A source of random bits that can be shared by the random generators
+in this repository (randomgen.RandomGen, bernoulli.Bernoulli,
+binomial.BinomialSampler and betadist._BitFetchingRandomGen), so that
+pipelines that mix them draw from one buffered bitstream.
+
+Written by Peter O.
+Any copyright to this work is released to the Public Domain.
+In case this is not possible, this work is also
+licensed under Creative Commons Zero (CC0):
+https://creativecommons.org/publicdomain/zero/1.0/
+"""
+
+import array
+import math
+import random
+import sys
+from fractions import Fraction
+
+# Number of random bits drawn at once from an
+# RNG that implements getrandbits
+_BITPOOL_BITS = 1 << 16
+
+# Each byte with its bits in reverse order
+_REVBITS = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
+
+_WORDMASK = (1 << 64) - 1
+
+# Position (1 to 8) of the lowest zero bit of each byte, or 0 if all
+# its bits are ones
+_FIRSTZERO = bytes(((~i & 255) & -(~i & 255)).bit_length() for i in range(256))
+
+class FractionDigits:
+    """The first 64 binary digits of the fraction px/py, for deciding
+    BitSource.zero_or_one(px, py) without big-integer arithmetic when
+    the same fraction is used many times.  px and py must be integers
+    with px/py in [0, 1].
+
+    Example:
+
+    >>> third = FractionDigits(1, 3)
+    >>> bits = BitSource()
+    >>> bits.zero_or_one(third)  # Same as bits.zero_or_one(1, 3)
+    """
+
+    def __init__(self, px, py):
+        if py <= 0 or px < 0 or px > py:
+            raise ValueError
+        self.px = px
+        self.py = py
+        if px == py:
+            # Handled separately by BitSource.zero_or_one
+            self.word = 0
+            self.count = 0
+            self.rem = 0
+        else:
+            d, self.rem = divmod(px << 64, py)
+            # The digits, first digit in the least significant bit
+            self.word = int.from_bytes(
+                d.to_bytes(8, "big").translate(_REVBITS), "little"
+            )
+            # Number of digits up to the last nonzero one, if the
+            # expansion ends within these digits, or 64 otherwise
+            self.count = 64 if self.rem != 0 else self.word.bit_length()
+        # For each value of the next 8 random bits, the result (in the
+        # lowest bit) and the number of bits used (in the other bits),
+        # or 0 if those bits don't decide the result
+        table = bytearray(256)
+        for i in range(256):
+            k = _FIRSTZERO[i]
+            if k != 0 and k <= self.count:
+                table[i] = ((self.word >> (k - 1)) & 1) | (k << 1)
+        self.table = bytes(table)
+
+class BitSource:
+    """A buffered source of random bits.  Bits are drawn from an
+    underlying RNG in large blocks and handed out as single bits,
+    n-bit integers or whole 64-bit words, in that order, to every
+    object that shares this source.
+
+    'rng' is the underlying RNG.  It must implement a 'randint(a, b)'
+    method that returns a random integer in the interval [a, b]
+    (where 'a' is always 0), and if it also implements
+    'getrandbits(k)' (as Python's 'random.Random' does), bits are
+    drawn from it 65536 at a time.  If 'rng' is None, a new
+    'random.Random' seeded with 'seed' is used.
+
+    'replay', if given, is a bitstream recorded by 'recording()'
+    (a sequence of 64-bit words or the bytes of such words in
+    little-endian order); the source then hands out those bits
+    and raises ValueError once they run out.
+
+    A BitSource also implements 'randint', 'getrandbits' and 'random',
+    so it can be used wherever a 'random.Random' is expected.
+
+    Example:
+
+    >>> bits = BitSource(seed=1)
+    >>> rg = randomgen.RandomGen(bits)
+    >>> bern = bernoulli.Bernoulli(bits)
+    >>> bits.startrecording()
+    >>> x = [rg.binomial(20, 0.3), bern.zero_or_one(1, 3)]
+    >>> replayed = BitSource(replay=bits.recording())
+    >>> # Same as x
+    >>> [randomgen.RandomGen(replayed).binomial(20, 0.3),
+    ...     bernoulli.Bernoulli(replayed).zero_or_one(1, 3)]
+    """
+
+    def __init__(self, rng=None, seed=None, replay=None):
+        if replay != None:
+            if isinstance(replay, (bytes, bytearray)):
+                words = array.array("Q")
+                words.frombytes(bytes(replay))
+                if sys.byteorder != "little":
+                    words.byteswap()
+                replay = words
+            self._replay = array.array("Q", replay)
+            self._replaypos = 0
+            rng = None
+        else:
+            self._replay = None
+            if rng == None:
+                rng = random.Random(seed)
+        self.rng = rng
+        # Pool of random 64-bit words, and the partly
+        # used word taken from that pool
+        self._pool = []
+        self._poolpos = 0
+        self.bitcount = 0
+        self.curbit = 0
+        self._recorded = None
+
+    def seed(self, seed=None):
+        """Seeds the underlying RNG (which must implement
+        'seed', as 'random.Random' does) and discards any
+        bits buffered so far."""
+        if self._replay != None:
+            raise ValueError("replayed bitstream can't be seeded")
+        self.rng.seed(seed)
+        self._pool = []
+        self._poolpos = 0
+        self.bitcount = 0
+        self.curbit = 0
+
+    def fork(self):
+        """Returns a new BitSource whose bits are independent of
+        this one's, seeded with 256 bits from this source.  The new
+        source's bits depend only on the bits this source has
+        handed out so far, so forking is reproducible under the
+        same seed."""
+        return BitSource(seed=self.randbits(256))
+
+    def startrecording(self):
+        """Starts recording the bits drawn from the underlying RNG,
+        discarding bits buffered so far, so that they can be
+        replayed with BitSource(replay=...)."""
+        self._pool = []
+        self._poolpos = 0
+        self.bitcount = 0
+        self.curbit = 0
+        self._recorded = array.array("Q")
+
+    def recording(self):
+        """Returns the bits recorded since 'startrecording', as the
+        bytes of 64-bit words in little-endian order."""
+        if self._recorded == None:
+            raise ValueError("not recording")
+        words = array.array("Q", self._recorded)
+        if sys.byteorder != "little":
+            words.byteswap()
+        return words.tobytes()
+
+    def _fillpool(self):
+        if self._replay != None:
+            if self._replaypos >= len(self._replay):
+                raise ValueError("replayed bitstream exhausted")
+            pool = self._replay[self._replaypos : self._replaypos + 1024]
+            self._replaypos += len(pool)
+        else:
+            if hasattr(self.rng, "getrandbits"):
+                bits = _BITPOOL_BITS
+                block = self.rng.getrandbits(bits)
+            else:
+                # The RNG may itself be built on a bit source
+                # (see betadist._RGConv), so draw only one word
+                # at a time from it
+                bits = 64
+                block = self.rng.randint(0, (1 << bits) - 1)
+            pool = array.array("Q")
+            pool.frombytes(block.to_bytes(bits // 8, "little"))
+            if sys.byteorder != "little":
+                pool.byteswap()
+        if self._recorded != None:
+            self._recorded.extend(pool)
+        self._pool = pool
+        self._poolpos = 0
+
+    def nextword(self):
+        """ Generates a random 64-bit integer. """
+        if self._poolpos >= len(self._pool):
+            self._fillpool()
+        ret = self._pool[self._poolpos]
+        self._poolpos += 1
+        return ret
+
+    def words(self, count):
+        """ Generates 'count' random 64-bit integers, as an array.array('Q'). """
+        ret = array.array("Q")
+        while len(ret) < count:
+            if self._poolpos >= len(self._pool):
+                self._fillpool()
+            take = min(count - len(ret), len(self._pool) - self._poolpos)
+            ret.extend(self._pool[self._poolpos : self._poolpos + take])
+            self._poolpos += take
+        return ret
+
+    def randbit(self):
+        """ Generates a random bit that is 1 or 0 with equal probability. """
+        if self.bitcount == 0:
+            self.curbit = self.nextword()
+            self.bitcount = 64
+        ret = self.curbit & 1
+        self.curbit >>= 1
+        self.bitcount -= 1
+        return ret
+
+    def randbits(self, n):
+        """ Generates an n-bit random integer. """
+        if n < 0:
+            raise ValueError("n less than 0")
+        bc = self.bitcount
+        cb = self.curbit
+        while bc < n:
+            cb |= self.nextword() << bc
+            bc += 64
+        self.curbit = cb >> n
+        self.bitcount = bc - n
+        return cb & ((1 << n) - 1)
+
+    def getrandbits(self, k):
+        return self.randbits(k)
+
+    def randint(self, a, b):
+        # Lumbroso's fast dice roller method, drawing
+        # several bits at a time
+        if a > b:
+            raise ValueError("a greater than b")
+        maxInclusive = b - a
+        if maxInclusive & (maxInclusive + 1) == 0:
+            return a + self.randbits(maxInclusive.bit_length())
+        m = maxInclusive + 1
+        x = 1
+        y = 0
+        while True:
+            k = (maxInclusive // x).bit_length()
+            x <<= k
+            y = (y << k) | self.randbits(k)
+            q = x // m
+            if y < q * m:
+                return a + y % m
+            x -= q * m
+            y -= q * m
+
+    def zero_or_one(self, px, py=None):
+        """Returns 1 at probability px/py, 0 otherwise.  'px' can
+        instead be a FractionDigits, with 'py' omitted.  Draws random bits
+        until the first zero bit, and returns the binary digit of px/py
+        in the same position (or 0 past the expansion's end).  Up to 64
+        random bits are examined at once, but only the bits up to the
+        first zero are used, so that the result and the bits used are the
+        same as drawing one bit at a time (2 bits on average)."""
+        return self._zero_or_one(px, py)[0]
+
+    def _zero_or_one(self, px, py):
+        # Same as zero_or_one, but returns a pair of the result
+        # and the number of random bits used
+        used = 0
+        if py == None:
+            digits = px
+            if digits.px == digits.py:
+                return (1, 0)
+            bc = self.bitcount
+            cb = self.curbit
+            if bc < 64:
+                cb |= self.nextword() << bc
+                bc += 64
+            zeros = ~cb & _WORDMASK
+            n = digits.count
+            if zeros != 0:
+                k = (zeros & -zeros).bit_length()
+                if k <= n:
+                    self.curbit = cb >> k
+                    self.bitcount = bc - k
+                    return ((digits.word >> (k - 1)) & 1, k)
+            self.curbit = cb >> n
+            self.bitcount = bc - n
+            if n < 64 or digits.rem == 0:
+                return (0, n)
+            # 64 ones in a row; continue with the rest of the expansion
+            used = 64
+            px = digits.rem
+            py = digits.py
+        else:
+            if py <= 0:
+                raise ValueError
+            if px >= py:
+                return (1, 0)
+            if px <= 0:
+                return (0, 0)
+            if not (isinstance(px, int) and isinstance(py, int)):
+                f = Fraction(px) / Fraction(py)
+                px = f.numerator
+                py = f.denominator
+        while True:
+            bc = self.bitcount
+            cb = self.curbit
+            if bc < 64:
+                cb |= self.nextword() << bc
+                bc += 64
+            # Position of the first zero bit, or 65 if there
+            # is none among the next 64 bits
+            zeros = ~cb & _WORDMASK
+            k = (zeros & -zeros).bit_length() if zeros != 0 else 65
+            # Remainder after the first k-1 digits
+            r = (px << (k - 1)) % py
+            if r == 0:
+                # The expansion ends after t < k digits, so
+                # only t bits (all ones) are used
+                t = (py // math.gcd(px, py)).bit_length() - 1
+                self.curbit = cb >> t
+                self.bitcount = bc - t
+                return (0, used + t)
+            if k <= 64:
+                self.curbit = cb >> k
+                self.bitcount = bc - k
+                return (1 if (r << 1) >= py else 0, used + k)
+            self.curbit = cb >> 64
+            self.bitcount = bc - 64
+            used += 64
+            px = r
+
+    def random(self):
+        """ Generates a random number in [0, 1) with 53 random bits. """
+        return self.randbits(53) / (1 << 53)
@@ -1,6 +1,11 @@
 import decimal as dec
 import math
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Fixed:
     """
     Fixed-point numbers, represented using integers that store multiples
@@ -751,6 +756,402 @@ class Fixed:
         avr = Fixed._expinternal(ava, avneg, 0)
         return Fixed(avr)
 
+    # Batch evaluation.  The _n methods below take a sequence of Fixed
+    # numbers or raw integers (the 'value' of a Fixed number, that is,
+    # multiples of 2^-BITS) and return a list of Fixed numbers, or of
+    # raw integers if 'raw' is True, with the same values as the
+    # corresponding method called on each number in turn.  If NumPy is
+    # available, the CORDIC iterations are run across all the numbers at
+    # once on int64 arrays; numbers whose intermediate results might not
+    # fit in 64 bits (or that take a special path, such as the
+    # high-resolution tangent) are evaluated one at a time as before.
+
+    @staticmethod
+    def _raw(values):
+        return [x.value if x.__class__ == Fixed else int(x) for x in values]
+
+    @staticmethod
+    def _batch(cols, limits, vecfunc, scalarfunc, raw):
+        # Evaluates a function over columns of raw values: 'vecfunc'
+        # on int64 arrays of the rows whose values are within 'limits'
+        # (returning an array of results and a boolean array marking
+        # results it didn't compute, or None), and 'scalarfunc' on
+        # the remaining rows
+        n = len(cols[0])
+        for c in cols:
+            if len(c) != n:
+                raise ValueError("sequences differ in length")
+        if numpy == None or n == 0:
+            ret = [scalarfunc(*row) for row in zip(*cols)]
+            return ret if raw else [Fixed(v) for v in ret]
+        try:
+            arrs = [numpy.array(c, dtype=numpy.int64) for c in cols]
+        except OverflowError:
+            # Some values don't fit in 64 bits
+            arrs = [
+                numpy.array(
+                    [x if lo <= x <= hi else 0 for x in c], dtype=numpy.int64
+                )
+                for c, (lo, hi) in zip(cols, limits)
+            ]
+            big = [
+                numpy.array([not (lo <= x <= hi) for x in c], dtype=bool)
+                for c, (lo, hi) in zip(cols, limits)
+            ]
+        else:
+            big = [(a < lo) | (a > hi) for a, (lo, hi) in zip(arrs, limits)]
+        ok = ~numpy.logical_or.reduce(big)
+        idx = numpy.flatnonzero(ok)
+        out = numpy.zeros(n, dtype=numpy.int64)
+        if len(idx) > 0:
+            vals, bad = vecfunc(*[a[idx] for a in arrs])
+            out[idx] = vals
+            if bad is not None:
+                ok[idx[bad]] = False
+        ret = out.tolist()
+        for i in numpy.flatnonzero(~ok).tolist():
+            ret[i] = scalarfunc(*[c[i] for c in cols])
+        return ret if raw else [Fixed(v) for v in ret]
+
+    @staticmethod
+    def _roundedshiftraw_np(a, shift):
+        aa = numpy.abs(a)
+        ret = aa >> shift
+        frac = aa & ((1 << shift) - 1)
+        half = 1 << (shift - 1)
+        ret += (frac > half) | ((frac == half) & ((ret & 1) == 1))
+        return numpy.where(a < 0, -ret, ret)
+
+    @staticmethod
+    def _divbits_np(av, bv, outputFracBits):
+        # Same as _divbits; 'bv' must not contain zeros
+        ava = numpy.abs(av)
+        bva = numpy.abs(bv)
+        ret = ava << outputFracBits
+        frac = ret % bva
+        ret = ret // bva
+        h = bva >> 1
+        ret += numpy.where(
+            (bva & 1) == 0, (frac > h) | ((frac == h) & ((ret & 1) == 1)), frac > h
+        )
+        return numpy.where((av >= 0) != (bv >= 0), -ret, ret)
+
+    @staticmethod
+    def _mul_np(av, bv):
+        ret = numpy.abs(av) * numpy.abs(bv)
+        frac = ret & Fixed.MASK
+        ret >>= Fixed.BITS
+        ret += (frac > Fixed.HALF) | ((frac == Fixed.HALF) & ((ret & 1) == 1))
+        return numpy.where((av >= 0) != (bv >= 0), -ret, ret)
+
+    @staticmethod
+    def _sincos_np(ra):
+        # Same as _sincos, except for zeros
+        negra = ra < 0
+        ra = numpy.abs(ra) % Fixed.TwoTimesPiArcTanBits
+        pi15 = Fixed.PiArcTanBits + Fixed.HalfPiArcTanBits
+        negateCos = (ra >= Fixed.HalfPiArcTanBits) & (ra < pi15)
+        ra = numpy.where(negateCos, Fixed.PiArcTanBits - ra, ra)
+        m = ra >= pi15
+        negateSin = numpy.where(m, ~negra, negra)
+        ra = numpy.where(m, Fixed.TwoTimesPiArcTanBits - ra, ra)
+        ry = numpy.zeros_like(ra)
+        rx = numpy.full_like(ra, Fixed.SinCosK)
+        rz = ra
+        for i in range(len(Fixed.ArcTanTable)):
+            x = rx >> i
+            y = ry >> i
+            m = rz >= 0
+            rx = numpy.where(m, rx - y, rx + y)
+            ry = numpy.where(m, ry + x, ry - x)
+            rz = numpy.where(m, rz - Fixed.ArcTanTable[i], rz + Fixed.ArcTanTable[i])
+        return [numpy.where(negateSin, -ry, ry), numpy.where(negateCos, -rx, rx)]
+
+    @staticmethod
+    def _sin_np(ra):
+        ret = Fixed._sincos_np(ra << Fixed.ArcTanBitDiff)[0]
+        ret = Fixed._roundedshiftraw_np(ret, Fixed.ArcTanBitDiff)
+        return numpy.where(ra == 0, 0, ret), None
+
+    @staticmethod
+    def _cos_np(ra):
+        ret = Fixed._sincos_np(ra << Fixed.ArcTanBitDiff)[1]
+        ret = Fixed._roundedshiftraw_np(ret, Fixed.ArcTanBitDiff)
+        return numpy.where(ra == 0, 1 << Fixed.BITS, ret), None
+
+    @staticmethod
+    def _tan_np(ra):
+        sc = Fixed._sincos_np(ra << Fixed.ArcTanBitDiff)
+        zero = sc[1] == 0
+        ret = Fixed._divbits_np(sc[0], numpy.where(zero, 1, sc[1]), Fixed.BITS)
+        # High tangent values take the high-resolution path
+        bad = (ra != 0) & (zero | ((numpy.abs(ret) >> Fixed.BITS) > 5))
+        return numpy.where(ra == 0, 0, ret), bad
+
+    @staticmethod
+    def _atan2_np(ry, rx):
+        xneg = rx < 0
+        yneg = ry < 0
+        x0 = rx
+        y0 = ry
+        rx = numpy.abs(rx) << Fixed.ArcTanBitDiff
+        ry = numpy.abs(ry) << Fixed.ArcTanBitDiff
+        rz = numpy.zeros_like(rx)
+        for i in range(len(Fixed.ArcTanTable)):
+            x = rx >> i
+            y = ry >> i
+            m = ry <= 0
+            rx = numpy.where(m, rx - y, rx + y)
+            ry = numpy.where(m, ry + x, ry - x)
+            rz = numpy.where(m, rz - Fixed.ArcTanTable[i], rz + Fixed.ArcTanTable[i])
+        rz = numpy.where(yneg != xneg, -rz, rz)
+        rz = numpy.where(xneg & yneg, rz - Fixed.PiArcTanBits, rz)
+        rz = numpy.where(xneg & ~yneg, rz + Fixed.PiArcTanBits, rz)
+        ret = Fixed._roundedshiftraw_np(rz, Fixed.ArcTanBitDiff)
+        ret = numpy.where(x0 == 0, numpy.where(y0 >= 0, Fixed.HalfPiBits, -Fixed.HalfPiBits), ret)
+        ret = numpy.where((y0 == 0) & (x0 < 0), Fixed.PiBits, ret)
+        return numpy.where((y0 == 0) & (x0 == 0), 0, ret), None
+
+    @staticmethod
+    def _log_np(av):
+        # Values must be positive
+        k = numpy.zeros_like(av)
+        while True:
+            m = av >= 1 << (Fixed.BITS - 1)
+            if not m.any():
+                break
+            av = numpy.where(m, Fixed._divbits_np(av, 2 << Fixed.BITS, Fixed.BITS), av)
+            k += m
+        while True:
+            m = av < Fixed.LogMin
+            if not m.any():
+                break
+            av = numpy.where(m, av * 2, av)
+            k -= m
+        avx = av << Fixed.ArcTanBitDiff
+        rx = avx + (1 << Fixed.ArcTanFrac)
+        ry = avx - (1 << Fixed.ArcTanFrac)
+        rz = numpy.zeros_like(av)
+        for i in range(1, len(Fixed.ArcTanHTable)):
+            iters = 2 if i == 4 or i == 13 else 1
+            for j in range(iters):
+                x = rx >> i
+                y = ry >> i
+                m = ry <= 0
+                rx = numpy.where(m, rx + y, rx - y)
+                ry = numpy.where(m, ry + x, ry - x)
+                rz = numpy.where(m, rz - Fixed.ArcTanHTable[i], rz + Fixed.ArcTanHTable[i])
+        ret = Fixed._roundedshiftraw_np(rz, Fixed.ArcTanBitDiff - 1)
+        return ret + k * Fixed.Log2Bits, None
+
+    @staticmethod
+    def _exp_np(av):
+        # Values must be less than 20
+        if Fixed.BITS >= 6:
+            low = av < -(Fixed.BITS << Fixed.BITS)
+        else:
+            low = av < -(6 << Fixed.BITS)
+        # The result for those values is 0; leave them out
+        # so that the shift below stays within 64 bits
+        av = numpy.where(low, 0, av)
+        avneg = av < 0
+        ava = numpy.abs(av) << Fixed.ArcTanBitDiff
+        big = numpy.abs(av) > 1 << Fixed.BITS
+        fint = numpy.where(big, ava // Fixed.Ln2ArcTanBits, 0)
+        rx = numpy.full_like(av, Fixed.ExpK)
+        ry = numpy.full_like(av, Fixed.ExpK)
+        rz = ava - fint * Fixed.Ln2ArcTanBits
+        for i in range(1, len(Fixed.ArcTanHTable)):
+            iters = 2 if i == 4 or i == 13 else 1
+            for j in range(iters):
+                x = rx >> i
+                y = ry >> i
+                m = rz >= 0
+                rx = numpy.where(m, rx + y, rx - y)
+                ry = numpy.where(m, ry + x, ry - x)
+                rz = numpy.where(m, rz - Fixed.ArcTanHTable[i], rz + Fixed.ArcTanHTable[i])
+        rx <<= fint
+        recip = Fixed._divbits_np(1 << Fixed.ArcTanFrac, rx, Fixed.ArcTanFrac)
+        rx = numpy.where(avneg, recip, rx)
+        ret = Fixed._roundedshiftraw_np(rx, Fixed.ArcTanBitDiff)
+        ret = numpy.where(av == 0, 1 << Fixed.BITS, ret)
+        return numpy.where(low, 0, ret), None
+
+    @staticmethod
+    def _bitlength_np(a):
+        # Bit length of nonnegative values
+        ret = numpy.zeros_like(a)
+        for s in (32, 16, 8, 4, 2, 1):
+            m = a >= 1 << s
+            ret += numpy.where(m, s, 0)
+            a = numpy.where(m, a >> s, a)
+        return ret + (a > 0)
+
+    @staticmethod
+    def _sqrt_np(av):
+        # Values must be nonnegative and less than 2^33
+        ava = av << Fixed.BITS
+        powerBits = (Fixed._bitlength_np(ava) + 1) // 2
+        sx = numpy.zeros_like(av)
+        sy = numpy.ones_like(av) << powerBits
+        active = numpy.ones(len(av), dtype=bool)
+        guardBits = Fixed.BITS // 2
+        while active.any():
+            sx = numpy.where(active, sy, sx)
+            ny = Fixed._divbits_np(ava, numpy.where(sx == 0, 1, sx), guardBits)
+            ny += sx << guardBits
+            ny = Fixed._roundedshiftraw_np(ny, guardBits + 1)
+            sy = numpy.where(active, ny, sy)
+            active &= sy < sx
+        ret = numpy.where((av == 0) | (av == 1 << Fixed.BITS), av, sx)
+        return ret, None
+
+    # Largest absolute value of a raw integer that the NumPy
+    # paths below accept
+    _NPLIMIT = 1 << 50
+
+    @staticmethod
+    def sin_n(values, raw=False):
+        """ Calculates the sine of each number in a sequence, as with 'sin'. """
+        return Fixed._batch(
+            [Fixed._raw(values)],
+            [(-Fixed._NPLIMIT, Fixed._NPLIMIT)],
+            Fixed._sin_np,
+            lambda v: 0
+            if v == 0
+            else Fixed._roundedshiftraw(
+                Fixed._sincos(Fixed._signedshift(v, Fixed.ArcTanBitDiff))[0],
+                Fixed.ArcTanBitDiff,
+            ),
+            raw,
+        )
+
+    @staticmethod
+    def cos_n(values, raw=False):
+        """ Calculates the cosine of each number in a sequence, as with 'cos'. """
+        return Fixed._batch(
+            [Fixed._raw(values)],
+            [(-Fixed._NPLIMIT, Fixed._NPLIMIT)],
+            Fixed._cos_np,
+            lambda v: 1 << Fixed.BITS
+            if v == 0
+            else Fixed._roundedshiftraw(
+                Fixed._sincos(Fixed._signedshift(v, Fixed.ArcTanBitDiff))[1],
+                Fixed.ArcTanBitDiff,
+            ),
+            raw,
+        )
+
+    @staticmethod
+    def tan_n(values, raw=False):
+        """ Calculates the tangent of each number in a sequence, as with 'tan'. """
+        return Fixed._batch(
+            [Fixed._raw(values)],
+            [(-Fixed._NPLIMIT, Fixed._NPLIMIT)],
+            Fixed._tan_np,
+            lambda v: Fixed._tan(Fixed._signedshift(v, Fixed.ArcTanBitDiff), Fixed.BITS),
+            raw,
+        )
+
+    @staticmethod
+    def atan2_n(ys, xs, raw=False):
+        """Calculates the inverse tangent of each pair of numbers
+        from two sequences, as with 'atan2'."""
+        return Fixed._batch(
+            [Fixed._raw(ys), Fixed._raw(xs)],
+            [(-Fixed._NPLIMIT, Fixed._NPLIMIT)] * 2,
+            Fixed._atan2_np,
+            lambda y, x: Fixed.v(Fixed(y).atan2(Fixed(x))).value,
+            raw,
+        )
+
+    @staticmethod
+    def log_n(values, raw=False):
+        """Calculates the natural logarithm of each number in a
+        sequence, as with 'log'."""
+        return Fixed._batch(
+            [Fixed._raw(values)],
+            [(1, Fixed._NPLIMIT >> Fixed.BITS)],
+            Fixed._log_np,
+            lambda v: Fixed(v).log().value,
+            raw,
+        )
+
+    @staticmethod
+    def exp_n(values, raw=False):
+        """ Calculates e raised to the power of each number in a sequence, as with 'exp'. """
+        return Fixed._batch(
+            [Fixed._raw(values)],
+            [(-Fixed._NPLIMIT, (20 << Fixed.BITS) - 1)],
+            Fixed._exp_np,
+            lambda v: Fixed(v).exp().value,
+            raw,
+        )
+
+    @staticmethod
+    def sqrt_n(values, raw=False):
+        """ Calculates the square root of each number in a sequence, as with 'sqrt'. """
+        return Fixed._batch(
+            [Fixed._raw(values)],
+            [(0, (1 << 33) - 1)],
+            Fixed._sqrt_np,
+            lambda v: Fixed(v).sqrt().value,
+            raw,
+        )
+
+    @staticmethod
+    def pow_n(values, exponents, raw=False):
+        """Raises each number in a sequence to a power, as with 'pow'.
+        'exponents' is either one exponent for all the numbers or a
+        sequence of exponents, one for each number."""
+        av = Fixed._raw(values)
+        if isinstance(exponents, (list, tuple)) or hasattr(exponents, "__array__"):
+            bv = Fixed._raw(exponents)
+            if len(bv) != len(av):
+                raise ValueError("sequences differ in length")
+        else:
+            bv = [Fixed.v(exponents).value] * len(av)
+        one = 1 << Fixed.BITS
+        ret = [None] * len(av)
+        # Square roots, and powers found from the logarithm (non-integer
+        # powers less than 1 of positive numbers); the rest, including
+        # the error cases, are calculated one at a time
+        roots = []
+        logs = []
+        for i in range(len(av)):
+            a = av[i]
+            b = bv[i]
+            if b == 0:
+                ret[i] = one
+            elif a == 0 or a == one:
+                if a == 0 and b < 0:
+                    raise ValueError
+                ret[i] = a
+            elif b == Fixed.HALF and a > 0:
+                roots.append(i)
+            elif a > 0 and (b & Fixed.MASK) != 0 and b < one:
+                logs.append(i)
+        if len(roots) > 0:
+            r = Fixed.sqrt_n([av[i] for i in roots], raw=True)
+            for j in range(len(roots)):
+                ret[roots[j]] = r[j]
+        if len(logs) > 0:
+            r = Fixed.log_n([av[i] for i in logs], raw=True)
+            b = [bv[i] for i in logs]
+            if numpy != None and all(abs(x) < Fixed._NPLIMIT >> 12 for x in b):
+                r = Fixed._mul_np(
+                    numpy.array(b, dtype=numpy.int64), numpy.array(r, dtype=numpy.int64)
+                ).tolist()
+            else:
+                r = [(Fixed(b[j]) * Fixed(r[j])).value for j in range(len(logs))]
+            r = Fixed.exp_n(r, raw=True)
+            for j in range(len(logs)):
+                ret[logs[j]] = r[j]
+        for i in range(len(av)):
+            if ret[i] == None:
+                ret[i] = Fixed(av[i]).pow(Fixed(bv[i])).value
+        return ret if raw else [Fixed(v) for v in ret]
+
     def __str__(self):
         return str(dec.Decimal(self.value) / dec.Decimal((1 << Fixed.BITS)))
 
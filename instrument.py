@@ -0,0 +1,86 @@
+"""
+Instrumentation shared by the random generators in this
+repository (randomgen.RandomGen, bernoulli.Bernoulli and
+betadist._BitFetchingRandomGen): random bits consumed, and
+calls made, bits consumed and wall time spent per sampler
+method.
+
+Written by Peter O.
+Any copyright to this work is released to the Public Domain.
+In case this is not possible, this work is also
+licensed under Creative Commons Zero (CC0):
+https://creativecommons.org/publicdomain/zero/1.0/
+"""
+
+import time
+
+class Instrumented:
+    """Base class for random generators that count the random bits
+    they consume in a 'totalbits' attribute.  Besides that count,
+    the methods of this class keep statistics on calls to
+    chosen methods of the generator.
+
+    Example:
+
+    >>> rg = randomgen.RandomGen()
+    >>> rg.instrument("binomial", "poisson")
+    >>> for i in range(1000): rg.binomial(20, 0.5)
+    >>> rg.stats()["methods"]["binomial"]["bits"]
+    """
+
+    def bitsconsumed(self):
+        """ Gets the number of random bits consumed so far. """
+        return self.totalbits
+
+    def instrument(self, *names):
+        """Starts counting calls, random bits consumed and wall time
+        for the methods with the given names, on this object only.
+        The bits and time of a method include those of any instrumented
+        method it calls in turn."""
+        if not hasattr(self, "_methodstats"):
+            self._methodstats = {}
+        for name in names:
+            if name in self._methodstats:
+                continue
+            method = getattr(self, name)
+            st = {"calls": 0, "bits": 0, "time": 0.0}
+            self._methodstats[name] = st
+            setattr(self, name, self._wrap(method, st))
+
+    def _wrap(self, method, st):
+        def wrapper(*args, **kwargs):
+            bits = self.bitsconsumed()
+            t = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                st["time"] += time.perf_counter() - t
+                st["bits"] += self.bitsconsumed() - bits
+                st["calls"] += 1
+
+        return wrapper
+
+    def uninstrument(self):
+        """ Stops counting for all methods passed to instrument(). """
+        for name in getattr(self, "_methodstats", {}):
+            delattr(self, name)
+        self._methodstats = {}
+
+    def stats(self):
+        """Returns a dictionary with the random bits consumed ('bits')
+        and, under 'methods', a dictionary for each instrumented method
+        giving its 'calls', 'bits', 'time' (in seconds) and 'bitspercall'."""
+        methods = {}
+        for name, st in getattr(self, "_methodstats", {}).items():
+            m = dict(st)
+            m["bitspercall"] = st["bits"] / st["calls"] if st["calls"] > 0 else 0
+            methods[name] = m
+        return {"bits": self.bitsconsumed(), "methods": methods}
+
+    def resetstats(self):
+        """ Resets the counts given by stats() to zero. """
+        self.totalbits = 0
+        for st in getattr(self, "_methodstats", {}).values():
+            st["calls"] = 0
+            st["bits"] = 0
+            st["time"] = 0.0
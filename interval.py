@@ -7,10 +7,24 @@
 #  (https://creativecommons.org/publicdomain/zero/1.0/).
 #
 import math
+import operator
 from decimal import Decimal
 from fractions import Fraction
 from betadist import *
 
+def _realev(real, x, n, memo):
+    # real(x).ev(n), where 'real' is a Real* class or a function
+    # that returns a Real* object; if 'memo' is given, it's a
+    # dictionary mapping x to that value, so that an endpoint
+    # shared by several intervals is evaluated only once
+    if memo == None:
+        return real(x).ev(n)
+    ret = memo.get(x)
+    if ret == None:
+        ret = real(x).ev(n)
+        memo[x] = ret
+    return ret
+
 #
 #  Implements interval numbers and interval arithmetic.  Builds on the concept of "constructive reals"
 #  or "recursive reals", which provide a function that outputs a value
@@ -136,8 +150,8 @@ class FInterval:
     def magnitude(self):
         return max(abs(self.sup), abs(self.inf))
 
-    def sqrt(self, n):
-        return self.pow(FInterval(0.5), n)
+    def sqrt(self, n, memo=None):
+        return self.pow(FInterval(0.5), n, memo)
 
     @staticmethod
     def _cos(sup, inf, precision):
@@ -236,7 +250,7 @@ class FInterval:
     def containedIn(self, y):
         return y.inf <= self.inf and self.sup <= y.sup
 
-    def pow(self, v, precision):
+    def pow(self, v, precision, memo=None):
         y = v if isinstance(v, FInterval) else FInterval(v)
         if y.inf == y.sup and int(y.inf) == y.inf and y.inf >= 0 and y.inf <= 32:
             # Special case: Integer power
@@ -256,40 +270,41 @@ class FInterval:
         # Use precision 1 greater than requested, so that
         # bounds will come (weakly) within 2^(precision+1) and thus
         # strictly within 2^precision.
-        rli = RealPow(self.inf, v).ev(precision + 1) - 1
-        rls = RealPow(self.sup, v).ev(precision + 1) + 1
+        real = lambda x: RealPow(x, v)
+        rli = _realev(real, self.inf, precision + 1, memo) - 1
+        rls = _realev(real, self.sup, precision + 1, memo) + 1
         return FInterval(
             Fraction(rli, 1 << (precision + 1)), Fraction(rls, 1 << (precision + 1))
         )
 
-    def log(self, precision):
+    def log(self, precision, memo=None):
         if not FInterval._greaterThanZero(self.inf):
             raise ValueError
         # Use precision 1 greater than requested, so that
         # bounds will come (weakly) within 2^(precision+1) and thus
         # strictly within 2^precision.
-        rli = RealLn(self.inf).ev(precision + 1) - 1
-        rls = RealLn(self.sup).ev(precision + 1) + 1
+        rli = _realev(RealLn, self.inf, precision + 1, memo) - 1
+        rls = _realev(RealLn, self.sup, precision + 1, memo) + 1
         return FInterval(
             Fraction(rli, 1 << (precision + 1)), Fraction(rls, 1 << (precision + 1))
         )
 
-    def tan(self, precision):
+    def tan(self, precision, memo=None):
         # Use precision 1 greater than requested, so that
         # bounds will come (weakly) within 2^(precision+1) and thus
         # strictly within 2^precision.
-        rli = RealTan(self.inf).ev(precision + 1) - 1
-        rls = RealTan(self.sup).ev(precision + 1) + 1
+        rli = _realev(RealTan, self.inf, precision + 1, memo) - 1
+        rls = _realev(RealTan, self.sup, precision + 1, memo) + 1
         return FInterval(
             Fraction(rli, 1 << (precision + 1)), Fraction(rls, 1 << (precision + 1))
         )
 
-    def exp(self, precision):
+    def exp(self, precision, memo=None):
         # Use precision 1 greater than requested, so that
         # bounds will come (weakly) within 2^(precision+1) and thus
         # strictly within 2^precision.
-        rli = RealExp(self.inf).ev(precision + 1) - 1
-        rls = RealExp(self.sup).ev(precision + 1) + 1
+        rli = _realev(RealExp, self.inf, precision + 1, memo) - 1
+        rls = _realev(RealExp, self.sup, precision + 1, memo) + 1
         return FInterval(
             Fraction(rli, 1 << (precision + 1)), Fraction(rls, 1 << (precision + 1))
         )
@@ -309,12 +324,12 @@ class FInterval:
             Fraction(max(rla + 1, rlb + 1, rlc + 1, rld + 1), 1 << (precision + 1)),
         )
 
-    def atan(self, precision):
+    def atan(self, precision, memo=None):
         # Use precision 1 greater than requested, so that
         # bounds will come (weakly) within 2^(precision+1) and thus
         # strictly within 2^precision.
-        rli = RealArcTan(self.inf).ev(precision + 1) - 1
-        rls = RealArcTan(self.sup).ev(precision + 1) + 1
+        rli = _realev(RealArcTan, self.inf, precision + 1, memo) - 1
+        rls = _realev(RealArcTan, self.sup, precision + 1, memo) + 1
         return FInterval(
             Fraction(rli, 1 << (precision + 1)), Fraction(rls, 1 << (precision + 1))
         )
@@ -343,6 +358,305 @@ class FInterval:
     def __repr__(self):
         return "[%s, %s]" % (float(self.inf), float(self.sup))
 
+# Comparisons allowed on the bounds of a traced interval
+_CMPOPS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+# Operations whose enclosure's lower and upper bounds are found
+# from the lower and upper endpoints separately, so that each
+# endpoint's value can be memoized (see _realev)
+_ENDPOINTOPS = {"exp", "log", "tan", "atan", "pow", "sqrt"}
+
+# Operations memoized by the whole interval
+_INTERVALOPS = {"sin", "cos"}
+
+class _Bound:
+    # Lower or upper bound of a traced interval.  The only thing
+    # that can be done with it is to compare it; each comparison's
+    # outcome is recorded as a guard for the trace.  Anything else,
+    # such as arithmetic, raises TypeError, so that the function
+    # being traced is evaluated directly instead.
+    __hash__ = None
+
+    def __init__(self, trace, node, attr, value):
+        self.trace = trace
+        self.node = node
+        self.attr = attr
+        self.value = value
+
+    def _cmp(self, op, other):
+        ov = other.value if isinstance(other, _Bound) else other
+        ret = _CMPOPS[op](self.value, ov)
+        self.trace.steps.append(("guard", self, op, other, ret))
+        return ret
+
+    def __lt__(self, other):
+        return self._cmp("<", other)
+
+    def __le__(self, other):
+        return self._cmp("<=", other)
+
+    def __gt__(self, other):
+        return self._cmp(">", other)
+
+    def __ge__(self, other):
+        return self._cmp(">=", other)
+
+    def __eq__(self, other):
+        return self._cmp("==", other)
+
+    def __ne__(self, other):
+        return self._cmp("!=", other)
+
+    def __bool__(self):
+        raise TypeError("bound of a traced interval used as a number")
+
+    def __repr__(self):
+        return repr(self.value)
+
+def _traced(name):
+    # Method of _TracedInterval that records the FInterval
+    # method 'name'
+    def method(self, *args):
+        return self._trace.op(name, self, args)
+
+    return method
+
+class _TracedInterval(FInterval):
+    # An FInterval that records the operations done on it
+    # (see IntervalExpression)
+    def __new__(cl, trace, node, value):
+        self = object.__new__(cl)
+        self._trace = trace
+        self._node = node
+        self._value = value
+        return self
+
+    @property
+    def inf(self):
+        return _Bound(self._trace, self._node, "inf", self._value.inf)
+
+    @property
+    def sup(self):
+        return _Bound(self._trace, self._node, "sup", self._value.sup)
+
+    __add__ = _traced("__add__")
+    __radd__ = _traced("__radd__")
+    __sub__ = _traced("__sub__")
+    __rsub__ = _traced("__rsub__")
+    __mul__ = _traced("__mul__")
+    __rmul__ = _traced("__rmul__")
+    __truediv__ = _traced("__truediv__")
+    __rtruediv__ = _traced("__rtruediv__")
+    __neg__ = _traced("__neg__")
+    __abs__ = _traced("__abs__")
+    negate = _traced("negate")
+    abs = _traced("abs")
+    clamp = _traced("clamp")
+    clampleft = _traced("clampleft")
+    floor = _traced("floor")
+    ceil = _traced("ceil")
+    rem = _traced("rem")
+    sqrt = _traced("sqrt")
+    pow = _traced("pow")
+    log = _traced("log")
+    tan = _traced("tan")
+    exp = _traced("exp")
+    atan2 = _traced("atan2")
+    atan = _traced("atan")
+    sin = _traced("sin")
+    cos = _traced("cos")
+
+    def __repr__(self):
+        return repr(self._value)
+
+class _Trace:
+    # Operations done on traced intervals by one call of a function,
+    # in order, and the comparisons of their bounds
+    def __init__(self):
+        self.steps = []
+        self.nodes = 0
+
+    def input(self, value):
+        ret = _TracedInterval(self, self.nodes, value)
+        self.nodes += 1
+        return ret
+
+    def op(self, name, selfv, args):
+        for a in args:
+            if isinstance(a, _Bound) or (
+                isinstance(a, _TracedInterval) and a._trace != self
+            ):
+                raise TypeError
+        func = getattr(FInterval, name)
+        value = func(
+            selfv._value,
+            *[a._value if isinstance(a, _TracedInterval) else a for a in args]
+        )
+        if not isinstance(value, FInterval):
+            raise TypeError
+        ret = _TracedInterval(self, self.nodes, value)
+        self.nodes += 1
+        self.steps.append(("op", ret._node, name, func, selfv._node, args))
+        return ret
+
+    def compile(self, ninputs, result):
+        # Generates a Python function that replays the operations on
+        # new inputs, returning None if any comparison has a different
+        # outcome than it did here
+        ns = {}
+
+        def const(v):
+            n = "C%d" % (len(ns))
+            ns[n] = v
+            return n
+
+        def arg(a):
+            if isinstance(a, _TracedInterval):
+                return "v%d" % (a._node)
+            if isinstance(a, _Bound):
+                return "v%d.%s" % (a.node, a.attr)
+            return const(a)
+
+        src = "def _replay(%s):\n" % ", ".join("v%d" % i for i in range(ninputs))
+        # Memoize only when no input is a single point: points (such
+        # as the samples MooreSampler evaluates the PDF at) seldom
+        # recur, so memoizing them would only use up memory
+        src += "    usememo = True\n"
+        for i in range(ninputs):
+            src += "    if v%d.inf == v%d.sup: usememo = False\n" % (i, i)
+        for step in self.steps:
+            if step[0] == "guard":
+                _, bound, op, other, outcome = step
+                src += "    if (%s %s %s) != %s: return None\n" % (
+                    arg(bound),
+                    op,
+                    arg(other),
+                    const(outcome),
+                )
+                continue
+            _, node, name, func, selfnode, args = step
+            call = ["v%d" % selfnode] + [arg(a) for a in args]
+            traced = any(isinstance(a, _TracedInterval) for a in args)
+            if name in _ENDPOINTOPS and not traced:
+                # Memoized by endpoint; the other arguments
+                # (exponent and precision) are constants
+                call.append("%s if usememo else None" % (const({})))
+                src += "    v%d = %s(%s)\n" % (node, const(func), ", ".join(call))
+            elif name in _INTERVALOPS and not traced:
+                memo = const({})
+                func = const(func)
+                src += "    k = (v%d.inf, v%d.sup)\n" % (selfnode, selfnode)
+                src += "    v%d = %s.get(k) if usememo else None\n" % (node, memo)
+                src += "    if v%d == None:\n" % (node)
+                src += "        v%d = %s(%s)\n" % (node, func, ", ".join(call))
+                src += "        if usememo: %s[k] = v%d\n" % (memo, node)
+            else:
+                src += "    v%d = %s(%s)\n" % (node, const(func), ", ".join(call))
+        src += "    return %s\n" % (arg(result))
+        exec(src, ns)
+        return ns["_replay"]
+
+def _shape(v, inputs):
+    # Hashable description of a function argument, with
+    # FIntervals (which are appended to 'inputs') left out
+    if isinstance(v, FInterval):
+        inputs.append(v)
+        return None
+    if isinstance(v, list):
+        return tuple([_shape(x, inputs) for x in v])
+    hash(v)
+    return ("const", v)
+
+def _unshape(v, inputs):
+    # Copy of a function argument with its FIntervals replaced,
+    # in order, by the items of the iterator 'inputs'
+    if isinstance(v, FInterval):
+        return next(inputs)
+    if isinstance(v, list):
+        return [_unshape(x, inputs) for x in v]
+    return v
+
+class IntervalExpression:
+    """A function of FIntervals, such as a PDF for moore.MooreSampler,
+    that is compiled into straight-line Python code the first time it's
+    called, by recording the FInterval operations it does.  Later calls
+    replay those operations on the new intervals without running the
+    function's own code; constant subexpressions (such as FInterval(9.7)
+    or FInterval.pi(5)) are evaluated only once; and the bounds of
+    exp, log, pow and the other transcendental operations are memoized,
+    so that an interval endpoint shared by several calls (as when a box
+    is split in two) is evaluated only once.  (Calls where an input is
+    a single point aren't memoized.)  Results are the same as
+    calling the function directly.
+      - func: A function that takes an FInterval, or a list (possibly
+         nested) of FIntervals and other values (such as a label
+         number), and returns an FInterval.  The function should depend
+         only on its argument, should use only the FInterval methods
+         on it, and may compare (but not otherwise use) the interval
+         bounds 'inf' and 'sup'.  The function is called directly
+         whenever it can't be compiled.
+      - maxtraces: Greatest number of compiled versions of the
+         function for each kind of argument.  A new version is compiled
+         whenever the function's comparisons of interval bounds have
+         different outcomes from those of earlier versions (as when
+         the function returns 0 outside its domain).  Optional; the
+         default is 8.
+
+    Example:
+
+    >>> pdf = IntervalExpression(lambda x: (x * x / -2).exp(60))
+    >>> pdf(FInterval(0, 1))
+    """
+
+    def __init__(self, func, maxtraces=8):
+        self.func = func
+        self.maxtraces = maxtraces
+        self._traces = {}
+        self._untraceable = set()
+
+    def __call__(self, v):
+        inputs = []
+        try:
+            key = _shape(v, inputs)
+        except TypeError:
+            # Unhashable argument
+            return self.func(v)
+        traces = self._traces.get(key)
+        if traces != None:
+            for replay in traces:
+                ret = replay(*inputs)
+                if ret != None:
+                    return ret
+            if len(traces) >= self.maxtraces:
+                return self.func(v)
+        if key in self._untraceable:
+            return self.func(v)
+        trace = _Trace()
+        tv = _unshape(v, iter([trace.input(x) for x in inputs]))
+        try:
+            result = self.func(tv)
+            if not isinstance(result, FInterval):
+                raise TypeError
+            if isinstance(result, _TracedInterval) and result._trace != trace:
+                raise TypeError
+            replay = trace.compile(len(inputs), result)
+        except Exception:
+            # The function does something that can't be traced, or
+            # else raises an error, which calling it directly raises
+            # again
+            ret = self.func(v)
+            self._untraceable.add(key)
+            return ret
+        self._traces.setdefault(key, []).append(replay)
+        return result._value if isinstance(result, _TracedInterval) else result
+
 def _polynomialProduct(a, b):
     # Finds the product of two polynomials.  Each polynomial
     # is a list of the following form:
@@ -4,9 +4,138 @@
 #  (https://creativecommons.org/publicdomain/zero/1.0/).
 #
 
+import bisect
+import itertools
 import math
 import random
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class UniformBuffer:
+    """A source of uniform random numbers in [0, 1) that generates
+    them in bulk and hands them out one at a time, for use as the 'rng'
+    parameter of the samplers in this module.  Giving each sampler (or
+    each thread) its own buffer, rather than sharing the 'random'
+    module's global state, makes parallel runs reproducible.
+      - seed: Seed for a new generator.  Optional.
+      - size: Number of random numbers generated at once.
+         Optional; the default is 4096.
+      - generator: The underlying generator: a NumPy Generator, or an
+         object with a 'random()' method such as random.Random.
+         Optional; if not given, a NumPy Generator (or, if NumPy isn't
+         installed, a random.Random) seeded with 'seed' is used.
+         Samplers in NumPy batch mode draw from a NumPy
+         generator directly.
+
+    Example:
+
+    >>> streams = UniformBuffer(seed=1).spawn(4)  # one for each thread
+    >>> samplers = [NormalDist(0, 1, rng=s) for s in streams]
+    """
+
+    def __init__(self, seed=None, size=4096, generator=None):
+        if generator == None:
+            if numpy != None:
+                generator = numpy.random.default_rng(seed)
+            else:
+                generator = random.Random(seed)
+        self.generator = generator
+        self.size = size
+        # Calls _chunk whenever the previous chunk runs out
+        self.random = itertools.chain.from_iterable(iter(self._chunk, None)).__next__
+
+    def _chunk(self):
+        if numpy != None and isinstance(self.generator, numpy.random.Generator):
+            return self.generator.random(self.size).tolist()
+        r = self.generator.random
+        return [r() for i in range(self.size)]
+
+    def randint(self, a, b):
+        """Generates a random integer in [a, b].  Meant for small
+        ranges, such as random signs; for large ranges, the result
+        is slightly biased."""
+        return a + int(self.random() * (b - a + 1))
+
+    def getrandbits(self, k):
+        """ Generates a k-bit random integer. """
+        if numpy != None and isinstance(self.generator, numpy.random.Generator):
+            r = int.from_bytes(self.generator.bytes((k + 7) // 8), "little")
+            return r & ((1 << k) - 1)
+        return self.generator.getrandbits(k)
+
+    def spawn(self, n):
+        """Returns a list of 'n' new buffers whose random numbers are
+        independent of this one's and of each other, and reproducible
+        given this buffer's seed."""
+        if hasattr(self.generator, "spawn"):
+            return [
+                UniformBuffer(size=self.size, generator=g)
+                for g in self.generator.spawn(n)
+            ]
+        return [UniformBuffer(self.getrandbits(128), self.size) for i in range(n)]
+
+class _RandomGenUniforms:
+    # Adapts a randomgen.RandomGen to the interface the samplers
+    # in this module use
+    def __init__(self, rg):
+        self.rg = rg
+        self.random = rg.rndu01oneexc
+
+    def randint(self, a, b):
+        return a + self.rg.rndintexc(b - a + 1)
+
+    def getrandbits(self, k):
+        return self.rg.randbits(k)
+
+def _uniforms(rng):
+    # Source of uniform random numbers for a sampler's 'rng' parameter:
+    # None (the 'random' module), a randomgen.RandomGen, or an object
+    # with 'random()', 'randint(a, b)' and 'getrandbits(k)' methods,
+    # such as random.Random or UniformBuffer
+    if rng == None:
+        return random
+    if hasattr(rng, "rndu01oneexc"):
+        return _RandomGenUniforms(rng)
+    return rng
+
+def _nprng(rng):
+    # NumPy random generator for one batch: the one behind 'rng'
+    # if it's a UniformBuffer over a NumPy generator, or else a new
+    # one seeded from 'rng', so that seeding 'rng' (or calling
+    # random.seed()) also makes batch sampling reproducible
+    gen = getattr(rng, "generator", None)
+    if isinstance(gen, numpy.random.Generator):
+        return gen
+    return numpy.random.default_rng(rng.getrandbits(128))
+
+def _fillbatch(n, block, rate):
+    # Batch mode of the rejection samplers below: 'block(m)' tries
+    # m candidates at once and returns a NumPy array of those that were
+    # accepted.  Block sizes follow the acceptance rate 'rate', so that
+    # a block usually brings in all the variates still needed, and
+    # later blocks only replace the rejected candidates.  Returns an array of exactly n
+    # variates, and the acceptance rate observed.
+    ret = numpy.empty(n)
+    filled = 0
+    trials = 0
+    accepts = 0
+    while filled < n:
+        need = n - filled
+        # Blocks are limited in size so that their arrays stay in cache
+        m = min(int(need / rate * 1.1) + 16, 1 << 14)
+        acc = block(m)
+        trials += m
+        accepts += len(acc)
+        take = min(len(acc), need)
+        ret[filled : filled + take] = acc[:take]
+        filled += take
+        if accepts > 0:
+            rate = accepts / trials
+    return ret, (accepts / trials if trials > 0 else rate)
+
 class TConcaveDiscreteSampler:
     """
     Generates a random variate that follows a
@@ -31,13 +160,18 @@ class TConcaveDiscreteSampler:
          function (CDF) at the mode-minus-1 (that is, the sum of
          all probabilities at values less than the mode).
          Optional.
+      - rng: Source of uniform random numbers: a randomgen.RandomGen,
+         a UniformBuffer, an object with 'random()' and 'randint(a, b)'
+         methods such as random.Random, or None (the default) to
+         use the 'random' module.
 
     Reference: J. Leydold, "A Simple Universal Generator for
     Continuous and Discrete Univariate T-Concave Distributions",
     ACM Transactions on Mathematical Software 27(1), March 2001.
     """
 
-    def __init__(self, f, area=1, mode=1, modecdf=None):
+    def __init__(self, f, area=1, mode=1, modecdf=None, rng=None):
+        self.rng = _uniforms(rng)
         self.uu = math.sqrt(f(mode - 1))
         self.uur = math.sqrt(f(mode))
         if self.uu <= 0:
@@ -60,8 +194,8 @@ class TConcaveDiscreteSampler:
 
     def sampleOne(self):
         while True:
-            v = random.random() * (self.vr - self.vl) + self.vl
-            u = random.random() * (self.uu if v < 0 else self.uur)
+            v = self.rng.random() * (self.vr - self.vl) + self.vl
+            u = self.rng.random() * (self.uu if v < 0 else self.uur)
             ret = math.floor(v / u) + self.mode
             # Accept/reject
             if u * u <= self.f(ret):
@@ -119,13 +253,22 @@ class TConcaveSampler:
          Optional; default is 0.
       - modecdf: Value of the distribution's cumulative distribution
          function (CDF) at the mode.  Optional.
+      - vf: Same as f, but takes and returns a NumPy array of numbers.
+         Optional.  If given and NumPy is installed, 'sample' tries
+         candidates in NumPy blocks rather than one at a time.
+      - rng: Source of uniform random numbers: a randomgen.RandomGen,
+         a UniformBuffer, an object with 'random()' and 'randint(a, b)'
+         methods such as random.Random, or None (the default) to
+         use the 'random' module.
 
     Reference: J. Leydold, "A Simple Universal Generator for
     Continuous and Discrete Univariate T-Concave Distributions",
     ACM Transactions on Mathematical Software 27(1), March 2001.
     """
 
-    def __init__(self, f, area=1, mode=0, modecdf=None):
+    def __init__(self, f, area=1, mode=0, modecdf=None, vf=None, rng=None):
+        self.rng = _uniforms(rng)
+        self.vf = vf
         self.fmode = f(mode)
         self.uu = math.sqrt(self.fmode)
         if self.uu <= 0:
@@ -152,6 +295,8 @@ class TConcaveSampler:
         self.sql = self.vl / self.uu
         self.sqr = self.vr / self.uu
         self.vrsq = self.vr * self.vr
+        # Acceptance rate of the hat function
+        self._rate = area / self.a
 
     def _simpleinit(self, f, area=1, mode=0, modecdf=None):
         self.uu = math.sqrt(f(mode))
@@ -173,15 +318,59 @@ class TConcaveSampler:
             self.sqr = self.vr / self.uu
 
     def sample(self, n):
+        if self.vf != None and numpy != None:
+            return self._sample_n(n).tolist()
         return [self.sampleOne() for i in range(n)]
 
+    def _sample_n(self, n):
+        # Batch mode of 'sample'; returns a NumPy array
+        rng = _nprng(self.rng)
+        ret, self._rate = _fillbatch(n, lambda m: self._block(rng, m), self._rate)
+        return ret
+
+    def _block(self, rng, m):
+        # Same as 'm' iterations of sampleOne's loop, returning
+        # the accepted variates
+        u = rng.random(m) * self.a
+        v = rng.random(m)
+        vl2 = self.vl * self.vl
+        left = u < self.al
+        right = u > self.ar
+        au = self.a - u
+        # Both branches of each numpy.where are computed, so the
+        # unused one can divide by zero (for example, when vl is 0
+        # because modecdf is 0)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            rawret = numpy.where(
+                left,
+                -vl2 / u,
+                numpy.where(
+                    right,
+                    self.vrsq / (self.uu * self.vr - (u - self.ar)),
+                    self.vl / self.uu + (u - self.al) / (self.uu * self.uu),
+                ),
+            )
+            y = numpy.where(
+                left, u * u / vl2, numpy.where(right, au * au / self.vrsq, self.fmode)
+            )
+        valid = u != 0
+        ret = numpy.where(valid, rawret, 0) + self.mode
+        vy = v * y
+        accept = vy <= self.vf(ret)
+        if self.havemodecdf:
+            # Squeeze
+            accept |= (
+                (self.sql <= rawret) & (rawret <= self.sqr) & (vy <= self.fmode / 4)
+            )
+        return ret[valid & accept]
+
     def sampleOne(self):
         while True:
-            u = random.random()
+            u = self.rng.random()
             u = u * self.a
             if u == 0:
                 continue
-            v = random.random()
+            v = self.rng.random()
             y = 0
             rawret = 0
             if u < self.al:
@@ -210,10 +399,10 @@ class TConcaveSampler:
 
     def _simplesampleOne(self):
         while True:
-            u = random.random() * self.uu
+            u = self.rng.random() * self.uu
             if u == 0:
                 continue
-            v = random.random() * (self.vr - self.vl) + self.vl
+            v = self.rng.random() * (self.vr - self.vl) + self.vl
             vu = v / u
             ret = self.mode + vu
             # Squeeze
@@ -250,6 +439,13 @@ class LogConcaveSampler:
          psi(-s) == psi(t) < 0. Optional; if not given, these two parameters
          will be chosen through numerical root finding, with the assumptions
          given earlier.
+      - vpsi - Same as psi, but takes and returns a NumPy array of numbers.
+         Optional.  If given and NumPy is installed, 'sample' tries
+         candidates in NumPy blocks rather than one at a time.
+      - rng - Source of uniform random numbers: a randomgen.RandomGen,
+         a UniformBuffer, an object with 'random()' and 'randint(a, b)'
+         methods such as random.Random, or None (the default) to
+         use the 'random' module.
 
      Example:
 
@@ -277,8 +473,12 @@ class LogConcaveSampler:
         eps = 1e-6
         return (psi(x + eps) - psi(x - eps)) / (2 * eps)
 
-    def __init__(self, psi, dpsi=None, s=None, t=None):
+    def __init__(self, psi, dpsi=None, s=None, t=None, vpsi=None, rng=None):
+        self.rng = _uniforms(rng)
         self.psi = psi
+        self.vpsi = vpsi
+        # Estimate of the acceptance rate, updated by batch sampling
+        self._rate = 0.5
         rho = 0.3
         if s == None:
             k = -1
@@ -327,20 +527,50 @@ class LogConcaveSampler:
         self.qr = self.q + self.r
 
     def sample(self, n):
+        if self.vpsi != None and numpy != None:
+            return self._sample_n(n).tolist()
         return [self.sampleOne() for i in range(n)]
 
+    def _sample_n(self, n):
+        # Batch mode of 'sample'; returns a NumPy array
+        rng = _nprng(self.rng)
+        ret, self._rate = _fillbatch(n, lambda m: self._block(rng, m), self._rate)
+        return ret
+
+    def _block(self, rng, m):
+        # Same as 'm' iterations of sampleOne's loop, returning
+        # the accepted variates
+        u = rng.random(m) * self.pqr
+        v = rng.random(m)
+        e = rng.standard_exponential(m)
+        ret = numpy.where(
+            u < self.q,
+            -self.sp + self.q * v,
+            numpy.where(u < self.qr, self.tp + self.r * e, -self.sp - self.p * e),
+        )
+        logchi = -rng.standard_exponential(m)
+        pr = self.vpsi(ret)
+        accept = numpy.where(
+            ret > self.tp,
+            logchi + self.tze - self.zeta * ret <= pr,
+            numpy.where(
+                ret < -self.sp, logchi + self.sxt + self.xi * ret <= pr, logchi <= pr
+            ),
+        )
+        return ret[accept]
+
     def sampleOne(self):
         while True:
-            u = random.random() * self.pqr
-            v = random.random()
+            u = self.rng.random() * self.pqr
+            v = self.rng.random()
             ret = 0
             if u < self.q:
                 ret = -self.sp + self.q * v
             elif u < self.qr:
-                ret = self.tp + self.r * math.log(1 / random.random())
+                ret = self.tp + self.r * math.log(1 / self.rng.random())
             else:
-                ret = -self.sp - self.p * math.log(1 / random.random())
-            chi = random.random()
+                ret = -self.sp - self.p * math.log(1 / self.rng.random())
+            chi = self.rng.random()
             logchi = math.log(chi)
             pr = self.psi(ret)
             if ret > self.tp:
@@ -364,24 +594,109 @@ class UnimodalSampler:
     chapter 7 of Devroye, 1986, "Non-Uniform Random Variate Generation").
 
     In the constructor, the mode is optional, and is assumed to be 0 if the
-    mode is not given.
+    mode is not given.  'vpdf' and 'vcdf' are optional and are the same as
+    'pdf' and 'cdf', but take and return NumPy arrays of numbers; if both
+    are given and NumPy is installed, 'sample' generates its variates
+    in NumPy blocks rather than one at a time.  'rng' is also optional and
+    is the source of uniform random numbers (see UniformBuffer); if not
+    given, the 'random' module is used.
     """
 
-    def __init__(self, pdf, cdf, mode=0):
+    def __init__(self, pdf, cdf, mode=0, vpdf=None, vcdf=None, rng=None):
+        self.rng = _uniforms(rng)
         self.mode = mode
         self.pdf = pdf
         self.cdf = cdf
+        self.vpdf = vpdf
+        self.vcdf = vcdf
         self.modepdf = pdf(self.mode)
         self.modecdf = cdf(self.mode)
         self.modecdfleft = cdf(self.mode - 1)
         self.modecdfright = cdf(self.mode + 1)
 
     def sample(self, n):
+        if self.vpdf != None and self.vcdf != None and numpy != None:
+            return self._sample_n(n).tolist()
         return [self.sampleOne() for i in range(n)]
 
+    def _sample_n(self, n):
+        # Batch mode of 'sample'; returns a NumPy array.  Each
+        # variate comes from one of four pieces, chosen as in
+        # sampleOne; the pieces are then sampled in blocks.
+        rng = _nprng(self.rng)
+        ret = numpy.empty(n)
+        left = rng.random(n) < self.modecdf
+        r = rng.random(n)
+        tail = numpy.zeros(n, dtype=bool)
+        if self.modecdf > 0:
+            tail |= left & (r < self.modecdfleft / self.modecdf)
+        if self.modecdf < 1:
+            tail |= ~left & (r < (1 - self.modecdfright) / (1 - self.modecdf))
+        pieces = [
+            (left & tail, self._tail_n, (self.mode - 1, -1, self.modecdfleft, 0)),
+            (
+                left & ~tail,
+                self._body_n,
+                (self.mode, self.mode - 1, self.modecdf, self.modecdfleft),
+            ),
+            (~left & tail, self._tail_n, (self.mode + 1, 1, self.modecdfright, 1)),
+            (
+                ~left & ~tail,
+                self._body_n,
+                (self.mode, self.mode + 1, self.modecdf, self.modecdfright),
+            ),
+        ]
+        for mask, func, args in pieces:
+            k = int(mask.sum())
+            if k > 0:
+                ret[mask] = func(rng, k, *args)
+        return ret
+
+    def _rejection_n(self, rng, lo, hi, pdfx, point):
+        # Samples y uniformly in [lo, hi) (arrays), accepting it at
+        # probability pdf(point(y))/pdfx, and resampling only
+        # the rejected slots
+        ret = numpy.empty(len(lo))
+        pending = numpy.arange(len(lo))
+        while len(pending) > 0:
+            y = lo[pending] + rng.random(len(pending)) * (hi[pending] - lo[pending])
+            pdfy = self.vpdf(point(y))
+            acc = rng.random(len(pending)) <= pdfy / pdfx[pending]
+            ret[pending[acc]] = point(y[acc])
+            pending = pending[~acc]
+        return ret
+
+    def _body_n(self, rng, k, st, en, cdfstart, cdfend):
+        # Batch version of _sampleBody
+        x = numpy.full(k, 0.5)
+        u = rng.random(k)
+        active = numpy.arange(k)
+        while len(active) > 0:
+            c = (self.vcdf(st + (en - st) * x[active]) - cdfstart) / (cdfend - cdfstart)
+            more = u[active] < c
+            active = active[more]
+            x[active] /= 2
+        pdfx = self.vpdf(st + (en - st) * x)
+        return self._rejection_n(rng, x, 2 * x, pdfx, lambda y: st + (en - st) * y)
+
+    def _tail_n(self, rng, k, st, direc, cdfstart, cdfend):
+        # Batch version of _sampleTail
+        x = numpy.zeros(k)
+        x2 = numpy.ones(k)
+        u = rng.random(k)
+        active = numpy.arange(k)
+        while len(active) > 0:
+            c = (self.vcdf(st + x2[active] * direc) - cdfstart) / (cdfend - cdfstart)
+            more = u[active] >= c
+            active = active[more]
+            x[active] = x2[active]
+            x2[active] *= 2
+        pdfx = self.vpdf(st + x * direc)
+        return self._rejection_n(rng, x, x2, pdfx, lambda y: st + y * direc)
+
     def _sampleBody(self, st, en, cdfstart, cdfend):
         x = 0.5
-        u = random.random()
+        u = self.rng.random()
         while True:
             c = (self.cdf(st + (en - st) * x) - cdfstart) / (cdfend - cdfstart)
             if u >= c:
@@ -389,15 +704,15 @@ class UnimodalSampler:
             x /= 2
         pdfx = self.pdf(st + (en - st) * x)
         while True:
-            y = x * (random.random() + 1)
+            y = x * (self.rng.random() + 1)
             pdfy = self.pdf(st + (en - st) * y)
-            if random.random() <= pdfy / pdfx:
+            if self.rng.random() <= pdfy / pdfx:
                 return st + (en - st) * y
 
     def _sampleTail(self, st, direc, cdfstart, cdfend):
         x = 0
         x2 = 1
-        u = random.random()
+        u = self.rng.random()
         while True:
             c = (self.cdf(st + x2 * direc) - cdfstart) / (cdfend - cdfstart)
             if u < c:
@@ -406,15 +721,15 @@ class UnimodalSampler:
             x2 *= 2
         pdfx = self.pdf(st + x * direc)
         while True:
-            y = x + random.random() * (x2 - x)
+            y = x + self.rng.random() * (x2 - x)
             pdfy = self.pdf(st + y * direc)
-            if random.random() <= pdfy / pdfx:
+            if self.rng.random() <= pdfy / pdfx:
                 return st + y * direc
 
     def sampleOne(self):
-        if random.random() < self.modecdf:
+        if self.rng.random() < self.modecdf:
             # Left side of the mode
-            if random.random() < self.modecdfleft / self.modecdf:
+            if self.rng.random() < self.modecdfleft / self.modecdf:
                 return self._sampleTail(self.mode - 1, -1, self.modecdfleft, 0)
             else:
                 return self._sampleBody(
@@ -422,7 +737,7 @@ class UnimodalSampler:
                 )
         else:
             # Right side of the mode
-            if random.random() < (1 - self.modecdfright) / (1 - self.modecdf):
+            if self.rng.random() < (1 - self.modecdfright) / (1 - self.modecdf):
                 return self._sampleTail(self.mode + 1, 1, self.modecdfright, 1)
             else:
                 return self._sampleBody(
@@ -443,6 +758,10 @@ class LogConcaveSampler2:
          if its slope does not increase on its domain),
          and 0 must be the distribution's mode (peak location) and thus
          the peak of psi must be at 0.
+      - rng - Source of uniform random numbers: a randomgen.RandomGen,
+         a UniformBuffer, an object with 'random()' and 'randint(a, b)'
+         methods such as random.Random, or None (the default) to
+         use the 'random' module.
 
      Example:
 
@@ -467,16 +786,21 @@ class LogConcaveSampler2:
      pp.1035-1039.
     """
 
-    def __init__(self, psi):
-        self.left = LogConcaveSamplerMonotonePositive(lambda x: psi(-x))
-        self.right = LogConcaveSamplerMonotonePositive(psi)
+    def __init__(self, psi, rng=None):
+        self.rng = _uniforms(rng)
+        self.left = LogConcaveSamplerMonotone(lambda x: psi(-x), rng=self.rng)
+        self.right = LogConcaveSamplerMonotone(psi, rng=self.rng)
 
     def sample(self, n):
         return [self.sampleOne() for i in range(n)]
 
     def sampleOne(self):
+        # Choose a half in proportion to the area under its
+        # envelope; both halves share the value of psi at 0
+        lefts = self.left.s
+        total = lefts + self.right.s
         while True:
-            if random.randint(0, 1) == 0:
+            if self.rng.random() * total < lefts:
                 ret = self.left.sampleIteration()
                 if ret != None:
                     return -ret
@@ -504,6 +828,13 @@ class LogConcaveSamplerMonotone:
       - symmetric - If true, the PDF is symmetric on both sides of the origin.
          This is done by mirroring the right half on the left half, but doesn't change
          the requirement that psi must have a positive domain only.
+      - vpsi - Same as psi, but takes and returns a NumPy array of numbers.
+         Optional.  If given and NumPy is installed, 'sample' tries
+         candidates in NumPy blocks rather than one at a time.
+      - rng - Source of uniform random numbers: a randomgen.RandomGen,
+         a UniformBuffer, an object with 'random()' and 'randint(a, b)'
+         methods such as random.Random, or None (the default) to
+         use the 'random' module.
 
      Example:
 
@@ -519,7 +850,7 @@ class LogConcaveSamplerMonotone:
      normal distribution with mean of mu and
      standard deviation of sigma:
 
-     >>> sampler = LogConcaveSamplerMonotonePositive(psi)
+     >>> sampler = LogConcaveSamplerMonotone(psi)
      >>> print([x+mu for x in sampler.sample(10)])
 
      Reference:
@@ -550,9 +881,13 @@ class LogConcaveSamplerMonotone:
                 return a
             i -= 1
 
-    def __init__(self, psi, symmetric=False):
+    def __init__(self, psi, symmetric=False, vpsi=None, rng=None):
+        self.rng = _uniforms(rng)
         self.psi = psi
+        self.vpsi = vpsi
         self.symmetric = symmetric
+        # Estimate of the acceptance rate, updated by batch sampling
+        self._rate = 0.5
         self.a = self._fx(psi)
         self.logfa = psi(self.a)
         self.logf2a = psi(2 * self.a)
@@ -567,8 +902,44 @@ class LogConcaveSamplerMonotone:
         self.s = self.qr + f2a * self.sp
 
     def sample(self, n):
+        if self.vpsi != None and numpy != None:
+            return self._sample_n(n).tolist()
         return [self.sampleOne() for i in range(n)]
 
+    def _sample_n(self, n):
+        # Batch mode of 'sample'; returns a NumPy array
+        rng = _nprng(self.rng)
+        ret, self._rate = _fillbatch(n, lambda m: self._block(rng, m), self._rate)
+        return ret
+
+    def _block(self, rng, m):
+        # Same as 'm' calls to sampleIteration, returning
+        # the accepted variates
+        u = 1.0 - rng.random(m)
+        v = rng.random(m) * self.s
+        chi = -rng.standard_exponential(m)
+        first = v <= self.q
+        second = ~first & (v < self.qr)
+        third = ~first & ~second
+        ret = numpy.where(
+            first,
+            self.a * u,
+            numpy.where(second, self.a + self.a * u, 2 * self.a - numpy.log(u) * self.sp),
+        )
+        bound = numpy.where(first, self.logf0, self.logfa)
+        if self.logf2a != 0:
+            h = (2 * self.a - ret) * self.logfa / self.a + (
+                ret - self.a
+            ) * self.logf2a / self.a
+            bound = numpy.where(third, h, bound)
+            accept = chi + bound <= self.vpsi(ret)
+        else:
+            accept = third | (chi + bound <= self.vpsi(ret))
+        ret = ret[accept]
+        if self.symmetric:
+            ret *= rng.integers(0, 2, len(ret)) * 2 - 1
+        return ret
+
     def codegen(self, name, pdfcall=None):
         """Generates Python code that samples
                 (approximately) from the distribution estimated
@@ -629,18 +1000,18 @@ class LogConcaveSamplerMonotone:
         return ret
 
     def sampleIteration(self):
-        u = random.random()
-        v = random.random() * self.s
-        chi = math.log(random.random())
+        u = self.rng.random()
+        v = self.rng.random() * self.s
+        chi = math.log(self.rng.random())
         ret = 0
         if v <= self.q:
             ret = self.a * u
             if chi + self.logf0 <= self.psi(ret):
-                return ret * ((random.randint(0, 1) * 2 - 1) if self.symmetric else 1)
+                return ret * ((self.rng.randint(0, 1) * 2 - 1) if self.symmetric else 1)
         elif v < self.qr:
             ret = self.a + self.a * u
             if chi + self.logfa <= self.psi(ret):
-                return ret * ((random.randint(0, 1) * 2 - 1) if self.symmetric else 1)
+                return ret * ((self.rng.randint(0, 1) * 2 - 1) if self.symmetric else 1)
         else:
             ret = 2 * self.a + math.log(1.0 / u) * self.sp
             h = 0
@@ -650,10 +1021,10 @@ class LogConcaveSamplerMonotone:
                 ) * self.logf2a / self.a
                 if chi + h <= self.psi(ret):
                     return ret * (
-                        (random.randint(0, 1) * 2 - 1) if self.symmetric else 1
+                        (self.rng.randint(0, 1) * 2 - 1) if self.symmetric else 1
                     )
             else:
-                return ret
+                return ret * ((self.rng.randint(0, 1) * 2 - 1) if self.symmetric else 1)
         return None
 
     def sampleOne(self):
@@ -662,38 +1033,310 @@ class LogConcaveSamplerMonotone:
             if ret != None:
                 return ret
 
+class AdaptiveLogConcaveSampler:
+    """
+    Generates a random variate that follows a distribution
+    whose probability density function (PDF) is log-concave, using
+    adaptive rejection sampling.  Specifically the PDF is proportional
+    to exp(psi), where psi is a continuous concave function.  The
+    sampler keeps an upper hull of psi made of tangent lines (so that
+    the hull of the PDF is piecewise exponential) and a lower hull (or
+    squeeze) made of chords, both through a set of points.  Whenever
+    psi is evaluated at a candidate, that point is added to the hulls,
+    until there are 'maxpoints' of them, so that the hulls approach psi,
+    nearly all candidates are accepted, and nearly all are accepted by
+    the squeeze without evaluating psi.
+      - psi - A function that takes one number and
+         outputs one number.  For this sampler to work, psi must be a
+         continuous concave function (informally, a function is concave
+         if its slope does not increase on its domain).
+      - dpsi - Derivative of psi.  Optional; if not given, this
+         derivative will be numerically approximated from psi.
+      - xs - Initial points.  Optional.  Either numbers, or [x, psi(x),
+         dpsi(x)] lists as returned by 'hull'; at least two are needed
+         unless 'mn' and 'mx' are both finite.  If not given, points are
+         searched for starting at -1 and 1 (or, if only 'mn' (or 'mx') is
+         finite, at 1 and 2 past it).  If the domain is unbounded
+         on the left (or right), dpsi must be positive (or negative) at
+         the leftmost (or rightmost) point, and points are moved outward
+         until it is.
+      - mn, mx - Domain of psi.  Optional; the default is the whole
+         real line.
+      - maxpoints - Greatest number of points in the hulls.
+         Optional; the default is 100.
+      - rng - Source of uniform random numbers: a randomgen.RandomGen,
+         a UniformBuffer, an object with 'random()' and 'randint(a, b)'
+         methods such as random.Random, or None (the default) to
+         use the 'random' module.
+
+     Example:
+
+     >>> psi = lambda x:  -(x * x) / (2 * sigma * sigma)
+     >>> sampler = AdaptiveLogConcaveSampler(psi, lambda x: -x / (sigma * sigma))
+     >>> print([x+mu for x in sampler.sample(10)])
+     >>> sampler.freeze()  # Stop adding points
+     >>> print(sampler.codegen("normal"))  # Code that samples with the hull
+
+     Reference:
+     Gilks, W.R., Wild, P., "Adaptive Rejection Sampling for Gibbs
+     Sampling", Journal of the Royal Statistical Society, Series C 41(2),
+     1992.
+    """
+
+    def _derivpsi(self, x):
+        eps = 1e-6
+        return (self.psi(x + eps) - self.psi(x - eps)) / (2 * eps)
+
+    def _point(self, x):
+        return [x, self.psi(x), self.dpsi(x)]
+
+    def __init__(
+        self,
+        psi,
+        dpsi=None,
+        xs=None,
+        mn=-math.inf,
+        mx=math.inf,
+        maxpoints=100,
+        rng=None,
+    ):
+        self.rng = _uniforms(rng)
+        if mn >= mx:
+            raise ValueError("mn is not less than mx")
+        self.psi = psi
+        self.dpsi = dpsi if dpsi != None else self._derivpsi
+        self.mn = mn
+        self.mx = mx
+        self.maxpoints = maxpoints
+        self.frozen = False
+        # Number of psi evaluations while sampling
+        self.psicalls = 0
+        if xs == None:
+            if mn > -math.inf and mx < math.inf:
+                xs = [mn + (mx - mn) / 3, mx - (mx - mn) / 3]
+            elif mn > -math.inf:
+                xs = [mn + 1, mn + 2]
+            elif mx < math.inf:
+                xs = [mx - 2, mx - 1]
+            else:
+                xs = [-1, 1]
+        pts = [x if isinstance(x, (list, tuple)) else self._point(x) for x in xs]
+        pts = sorted([list(p) for p in pts])
+        if len(pts) < 2:
+            raise ValueError("at least two points are needed")
+        step = 1
+        while mn == -math.inf and pts[0][2] <= 0:
+            pts.insert(0, self._point(pts[0][0] - step))
+            step *= 2
+        step = 1
+        while mx == math.inf and pts[-1][2] >= 0:
+            pts.append(self._point(pts[-1][0] + step))
+            step *= 2
+        self.points = pts
+        self._rebuild()
+
+    def _rebuild(self):
+        # Recalculates the hulls from the points
+        pts = self.points
+        k = len(pts)
+        # Ends of the tangent lines' segments
+        z = [self.mn]
+        for i in range(k - 1):
+            x0, h0, d0 = pts[i]
+            x1, h1, d1 = pts[i + 1]
+            if d0 - d1 <= 1e-12 * max(abs(d0), abs(d1), 1):
+                zi = (x0 + x1) / 2
+            else:
+                zi = (h1 - h0 - x1 * d1 + x0 * d0) / (d0 - d1)
+            z.append(min(max(zi, x0), x1))
+        z.append(self.mx)
+        # Top of the upper hull, so that the areas below
+        # (relative to exp(hmax)) don't overflow
+        hmax = -math.inf
+        for i in range(k):
+            x, h, d = pts[i]
+            end = z[i + 1] if d > 0 else z[i] if d < 0 else x
+            if abs(end) < math.inf:
+                hmax = max(hmax, h + d * (end - x))
+        areas = []
+        for i in range(k):
+            x, h, d = pts[i]
+            a = z[i]
+            b = z[i + 1]
+            if d > 0:
+                ar = math.exp(h - hmax + d * (b - x)) * -math.expm1(d * (a - b)) / d
+            elif d < 0:
+                ar = math.exp(h - hmax + d * (a - x)) * -math.expm1(d * (b - a)) / -d
+            else:
+                ar = math.exp(h - hmax) * (b - a)
+            areas.append(ar)
+        cumul = []
+        total = 0
+        for ar in areas:
+            total += ar
+            cumul.append(total)
+        self.z = z
+        self.cumul = cumul
+        self.total = total
+
+    def hull(self):
+        """Returns the points of the hulls, as a list of [x, psi(x),
+        dpsi(x)] lists, which can be passed as 'xs' to a new sampler
+        (for the same psi) to reuse the hulls without evaluating psi."""
+        return [list(p) for p in self.points]
+
+    def freeze(self):
+        """Stops adding points to the hulls, so that the hulls stay
+        the same from then on (as in the code generated by 'codegen')."""
+        self.frozen = True
+
+    def _add(self, x, h):
+        # Adds a point to the hulls, keeping them sorted
+        if self.frozen or len(self.points) >= self.maxpoints:
+            return
+        xs = [p[0] for p in self.points]
+        i = bisect.bisect_left(xs, x)
+        if i < len(xs) and xs[i] == x:
+            return
+        self.points.insert(i, [x, h, self.dpsi(x)])
+        self._rebuild()
+
+    def sample(self, n):
+        return [self.sampleOne() for i in range(n)]
+
+    def sampleOne(self):
+        pts = self.points
+        while True:
+            # Choose a segment of the upper hull, then a point
+            # in it
+            i = bisect.bisect_right(self.cumul, self.rng.random() * self.total)
+            i = min(i, len(pts) - 1)
+            x0, h0, d0 = pts[i]
+            a = self.z[i]
+            b = self.z[i + 1]
+            u = 1.0 - self.rng.random()
+            if d0 > 0:
+                x = b + math.log(u + (1 - u) * math.exp(d0 * (a - b))) / d0
+            elif d0 < 0:
+                x = a + math.log(u + (1 - u) * math.exp(d0 * (b - a))) / d0
+            else:
+                x = a + (1 - u) * (b - a)
+            upper = h0 + d0 * (x - x0)
+            logchi = math.log(1.0 - self.rng.random())
+            # Squeeze
+            j = i if x >= x0 else i - 1
+            if j >= 0 and j + 1 < len(pts):
+                xa, ha, _ = pts[j]
+                xb, hb, _ = pts[j + 1]
+                lower = ((xb - x) * ha + (x - xa) * hb) / (xb - xa)
+                if logchi + upper <= lower:
+                    return x
+            # Accept/reject
+            self.psicalls += 1
+            pr = self.psi(x)
+            self._add(x, pr)
+            if logchi + upper <= pr:
+                return x
+            pts = self.points
+
+    def codegen(self, name, pdfcall=None):
+        """Generates Python code that samples
+                (approximately) from the distribution estimated
+                in this class, using the hulls as they are now.
+                Idea from Leydold, et al.,
+                "An Automatic Code Generator for
+                Nonuniform Random Variate Generation", 2001.
+        - name: Distribution name.  Generates a Python method called
+           sample_X where X is the name given here (samples one
+           random number).
+        - pdfcall: Name of the method representing psi (for more information,
+           see the __init__ method of this class).  Optional; if not given
+           the name is psi_X where X is the name given in the name parameter."""
+        if pdfcall == None:
+            pdfcall = "psi_" + name
+        fmt = lambda v: "math.inf" if v == math.inf else (
+            "-math.inf" if v == -math.inf else "%.17g" % (v)
+        )
+        tbl = lambda vals: "[" + ", ".join(fmt(v) for v in vals) + "]"
+        ret = "import random\nimport math\nimport bisect\n\n"
+        ret += "X_%s = %s\n" % (name, tbl([p[0] for p in self.points]))
+        ret += "H_%s = %s\n" % (name, tbl([p[1] for p in self.points]))
+        ret += "D_%s = %s\n" % (name, tbl([p[2] for p in self.points]))
+        ret += "Z_%s = %s\n" % (name, tbl(self.z))
+        ret += "C_%s = %s\n\n" % (name, tbl(self.cumul))
+        ret += "def sample_" + name + "():\n"
+        ret += "    while True:\n"
+        ret += "        i = min(bisect.bisect_right(C_%s, random.random() * %s), %d)\n" % (
+            name,
+            fmt(self.total),
+            len(self.points) - 1,
+        )
+        ret += "        x0 = X_%s[i]\n" % (name)
+        ret += "        d0 = D_%s[i]\n" % (name)
+        ret += "        a = Z_%s[i]\n" % (name)
+        ret += "        b = Z_%s[i + 1]\n" % (name)
+        ret += "        u = 1.0 - random.random()\n"
+        ret += "        if d0 > 0:\n"
+        ret += "            x = b + math.log(u + (1 - u) * math.exp(d0 * (a - b))) / d0\n"
+        ret += "        elif d0 < 0:\n"
+        ret += "            x = a + math.log(u + (1 - u) * math.exp(d0 * (b - a))) / d0\n"
+        ret += "        else:\n"
+        ret += "            x = a + (1 - u) * (b - a)\n"
+        ret += "        upper = H_%s[i] + d0 * (x - x0)\n" % (name)
+        ret += "        logchi = math.log(1.0 - random.random())\n"
+        ret += "        j = i if x >= x0 else i - 1\n"
+        ret += "        if j >= 0 and j + 1 < %d:\n" % (len(self.points))
+        ret += "            xa = X_%s[j]\n" % (name)
+        ret += "            xb = X_%s[j + 1]\n" % (name)
+        ret += "            lower = ((xb - x) * H_%s[j] + (x - xa) * H_%s[j + 1]) / (xb - xa)\n" % (
+            name,
+            name,
+        )
+        ret += "            if logchi + upper <= lower: return x\n"
+        ret += "        if logchi + upper <= %s(x): return x\n\n" % (pdfcall)
+        return ret
+
 class NormalDist:
-    def __init__(self, mu=0, sigma=1):
+    def __init__(self, mu=0, sigma=1, rng=None):
         psi = lambda x: -(x * x) / (2 * sigma * sigma)
         self.mu = mu
-        self.sampler = LogConcaveSampler(psi)
+        # psi also works on NumPy arrays
+        self.sampler = LogConcaveSampler(psi, vpsi=psi, rng=rng)
 
     def sample(self, n):
+        if numpy != None:
+            return (self.sampler._sample_n(n) + self.mu).tolist()
         return [x + self.mu for x in self.sampler.sample(n)]
 
 class GenInvGaussianAlphaBeta:
-    def __init__(self, lamda, alpha, beta):
+    def __init__(self, lamda, alpha, beta, rng=None):
         # Three-parameter version (Hörmann, W., Leydold, J.,
         # "Generating Generalized Inverse Gaussian
         # Random Variates", 2013).
-        self.sampler = GenInvGaussian(lamda, beta)
+        self.sampler = GenInvGaussian(lamda, beta, rng)
         self.alpha = alpha
 
     def sample(self, n):
+        if numpy != None:
+            return (self.sampler._sample_n(n) * self.alpha).tolist()
         return [x * self.alpha for x in self.sampler.sample(n)]
 
-    def fromLambdaPsiChi(lamda, psi, chi):
+    def _sample_n(self, n):
+        return self.sampler._sample_n(n) * self.alpha
+
+    def fromLambdaPsiChi(lamda, psi, chi, rng=None):
         # Called lambda, psi, chi in Hörmann and Leydold 2013
         # Called p, a, b in Devroye 2014
         return GenInvGaussianAlphaBeta(
-            lamda, math.sqrt(psi / chi), math.sqrt(psi * chi)
+            lamda, math.sqrt(psi / chi), math.sqrt(psi * chi), rng
         )
 
 class GammaDist:
     # Devroye 2014
-    def __init__(self, a):
+    def __init__(self, a, rng=None):
         if a <= 0:
             raise ValueError
+        self.rng = _uniforms(rng)
         self.apow = 0
         self.lessThanOne = a < 1
         if self.lessThanOne:
@@ -703,25 +1346,34 @@ class GammaDist:
             self.a = a
         psi = lambda x: self.a * (1 - math.exp(x) + x)
         dpsi = lambda x: self.a * (1 - math.exp(x))
-        self.sampler = LogConcaveSampler(psi, dpsi)
+        vpsi = lambda x: self.a * (1 - numpy.exp(x) + x)
+        self.sampler = LogConcaveSampler(psi, dpsi, vpsi=vpsi, rng=self.rng)
 
     def sample(self, n):
+        if numpy != None:
+            ret = self.a * numpy.exp(self.sampler._sample_n(n))
+            if self.lessThanOne:
+                ret *= _nprng(self.rng).random(n) ** self.apow
+            return ret.tolist()
         return [
-            (random.random() ** self.apow if self.lessThanOne else 1)
+            (self.rng.random() ** self.apow if self.lessThanOne else 1)
             * self.a
             * math.exp(x)
             for x in self.sampler.sample(n)
         ]
 
 class GenInvGaussian:
-    def __init__(self, lamda, omega):
+    def __init__(self, lamda, omega, rng=None):
         # omega>0, lamda>=0. Two-parameter version described in Devroye 2014
         self.invert = lamda < 0
         lamda = abs(lamda)
         alpha = math.hypot(lamda, omega) - lamda
         psi = lambda x: -alpha * (math.cosh(x) - 1) - lamda * (math.exp(x) - x - 1)
         dpsi = lambda x: -alpha * (math.sinh(x)) - lamda * (math.exp(x) - 1)
-        self.sampler = LogConcaveSampler(psi, dpsi)
+        vpsi = lambda x: -alpha * (numpy.cosh(x) - 1) - lamda * (
+            numpy.exp(x) - x - 1
+        )
+        self.sampler = LogConcaveSampler(psi, dpsi, vpsi=vpsi, rng=rng)
         self.mult = lamda / omega + math.sqrt(1 + lamda * lamda / (omega * omega))
 
     def _trans(self, v):
@@ -729,8 +1381,14 @@ class GenInvGaussian:
         return 1 / v if self.invert else v
 
     def sample(self, n):
+        if numpy != None:
+            return self._sample_n(n).tolist()
         return [self._trans(x) for x in self.sampler.sample(n)]
 
+    def _sample_n(self, n):
+        v = self.mult * numpy.exp(self.sampler._sample_n(n))
+        return 1 / v if self.invert else v
+
 if __name__ == "__main__":
 
     def bucket(v, ls, buckets):
@@ -1,5 +1,6 @@
 from fractions import Fraction
 from betadist import *
+import bernoulli
 import time
 import math
 import random
@@ -461,7 +462,7 @@ class C4Function:
             ) ** Fraction(1, 2)
         else:
             print("Unsupported")
-        overshifted = realIsLessOrEqual(Fraction(1), incr):
+        overshifted = realIsLessOrEqual(Fraction(1), incr)
         ipol = None if overshifted else iteratedPoly2(self.func, deg)
         # NOTE: Can return a Fraction (rather than Real*)
         # in some cases, but this is only used in realIsLess
@@ -498,19 +499,25 @@ class C4Function:
         """ - coin(): Function that returns 1 or 0 with a fixed probability."""
         return simulate(coin, self.fbelow, self.fabove, self.fbound, self.nextdegree)
 
-def _fb2(fbelow, a, b, v=1):
+def _fb2n(fbelow, a, b, v=1):
     if b > a:
         raise ValueError
-    return Fraction(realFloor(fbelow(a, b) * v), v)
+    return realFloor(fbelow(a, b) * v)
 
-def _fa2(fabove, a, b, v=1):
+def _fa2n(fabove, a, b, v=1):
     if b > a:
         raise ValueError
     mv = realFloor(fabove(a, b) * v)
     imv = int(mv)
-    return Fraction(imv, v) if mv == imv else Fraction(imv + 1, v)
+    return imv if mv == imv else imv + 1
+
+def _fb2(fbelow, a, b, v=1):
+    return Fraction(_fb2n(fbelow, a, b, v), v)
+
+def _fa2(fabove, a, b, v=1):
+    return Fraction(_fa2n(fabove, a, b, v), v)
 
-def simulate(coin, fbelow, fabove, fbound, nextdegree=None):
+def simulate(coin, fbelow, fabove, fbound, nextdegree=None, cache=None):
     """A Bernoulli factory for a continuous function f(x) that maps [0, 1]
      to [0, 1] (and where f(x) is polynomially bounded).  Returns either 1
      with probability f(x) (where x is the probability that the given coin
@@ -529,7 +536,11 @@ def simulate(coin, fbelow, fabove, fbound, nextdegree=None):
        must return an integer greater than n.
        Optional.  If not given, the first degree is 1 and the next degree is n*2
        (so that for each power of 2 as well as 1, a polynomial of that degree
-       must be specified)."""
+       must be specified).
+    - cache: bernoulli.BernsteinCache holding the coefficients calculated
+       so far.  Optional.  If not given, uses bernoulli.BERNSTEINCACHE.
+       Repeated simulations with the same 'fbelow' and 'fabove' functions
+       (such as C4Function.simulate) reuse the coefficients found earlier."""
     ones = 0
     lastdegree = 0
     l = Fraction(0)
@@ -542,65 +553,23 @@ def simulate(coin, fbelow, fabove, fbound, nextdegree=None):
         if fb[0] >= 0 and fb[1] <= 1:
             break
         degree = nextdegree(degree) if nextdegree != None else degree * 2
-    startdegree = degree
+    cache = bernoulli.BERNSTEINCACHE if cache == None else cache
     ret = RandUniform()
-    correctness = False
-    if correctness:
-        fba = {}
-        faa = {}
     while True:
         for i in range(degree - lastdegree):
             if coin() == 1:
                 ones += 1
-        c = math.comb(degree, ones)
-        md = degree
-        l = _fb2(fbelow, degree, ones, c << md)
-        u = _fa2(fabove, degree, ones, c << md)
-        if correctness:
-            fba[(degree, ones)] = l
-            faa[(degree, ones)] = u
-        ls = Fraction(0)
-        us = Fraction(1)
-        if degree > startdegree:
-            nh = math.comb(degree, ones)
-            md = lastdegree
-            combs = [
-                Fraction(
-                    math.comb(degree - lastdegree, ones - j) * math.comb(lastdegree, j),
-                    nh,
-                )
-                for j in range(0, min(lastdegree, ones) + 1)
-            ]
-            if correctness:  # Correctness check
-                for j in range(0, min(lastdegree, ones) + 1):
-                    fb = _fb2(
-                        fbelow, lastdegree, j, (1 * math.comb(lastdegree, j)) << md
-                    )
-                    if (lastdegree, j) in fba:
-                        # print(fb)
-                        if fba[(lastdegree, j)] != fb:
-                            raise ValueError
-                    fa = _fa2(
-                        fabove, lastdegree, j, (1 * math.comb(lastdegree, j)) << md
-                    )
-                    if (lastdegree, j) in faa:
-                        # print(fa)
-                        if faa[(lastdegree, j)] != fa:
-                            raise ValueError
-            ls = sum(
-                _fb2(fbelow, lastdegree, j, (1 * math.comb(lastdegree, j)) << md)
-                * combs[j]
-                for j in range(0, min(lastdegree, ones) + 1)
-            )
-            us = sum(
-                _fa2(fabove, lastdegree, j, (1 * math.comb(lastdegree, j)) << md)
-                * combs[j]
-                for j in range(0, min(lastdegree, ones) + 1)
-            )
+        l, u, ls, us = cache.bounds(
+            fbelow, fabove, _fb2n, _fa2n, degree, lastdegree, ones
+        )
+        if lastdegree > 0:
             if l < ls:
                 raise ValueError
             if us < u:
                 raise ValueError
+        else:
+            ls = Fraction(0)
+            us = Fraction(1)
         m = (ut - lt) / (us - ls)
         lt = lt + (l - ls) * m
         ut = ut - (us - u) * m
@@ -623,4 +592,5 @@ def cc():
     print(ce.value(0.9))
     print(sum(f.simulate(coin) for i in range(50000)) / 50000)
 
-cc()
+if __name__ == "__main__":
+    cc()
@@ -8,9 +8,9 @@
 import heapq
 import random
 import math
-from randomgen import RandomGen, FastLoadedDiceRoller
+from randomgen import RandomGen, DynamicWeightedSampler
 from fractions import Fraction
-from interval import FInterval
+from interval import FInterval, IntervalExpression
 
 class MooreSampler:
     """
@@ -53,6 +53,14 @@ class MooreSampler:
     - bitAccuracy: Bit accuracy of the sampler; the sampler will sample from
        a distribution (truncated to the sampling domain) that is close to the
        ideal distribution by 2^-bitAccuracy.  The default is 53.
+    - compilePdf: If true (the default), the PDF is wrapped in an
+       interval.IntervalExpression, which records its FInterval
+       operations on the first call and replays them on later boxes
+       and samples, memoizing the bounds of exp, log, pow and
+       other transcendental operations, so that interval endpoints
+       shared by neighboring boxes are evaluated only once.  The
+       sampler's results don't change either way.  Set this to false
+       if the PDF depends on anything other than its argument.
 
     Reference:
     Sainudiin, Raazesh, and Thomas L. York. "An Auto-Validating, Trans-Dimensional,
@@ -65,7 +73,7 @@ class MooreSampler:
     Constraint Programming and Decision Making (pp. 143-152). Springer, Cham.
     """
 
-    def __init__(self, pdf, mn, mx, numLabels=1, bitAccuracy=53):
+    def __init__(self, pdf, mn, mx, numLabels=1, bitAccuracy=53, compilePdf=True):
         if not isinstance(mn, list):
             mn = [mn]
         if not isinstance(mx, list):
@@ -76,11 +84,18 @@ class MooreSampler:
         for i in range(len(mn)):
             if mn[i] >= mx[i]:
                 raise ValueError("A minimum is not less than a maximum")
+        if compilePdf and not isinstance(pdf, IntervalExpression):
+            pdf = IntervalExpression(pdf)
         self.pdf = pdf
         self.bitAccuracy = bitAccuracy
         self.queue = []
         self.boxes = []
         self.weights = []
+        # Box weights as integers: each weight times a common
+        # denominator (_weightscale); updated in place when a box
+        # is split, rather than rebuilt
+        self.alias = DynamicWeightedSampler()
+        self._weightscale = 1
         self.transdim = numLabels > 1
         for label in range(numLabels):
             box = [FInterval(mn[i], mx[i]) for i in range(len(mn))]
@@ -88,7 +103,8 @@ class MooreSampler:
             heapq.heappush(self.queue, (boxkey, len(self.boxes)))
             self.boxes.append((box, boxrange, self._boxToISD(box), label))
             self.weights.append(boxweight)
-        self._regenTable()
+            w = self._intWeight(boxweight)
+            self.alias.insert(w)
         self.rg = RandomGen()
         self.accepts = 0
         self.totaltrials = 0
@@ -96,12 +112,20 @@ class MooreSampler:
     def acceptRate(self):
         return float(Fraction(self.accepts, self.totaltrials))
 
-    def _regenTable(self):
-        # Convert to integer weights
-        wsum = sum(self.weights)
-        intweights = [int(x * wsum.denominator) for x in self.weights]
-        # Regenerate alias table
-        self.alias = FastLoadedDiceRoller(intweights)
+    def _intWeight(self, weight):
+        # Converts a box weight to an integer weight, first
+        # rescaling the existing integer weights if the common
+        # denominator isn't a multiple of the weight's denominator.
+        # Box weights are usually dyadic rationals, so rescaling
+        # is rare.
+        den = weight.denominator
+        if self._weightscale % den != 0:
+            factor = den // math.gcd(self._weightscale, den)
+            self._weightscale *= factor
+            self.alias = DynamicWeightedSampler(
+                [w * factor for w in self.alias.weights]
+            )
+        return weight.numerator * (self._weightscale // den)
 
     def _boxToISD(self, box):  # ISD = inf, sup, denominator
         return [self._intvToISD(intv) for intv in box]
@@ -154,10 +178,13 @@ class MooreSampler:
                 label,
             )
             self.weights[newBoxIndex] = boxweight
+            w = self._intWeight(boxweight)
+            self.alias.update(newBoxIndex, w)
             newBoxIndex = len(self.boxes)  # Add right box
         else:
             # Weight is 0, since the old box was removed
             self.weights[newBoxIndex] = 0
+            self.alias.update(newBoxIndex, 0)
         # Right box
         rightbox[dim] = FInterval(mid, box[dim].sup)
         if rightbox[dim].inf != rightbox[dim].sup:
@@ -166,6 +193,8 @@ class MooreSampler:
             box = (rightbox, boxrange, self._boxToISD(rightbox), label)
             self.boxes.append(box)
             self.weights.append(boxweight)
+            w = self._intWeight(boxweight)
+            self.alias.insert(w)
 
     def _widthAsFrac(self, intv):
         return Fraction(intv.sup) - Fraction(intv.inf)
@@ -258,7 +287,6 @@ class MooreSampler:
                 # print(["accept",self.acceptRate()])
                 for i in range(10):
                     self._bisect()
-                self._regenTable()
             if s[0] != None:
                 return s[0]
 
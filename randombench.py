@@ -0,0 +1,412 @@
+"""
+Microbenchmarks for the samplers in randomgen.py and related modules.
+
+Written by Peter O.
+Any copyright to this work is released to the Public Domain.
+In case this is not possible, this work is also
+licensed under Creative Commons Zero (CC0):
+https://creativecommons.org/publicdomain/zero/1.0/
+"""
+
+import json
+import math
+import random
+import sys
+import time
+from randomgen import RandomGen, DynamicWeightedSampler, FastLoadedDiceRoller
+from bitsource import FractionDigits
+from betadist import psrn_add, psrn_fill, psrn_new_01, betadist, BetaTable
+from bernoulli import Bernoulli, DiceEnterprise
+from fixed import Fixed
+from moore import MooreSampler
+import logconcave
+
+class _BitAtATimeRandomGen(RandomGen):
+    # RandomGen as it was before bits were drawn from a
+    # bulk pool: 63 bits per call to the RNG, one
+    # Python-level call per bit in the fast dice roller.
+    def __init__(self, rng=None):
+        RandomGen.__init__(self, rng)
+        self.bitcount = 63
+        self.curbit = 0
+
+    def randbit(self):
+        if self.bitcount >= 63:
+            self.bitcount = 0
+            self.curbit = self.rng.randint(0, (1 << 63) - 1)
+        ret = self.curbit & 1
+        self.curbit >>= 1
+        self.bitcount += 1
+        return ret
+
+    def rndint(self, maxInclusive):
+        if maxInclusive < 0:
+            raise ValueError("maxInclusive less than 0")
+        if maxInclusive == 0:
+            return 0
+        if maxInclusive == 1:
+            return self.randbit()
+        x = 1
+        y = 0
+        while True:
+            x = x * 2
+            y = y * 2 + self.randbit()
+            if x > maxInclusive:
+                if y <= maxInclusive:
+                    return y
+                x = x - maxInclusive - 1
+                y = y - maxInclusive - 1
+
+    def randbits(self, n):
+        return self.rndint((1 << n) - 1)
+
+def callspersecond(func, mintime=0.5):
+    """Calls 'func' (which takes no arguments) repeatedly for at
+    least 'mintime' seconds and returns the number of calls
+    made per second."""
+    calls = 0
+    batch = 100
+    t = time.perf_counter()
+    while True:
+        for i in range(batch):
+            func()
+        calls += batch
+        elapsed = time.perf_counter() - t
+        if elapsed >= mintime:
+            return calls / elapsed
+        batch *= 2
+
+def bench_bitpool(seed=1):
+    """Compares calls per second of rndint and randbits
+    before and after RandomGen's bulk bit pool."""
+    before = _BitAtATimeRandomGen(random.Random(seed))
+    after = RandomGen(random.Random(seed))
+    cases = [
+        ("rndint(6)", lambda rg: rg.rndint(6)),
+        ("rndint(2**40)", lambda rg: rg.rndint(2**40)),
+        ("randbits(53)", lambda rg: rg.randbits(53)),
+    ]
+    for name, f in cases:
+        b = callspersecond(lambda: f(before))
+        a = callspersecond(lambda: f(after))
+        print("%-15s before %12.0f/s  after %12.0f/s  (%.2fx)" % (name, b, a, a / b))
+
+def bench_batch(n=100000, seed=1):
+    """Compares variates per second of the scalar RandomGen
+    samplers against their batch (_n) counterparts."""
+    rg = RandomGen(random.Random(seed))
+    cases = [
+        ("rndint(6)", lambda: rg.rndint(6), lambda: rg.rndint_n(6, n)),
+        ("rndu01()", lambda: rg.rndu01(), lambda: rg.rndu01_n(n)),
+        (
+            "binomial(20, 0.5)",
+            lambda: rg.binomial(20, 0.5),
+            lambda: rg.binomial_n(20, 0.5, n),
+        ),
+        ("poisson(3)", lambda: rg.poisson(3), lambda: rg.poisson_n(3, n)),
+    ]
+    for name, scalar, batch in cases:
+        s = callspersecond(scalar)
+        b = callspersecond(batch) * n
+        print("%-18s scalar %12.0f/s  batch %12.0f/s  (%.2fx)" % (name, s, b, b / s))
+
+def check_weighted_choice_n(n=20000, seed=1):
+    """Checks that weighted_choice_n follows non-integer weights,
+    including ones whose sum is a whole number, both before and
+    after it switches to a prepared sampler."""
+    rg = RandomGen(random.Random(seed))
+    for weights in [[0.25, 0.75], [0.5, 1.5, 2.0], [0.1, 0.2, 0.3]]:
+        total = sum(weights)
+        mean = sum(i * w for i, w in enumerate(weights)) / total
+        var = sum((i - mean) ** 2 * w for i, w in enumerate(weights)) / total
+        for count in [50, n]:
+            got = [rg.weighted_choice_n(weights, count) for i in range(n // count)]
+            got = [x for g in got for x in g]
+            if abs(sum(got) / len(got) - mean) > 5 * math.sqrt(var / len(got)):
+                raise ValueError("weighted_choice_n(%s): wrong mean" % (weights))
+    print("weighted_choice_n with non-integer weights: OK")
+
+def bench_dynamic(n=1000, rounds=2000, seed=1):
+    """Compares a DynamicWeightedSampler against rebuilding a
+    FastLoadedDiceRoller, when one weight changes before
+    each sample."""
+    rg = RandomGen(random.Random(seed))
+    weights = [rg.rndintrange(1, 1000) for i in range(n)]
+    updates = [(rg.rndintexc(n), rg.rndintrange(0, 1000)) for i in range(rounds)]
+    t = time.perf_counter()
+    w = [x for x in weights]
+    for index, weight in updates:
+        w[index] = weight
+        FastLoadedDiceRoller(w).next(rg)
+    rebuild = rounds / (time.perf_counter() - t)
+    t = time.perf_counter()
+    dyn = DynamicWeightedSampler(weights)
+    for index, weight in updates:
+        dyn.update(index, weight)
+        dyn.next(rg)
+    dynamic = rounds / (time.perf_counter() - t)
+    print(
+        "update+sample, n=%d: rebuild %10.0f/s  dynamic %10.0f/s  (%.2fx)"
+        % (n, rebuild, dynamic, dynamic / rebuild)
+    )
+
+def bench_binomial_many(n=1000000, seed=1):
+    """Compares drawing 'n' binomial random numbers with mixed
+    parameters one at a time against binomial_many."""
+    rg = RandomGen(random.Random(seed))
+    probs = [0.01, 0.1, 0.25, 0.3, 0.5, 0.9]
+    ns = [rg.rndintrange(1, 200) for i in range(n)]
+    ps = [probs[rg.rndintexc(len(probs))] for i in range(n)]
+    t = time.perf_counter()
+    for i in range(n):
+        rg.binomial(ns[i], ps[i])
+    scalar = n / (time.perf_counter() - t)
+    t = time.perf_counter()
+    rg.binomial_many(ns, ps)
+    many = n / (time.perf_counter() - t)
+    print(
+        "binomial, %d mixed: scalar %10.0f/s  binomial_many %10.0f/s  (%.2fx)"
+        % (n, scalar, many, many / scalar)
+    )
+
+def _zero_or_one_bitwise(rg, px, py):
+    # RandomGen.zero_or_one as it was before it examined
+    # several bits at once: one bit per loop iteration
+    z = px
+    while True:
+        z = z * 2
+        if z >= py:
+            if rg.randbit() == 0:
+                return 1
+            z = z - py
+        elif z == 0 or rg.randbit() == 0:
+            return 0
+
+def bench_zero_or_one(seed=1):
+    """Compares calls per second of zero_or_one one bit at a time,
+    a word at a time, and with a precompiled FractionDigits."""
+    rg = RandomGen(random.Random(seed))
+    for px, py in [(1, 3), (5, 9), (123456789, 1000000007)]:
+        digits = FractionDigits(px, py)
+        b = callspersecond(lambda: _zero_or_one_bitwise(rg, px, py))
+        a = callspersecond(lambda: rg.zero_or_one(px, py))
+        p = callspersecond(lambda: rg.zero_or_one(digits))
+        print(
+            "zero_or_one(%d, %d): bitwise %10.0f/s  word %10.0f/s (%.2fx)  precompiled %10.0f/s (%.2fx)"
+            % (px, py, b, a, a / b, p, p / b)
+        )
+
+def bench_betatable(seed=1):
+    """Compares variates per second of betadist with and
+    without a precomputed BetaTable."""
+    bern = Bernoulli(random.Random(seed))
+    for a, b in [((3, 2), (3, 2)), ((5, 2), (7, 2)), ((2, 1), (1, 1))]:
+        table = BetaTable(a[0], a[1], b[0], b[1])
+        f = callspersecond(lambda: betadist(bern, a[0], a[1], b[0], b[1]))
+        t = callspersecond(lambda: betadist(bern, a[0], a[1], b[0], b[1], table=table))
+        print(
+            "betadist(%d/%d, %d/%d): factory %8.0f/s  table %8.0f/s  (%.2fx)"
+            % (a[0], a[1], b[0], b[1], f, t, t / f)
+        )
+
+def bench_fixed_n(n=10000, seed=1):
+    """Compares values per second of Fixed's scalar methods against
+    their batch (_n) counterparts, which give the same results."""
+    rnd = random.Random(seed)
+    angles = [Fixed(rnd.randint(-Fixed.PiBits * 2, Fixed.PiBits * 2)) for i in range(n)]
+    pos = [Fixed(rnd.randint(1, 1000 << Fixed.BITS)) for i in range(n)]
+    small = [Fixed(rnd.randint(-(10 << Fixed.BITS), 10 << Fixed.BITS)) for i in range(n)]
+    cases = [
+        ("sin", angles, lambda x: x.sin(), Fixed.sin_n),
+        ("cos", angles, lambda x: x.cos(), Fixed.cos_n),
+        ("tan", angles, lambda x: x.tan(), Fixed.tan_n),
+        ("atan2", angles, lambda x: x.atan2(small[0]), lambda v: Fixed.atan2_n(v, small[:1] * len(v))),
+        ("exp", small, lambda x: x.exp(), Fixed.exp_n),
+        ("log", pos, lambda x: x.log(), Fixed.log_n),
+        ("sqrt", pos, lambda x: x.sqrt(), Fixed.sqrt_n),
+        ("pow(x, 0.3)", pos, lambda x: x.pow(Fixed.v("0.3")), lambda v: Fixed.pow_n(v, Fixed.v("0.3"))),
+    ]
+    for name, values, scalar, batch in cases:
+        t = time.perf_counter()
+        expected = [scalar(x) for x in values]
+        s = n / (time.perf_counter() - t)
+        t = time.perf_counter()
+        got = batch(values)
+        b = n / (time.perf_counter() - t)
+        if [x.value for x in got] != [x.value for x in expected]:
+            raise ValueError(name + ": results differ")
+        print("Fixed.%-12s scalar %10.0f/s  batch %10.0f/s  (%.2fx)" % (name, s, b, b / s))
+
+def check_adaptive_logconcave(n=20000, seed=1):
+    """Checks the mean and standard deviation of AdaptiveLogConcaveSampler
+    for densities whose tangent hull climbs far above the starting
+    points: a narrow normal and a steep truncated exponential."""
+    sigma = 0.03
+    rate = 5.0
+    cases = [
+        (
+            "normal(0, %g)" % (sigma),
+            lambda rng: logconcave.AdaptiveLogConcaveSampler(
+                lambda x: -x * x / (2 * sigma * sigma),
+                lambda x: -x / (sigma * sigma),
+                rng=rng,
+            ),
+            0,
+            sigma,
+        ),
+        (
+            "exp(%g*x) on [0, 600]" % (rate),
+            lambda rng: logconcave.AdaptiveLogConcaveSampler(
+                lambda x: rate * x, lambda x: rate, mn=0, mx=600, rng=rng
+            ),
+            600 - 1 / rate,
+            1 / rate,
+        ),
+    ]
+    for name, make, mean, sd in cases:
+        got = make(random.Random(seed)).sample(n)
+        m = sum(got) / n
+        s = math.sqrt(sum((x - m) ** 2 for x in got) / n)
+        if abs(m - mean) > 5 * sd / math.sqrt(n) or abs(s / sd - 1) > 0.05:
+            raise ValueError("AdaptiveLogConcaveSampler %s: wrong moments" % (name))
+    print("AdaptiveLogConcaveSampler with steep hulls: OK")
+
+def bench_logconcave(n=100000):
+    """Compares variates per second of the log-concave samplers
+    one at a time against their NumPy batch mode (if NumPy is
+    installed)."""
+    if logconcave.numpy == None:
+        print("logconcave: NumPy not installed")
+        return
+    cases = [
+        ("NormalDist(0, 1)", logconcave.NormalDist(0, 1)),
+        ("GammaDist(3)", logconcave.GammaDist(3)),
+        ("GenInvGaussian(2, 1.5)", logconcave.GenInvGaussian(2, 1.5)),
+    ]
+    for name, dist in cases:
+        t = time.perf_counter()
+        dist.sample(n)
+        b = n / (time.perf_counter() - t)
+        logconcave.numpy = None
+        try:
+            t = time.perf_counter()
+            dist.sample(n // 10)
+            s = (n // 10) / (time.perf_counter() - t)
+        finally:
+            logconcave.numpy = sys.modules["numpy"]
+        print("%-24s scalar %10.0f/s  batch %10.0f/s  (%.2fx)" % (name, s, b, b / s))
+
+def bench_moore(bisections=200):
+    """Compares the time MooreSampler takes to refine its boxes with
+    and without compiling the PDF, which gives the same boxes."""
+    cases = [
+        ("normal", lambda x: (-(x * x) / 2).exp(60), -4, 4),
+        ("gamma(2)", lambda x: x * (-x / 2).exp(60), 0, 20),
+        (
+            "normal 2-D",
+            lambda v: (-(v[0] * v[0]) / 2).exp(60) * (-(v[1] * v[1]) / 2).exp(60),
+            [-3, -3],
+            [3, 3],
+        ),
+    ]
+    for name, pdf, mn, mx in cases:
+        times = []
+        weights = []
+        for compilePdf in [False, True]:
+            t = time.perf_counter()
+            sampler = MooreSampler(pdf, mn, mx, compilePdf=compilePdf)
+            for i in range(bisections):
+                sampler._bisect()
+            times.append(time.perf_counter() - t)
+            weights.append(sampler.weights)
+        if weights[0] != weights[1]:
+            raise ValueError(name + ": boxes differ")
+        print(
+            "MooreSampler %-12s direct %7.3f s  compiled %7.3f s  (%.2fx)"
+            % (name, times[0], times[1], times[0] / times[1])
+        )
+
+def _entropy(probs):
+    # Shannon entropy, in bits, of a discrete distribution
+    return -sum(p * math.log2(p) for p in probs if p > 0)
+
+def bench_entropy(n=10000, seed=1, jsonfile=None):
+    """Runs the main samplers 'n' times each and reports the random bits
+    they consume per variate, the entropy of their output (the least
+    number of bits per variate any exact sampler can use on average),
+    the ratio of the two, and variates per second.  Returns the results
+    as a list of dictionaries, and also writes them as JSON to
+    'jsonfile' if given."""
+    rg = RandomGen(random.Random(seed))
+    # Output entropies.  For the samplers with continuous output
+    # (rounded to 16 fractional bits), 16 plus the differential
+    # entropy in bits is accurate enough.
+    binom = [math.comb(20, k) * 0.3 ** k * 0.7 ** (20 - k) for k in range(21)]
+    pois = [math.exp(-3 + k * math.log(3) - math.lgamma(k + 1)) for k in range(100)]
+    ent = DiceEnterprise()
+    ent.append_poly(1, [[math.sqrt(2), 3]])
+    ent.append_poly(0, [[-5, 3], [11, 2], [-9, 1], [3, 0]])
+    ent.bern.r = random.Random(seed)
+    coin = lambda: rg.zero_or_one(3, 5)
+    entq = ent._calcprob(0.6)
+    cases = [
+        ("zero_or_one(3, 7)", rg, lambda: rg.zero_or_one(3, 7), _entropy([3 / 7, 4 / 7])),
+        (
+            "exprandnew+exprandfill(16)",
+            rg,
+            lambda: rg.exprandfill(rg.exprandnew(), 16),
+            16 + math.log2(math.e),
+        ),
+        ("binomial(20, 0.3)", rg, lambda: rg.binomial(20, 0.3), _entropy(binom)),
+        ("poisson(3)", rg, lambda: rg.poisson(3), _entropy(pois)),
+        (
+            "psrn_add+psrn_fill(16)",
+            rg,
+            lambda: psrn_fill(rg, psrn_add(rg, psrn_new_01(), psrn_new_01()), precision=16),
+            16 + 0.5 / math.log(2),
+        ),
+        # Counts the input coin's bits as well as the
+        # Dice Enterprise object's own bits
+        ("DiceEnterprise.next", ent.bern, lambda: ent.next(coin), _entropy([entq, 1 - entq])),
+    ]
+    results = []
+    for name, gen, func, bound in cases:
+        rg.resetstats()
+        gen.resetstats()
+        t = time.perf_counter()
+        for i in range(n):
+            func()
+        elapsed = time.perf_counter() - t
+        bits = rg.bitsconsumed() + (gen.bitsconsumed() if gen != rg else 0)
+        r = {
+            "sampler": name,
+            "variates": n,
+            "bitspervariate": bits / n,
+            "entropybound": bound,
+            "efficiency": bound / (bits / n) if bits > 0 else 0,
+            "variatespersec": n / elapsed,
+        }
+        results.append(r)
+        print(
+            "%-28s bits/variate %9.3f  bound %8.3f  (%5.1f%%)  %10.0f/s"
+            % (name, r["bitspervariate"], bound, r["efficiency"] * 100, r["variatespersec"])
+        )
+    if jsonfile != None:
+        with open(jsonfile, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+if __name__ == "__main__":
+    bench_bitpool()
+    bench_batch()
+    check_weighted_choice_n()
+    bench_dynamic()
+    bench_binomial_many()
+    bench_zero_or_one()
+    bench_betatable()
+    bench_fixed_n()
+    check_adaptive_logconcave()
+    bench_logconcave()
+    bench_moore()
+    # Optional argument: file to write the entropy results to as JSON
+    bench_entropy(jsonfile=sys.argv[1] if len(sys.argv) > 1 else None)
@@ -11,11 +11,28 @@ https://creativecommons.org/publicdomain/zero/1.0/
 
 # TODO: Use betadist's PSRN methods here somehow
 
+import array
+import bisect
+import collections
+import concurrent.futures
+import hashlib
 import math
+import mmap
+import os
 import random
+import struct
+import sys
+import tempfile
+from bitsource import BitSource, FractionDigits, _FIRSTZERO
+from instrument import Instrumented
 from fractions import Fraction
 from betadist import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 _SIGBITS = 53
 _FLOAT_MAX = 1.7976931348623157e308
 
@@ -122,6 +139,10 @@ class VoseAlias:
         self.total = ms
         self.prob = prob
         self.alias = alias
+        # Integer weights give integer probabilities; otherwise
+        # the total can be a whole number while the
+        # probabilities are not
+        self.intweights = all(int(w) == w for w in weights)
 
     def next(self, randgen):
         d = randgen.rndintexc(len(self.prob))
@@ -130,7 +151,7 @@ class VoseAlias:
             return d
         tsample = (
             randgen.rndintexc(self.total)
-            if int(self.total) == self.total
+            if self.intweights
             else randgen.rndrangemaxexc(0, self.total)
         )
         return d if tsample < self.prob[d] else da
@@ -268,7 +289,7 @@ class FastLoadedDiceRoller:
         for i in range(len(self.leavesAndLabels)):
             if i > 0:
                 ret += ", "
-            ret += "%s" % (str(self.leavesAndLabels[i]),)
+            ret += "%s" % (str(list(self.leavesAndLabels[i])),)
         ret += "]\n\n"
         ret += "def " + name + "():\n"
         if self.n <= 1:
@@ -594,9 +615,112 @@ class OptimalSampler:
             b.append(xy)
         return [b, l, len(m) if rejectionEvent >= 0 else -1]
 
+class DynamicWeightedSampler:
+    """
+    Implements a sampler which chooses a random number in [0, n)
+    where the probability that each number is chosen is weighted,
+    and where weights can be added, removed, and changed between
+    samples without rebuilding the sampler.  The weights are kept
+    in a Fenwick tree (binary indexed tree) of partial sums, so
+    that each update and each sample takes O(log n) time.  This
+    sampler supports only integer weights, which it handles
+    exactly.
+    - weights: List of initial weights, each 0 or greater.
+      Default is an empty list.
+
+    Reference: Fenwick, P.M., "A new data structure for cumulative
+    frequency tables", Software: Practice and Experience 24(3), 1994.
+    """
+
+    def __init__(self, weights=None):
+        weights = [] if weights == None else weights
+        self.n = len(weights)
+        self.weights = [self._checkweight(w) for w in weights]
+        # 1-based tree of partial sums, built in linear time
+        self.tree = [0] + self.weights
+        for i in range(1, self.n + 1):
+            parent = i + (i & -i)
+            if parent <= self.n:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(self.weights)
+
+    def _checkweight(self, weight):
+        if int(weight) != weight:
+            raise ValueError("Weight is not an integer")
+        if weight < 0:
+            raise ValueError("Weight is negative")
+        return int(weight)
+
+    def _add(self, index, delta):
+        i = index + 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+        self.total += delta
+
+    def _prefix(self, i):
+        # Sum of the first i weights
+        ret = 0
+        while i > 0:
+            ret += self.tree[i]
+            i -= i & -i
+        return ret
+
+    def __len__(self):
+        return self.n
+
+    def weight(self, index):
+        """ Gets the weight of the number 'index'. """
+        return self.weights[index]
+
+    def insert(self, weight):
+        """Adds a number with the given weight and returns
+        that number, which is the previous count of numbers."""
+        weight = self._checkweight(weight)
+        i = self.n + 1
+        # The new node covers the weights in
+        # (i - lowbit(i), i]
+        self.tree.append(weight + self._prefix(i - 1) - self._prefix(i - (i & -i)))
+        self.weights.append(weight)
+        self.n = i
+        self.total += weight
+        return i - 1
+
+    def update(self, index, weight):
+        """ Sets the weight of the number 'index'. """
+        weight = self._checkweight(weight)
+        if index < 0 or index >= self.n:
+            raise ValueError
+        self._add(index, weight - self.weights[index])
+        self.weights[index] = weight
+
+    def delete(self, index):
+        """Removes the number 'index' from the choices.  The number keeps
+        its place, with a weight of 0, so that other numbers don't
+        change; it can be given a weight again with 'update'."""
+        self.update(index, 0)
+
+    def next(self, randgen):
+        if self.total <= 0:
+            raise ValueError("Sum of weights is zero")
+        v = randgen.rndintexc(self.total)
+        # Find the first number whose prefix sum exceeds v,
+        # by descending the tree
+        pos = 0
+        step = 1 << (self.n.bit_length() - 1)
+        tree = self.tree
+        while step > 0:
+            nxt = pos + step
+            if nxt <= self.n and tree[nxt] <= v:
+                pos = nxt
+                v -= tree[nxt]
+            step >>= 1
+        return pos
+
 class _BinomialAliasTable:
-    def __init__(self, aliases, entries, n):
+    def __init__(self, aliases, entries, n, dice=None):
         self.aliases = aliases
+        self.aliasentries = entries
         if len(entries) != len(aliases):
             raise ValueError
         if aliases[len(aliases) - 1] != -1:
@@ -610,7 +734,9 @@ class _BinomialAliasTable:
         self.entrymap = None
         # self.entrymap={}
         # for i in range(len(aliases)): self.entrymap[aliases[i]]=entries[i]
-        self.entries = FastLoadedDiceRoller(entries)
+        # 'dice', if given, is a FastLoadedDiceRoller already built
+        # for 'entries' (such as one loaded by AliasTableCache)
+        self.entries = FastLoadedDiceRoller(entries) if dice == None else dice
 
     def _bitcount(self, x):
         r = 0
@@ -689,11 +815,17 @@ class _BinomialAliasTable:
 
 class PascalTriangle:
     """Generates the rows of Pascal's triangle, or the
-    weight table for a binomial(n,1/2) distribution."""
+    weight table for a binomial(n,1/2) distribution.
+    'cache', if given, is an AliasTableCache (or the path of its
+    directory) that 'aliasinfo' loads alias tables from and
+    saves them to."""
 
-    def __init__(self):
+    def __init__(self, cache=None):
         self.table = []
         self.rownumber = 0
+        if cache != None and not isinstance(cache, AliasTableCache):
+            cache = AliasTableCache(cache)
+        self.cache = cache
 
     def row(self):
         """Gets the row number of the row that will be generated
@@ -835,11 +967,20 @@ class PascalTriangle:
         return _BinomialAliasTable(aliases, aliasentries, n)
 
     def aliasinfo(self, desiredRow):
-        r = self.getrow(desiredRow)
         if desiredRow <= 16:
             # Use simple alias table to avoid overhead
-            return FastLoadedDiceRoller(r)
-        return self._buildAliasTable2(r[desiredRow // 2], desiredRow)
+            return FastLoadedDiceRoller(self.getrow(desiredRow))
+        if self.cache != None:
+            table = self.cache.get(desiredRow)
+            if table != None:
+                return table
+        # Only the middle entry of the row is needed
+        table = self._buildAliasTable2(
+            math.comb(desiredRow, desiredRow // 2), desiredRow
+        )
+        if self.cache != None:
+            self.cache.put(desiredRow, table)
+        return table
 
     def nextto(self, desiredRow):
         """Generates the row of Pascal's triangle with the given row number,
@@ -866,6 +1007,137 @@ class PascalTriangle:
         self.rownumber += 1
         return [x for x in self.table]
 
+class AliasTableCache:
+    """A directory of alias tables for binomial(n, 1/2) distributions,
+    as built by PascalTriangle.aliasinfo, so that they need not be
+    rebuilt in every process.  Building the table for a large row
+    (2^20 or more) needs the row's middle entry, a number with about
+    n bits, which takes seconds to minutes; loading it from this cache
+    takes well under a millisecond.
+
+    Each table is stored in its own file, named after its row number,
+    as a versioned header followed by arrays of 64-bit integers in
+    little-endian order.  Files are mapped into memory with 'mmap'
+    rather than read, so that worker processes using the same
+    directory share one copy of each table.  Files are written under a
+    temporary name and then renamed, so that processes warming the same
+    directory at once never see a partly written table.  A file with a
+    different version or an unexpected size is ignored and rebuilt.
+
+    The cache used by RandomGen's binomial samplers is set with
+    RandomGen.setaliascache, or with the RANDOMGEN_ALIASCACHE environment
+    variable (which worker processes inherit).  To build the tables
+    ahead of time, use 'warm', or run aliascache.py."""
+
+    MAGIC = b"RGALIAS\0"
+    VERSION = 1
+    # Magic, version, row number, number of aliases,
+    # and bits per dice roller column
+    _HEADER = struct.Struct("<8sIQQQ")
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, n):
+        """ Gets the name of the file holding the table for row 'n'. """
+        return os.path.join(self.path, "binomial-%d.alias" % (n,))
+
+    def get(self, n):
+        """Loads the alias table for row 'n' from this cache, or
+        returns None if the cache has no valid table for that row."""
+        try:
+            with open(self.filename(n), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        hs = self._HEADER.size
+        if len(mm) < hs:
+            return None
+        magic, version, row, count, bits = self._HEADER.unpack_from(mm, 0)
+        if (
+            magic != self.MAGIC
+            or version != self.VERSION
+            or row != n
+            or count < 2
+            or bits < 1
+            or len(mm) != hs + 8 * (count * 2 + (count + 2) * bits)
+        ):
+            return None
+        view = memoryview(mm)
+        if sys.byteorder == "little":
+            aliases = view[hs : hs + 8 * count].cast("q")
+            entries = view[hs + 8 * count : hs + 16 * count].cast("Q")
+            leaves = view[hs + 16 * count :].cast("q")
+        else:
+            # Copy and swap to native order
+            arrs = []
+            for tc, start, end in [
+                ("q", hs, hs + 8 * count),
+                ("Q", hs + 8 * count, hs + 16 * count),
+                ("q", hs + 16 * count, len(mm)),
+            ]:
+                a = array.array(tc)
+                a.frombytes(view[start:end])
+                a.byteswap()
+                arrs.append(a)
+            aliases, entries, leaves = arrs
+        dice = FastLoadedDiceRoller.__new__(FastLoadedDiceRoller)
+        dice.n = count
+        dice.leavesAndLabels = [
+            leaves[i * bits : (i + 1) * bits] for i in range(count + 2)
+        ]
+        return _BinomialAliasTable(aliases, entries, n, dice=dice)
+
+    def put(self, n, table):
+        """Saves the alias table for row 'n' (a table returned by
+        PascalTriangle.aliasinfo for a row greater than 16) to this
+        cache."""
+        count = len(table.aliases)
+        leaves = table.entries.leavesAndLabels
+        bits = len(leaves[0])
+        data = array.array("q", table.aliases)
+        entries = array.array("Q", table.aliasentries)
+        flat = array.array("q")
+        for row in leaves:
+            flat.extend(row)
+        if sys.byteorder != "little":
+            for a in (data, entries, flat):
+                a.byteswap()
+        fd, tmpname = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            # Readable by other users' worker processes, as
+            # with files created by open()
+            os.chmod(tmpname, 0o644)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._HEADER.pack(self.MAGIC, self.VERSION, n, count, bits))
+                f.write(data.tobytes())
+                f.write(entries.tobytes())
+                f.write(flat.tobytes())
+            os.replace(tmpname, self.filename(n))
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+    def warm(self, rows):
+        """Builds and saves the alias tables for the given row numbers,
+        skipping rows less than 32 (which the binomial samplers never
+        load from a cache), rows for which no alias table can be built
+        (currently some odd rows), and rows already in this cache.
+        Returns the list of rows built."""
+        pascal = PascalTriangle(self)
+        built = []
+        for n in rows:
+            # Rows up to 16 use a simpler table, and alias tables
+            # can't be built for rows 17 through 31
+            if n >= 32 and self.get(n) == None:
+                try:
+                    pascal.aliasinfo(n)
+                except ValueError:
+                    continue
+                built.append(n)
+        return built
+
 class _FractionBinaryExpansion:
     def __init__(self, frac):
         self.frac = frac
@@ -1045,7 +1317,118 @@ class BinaryExpansion:
         """ Resets this object to the first bit in the binary expansion. """
         self.index = 0
 
-class RandomGen:
+class _WeightTable:
+    # Prepared form of a list of weights, as cached by
+    # RandomGen._weighted_choice_n.  Holds the prefix sums
+    # of the weights, which are searched by bisection, and
+    # once enough numbers were sampled from it, a
+    # FastLoadedDiceRoller, BringmannLarsen, or VoseAlias
+    # sampler.
+    def __init__(self, weights):
+        self.n = len(weights)
+        self.prefix = []
+        total = 0
+        negweights = False
+        self.intweights = True
+        for w in weights:
+            negweights = negweights or w < 0
+            if int(w) != w:
+                self.intweights = False
+            total += w
+            self.prefix.append(total)
+        self.total = total
+        self.canalias = not negweights and total > 0
+        self.sampler = None
+        self.draws = 0
+        self.weights = weights
+
+    def prepare(self):
+        weights = self.weights
+        if not self.intweights:
+            self.sampler = VoseAlias(weights)
+        elif (
+            self.n >= 4096
+            and self.total >= (1 << 19) * self.n
+            and max(weights) * self.n <= self.total * 2
+        ):
+            # Many large, nearly equal integer weights:
+            # BringmannLarsen then stores the weights as is and
+            # accepts at least half of its uniform proposals,
+            # avoiding the bigger setup of the other samplers
+            self.sampler = BringmannLarsen(weights)
+        else:
+            self.sampler = FastLoadedDiceRoller(weights)
+        self.weights = None
+
+    def next(self, randgen):
+        if self.sampler != None:
+            return self.sampler.next(randgen)
+        value = (
+            randgen.rndintexc(self.total)
+            if self.intweights
+            else randgen.rndrangemaxexc(0, self.total)
+        )
+        # First index whose prefix sum exceeds the value;
+        # items with zero weight are never chosen
+        return min(bisect.bisect_right(self.prefix, value), self.n - 1)
+
+class _BinomialCdfTable:
+    # Prepared form of a binomial(trials, p) distribution where
+    # p = a/2^e, as cached by RandomGen.binomial_many.  Holds the
+    # cumulative weights C(trials,j)*a^j*(2^e-a)^(trials-j), summed
+    # over j < k, which add up to 2^(e*trials), as well as the top
+    # 64 bits of each of them.  A variate is found by inversion from
+    # the top 64 bits of a uniform number; the remaining bits are
+    # drawn only when those 64 bits don't settle the variate.
+    def __init__(self, trials, a, e):
+        self.bits = e * trials
+        self.shift = max(0, self.bits - 64)
+        cum = [0]
+        q = (1 << e) - a
+        w = q ** trials
+        total = 0
+        for j in range(trials + 1):
+            total += w
+            cum.append(total)
+            # Exact, since the next weight is an integer
+            w = w * (trials - j) * a // ((j + 1) * q)
+        self.cum = cum
+        # The last cumulative weight, 2^bits, is left out; its
+        # top 64 bits wouldn't fit in the array
+        self.top = array.array("Q", [cum[i] >> self.shift for i in range(trials + 1)])
+
+    def next(self, randgen):
+        if self.shift == 0:
+            return bisect.bisect_right(self.cum, randgen.randbits(self.bits)) - 1
+        r = randgen.randbits(64)
+        k = bisect.bisect_right(self.top, r) - 1
+        if self.top[k] < r:
+            # The whole interval [r, r+1)*2^shift lies between
+            # cum[k] and cum[k+1]
+            return k
+        u = (r << self.shift) | randgen.randbits(self.shift)
+        return bisect.bisect_right(self.cum, u) - 1
+
+    def next_n(self, randgen, n):
+        # Same as 'n' calls to next, but draws the top 64
+        # bits of the uniform numbers in bulk
+        words = randgen._randwords(n)
+        cum = self.cum
+        br = bisect.bisect_right
+        if self.shift == 0:
+            dropbits = 64 - self.bits
+            return [br(cum, w >> dropbits) - 1 for w in words]
+        top = self.top
+        shift = self.shift
+        ret = []
+        for r in words:
+            k = br(top, r) - 1
+            if top[k] >= r:
+                k = br(cum, (r << shift) | randgen.randbits(shift)) - 1
+            ret.append(k)
+        return ret
+
+class RandomGen(Instrumented):
     """A class that implements many methods for
     random number generation and sampling.  It takes
     an underlying RNG as specified in the constructor."""
@@ -1063,24 +1446,55 @@ class RandomGen:
         needed at once.  Ways to improve the performance
         of generating many random numbers at once include
         vectorization (which is often PRNG specific) and multithreading
-        (which is too complicated to show here)."""
-        if rng == None:
-            self.rng = random.Random()
+        (which is too complicated to show here).  Some methods have
+        a batch counterpart ending in '_n' (such as 'rndint_n' and
+        'normal_n') that generates many random numbers at once.
+        3. If 'rng' also implements a 'getrandbits(k)' method (as
+        Python's 'random.Random' does), random bits are drawn from
+        it in large blocks rather than one word at a time.
+        'rng' can also be a bitsource.BitSource, which can be shared
+        with other random generators (such as bernoulli.Bernoulli)
+        so that they all draw from one bitstream.
+        The 'totalbits' attribute counts the random bits consumed
+        by this instance's sampling methods; see also the methods
+        inherited from instrument.Instrumented, such as 'instrument'
+        and 'stats'."""
+        if isinstance(rng, BitSource):
+            self.bits = rng
         else:
-            self.rng = rng
-        self.bitcount = 63
-        self.curbit = 0
-
-    def randbits(self, count):
-        return self.rndintexc(1 << count)
+            self.bits = BitSource(rng)
+        self.rng = self.bits.rng
+        # Number of random bits consumed so far
+        self.totalbits = 0
+        # LRU cache of prepared weight tables used by
+        # weighted_choice_n, keyed by weight tuple
+        self.weightcachesize = 64
+        self._weightcache = collections.OrderedDict()
+        self._weightcachehits = 0
+        self._weightcachemisses = 0
+
+    def _randwords(self, count):
+        # Takes 'count' whole 64-bit words from the bit
+        # source, as an array.array('Q')
+        self.totalbits += count * 64
+        return self.bits.words(count)
+
+    def _batcharray(self, values, typecode):
+        # Converts the results of a batch method to a NumPy
+        # array if NumPy is available, or to an array.array
+        # otherwise
+        if numpy != None:
+            return numpy.array(values, dtype="int64" if typecode == "q" else "float64")
+        return array.array(typecode, values)
 
     def randbit(self):
-        if self.bitcount >= 63:
-            self.bitcount = 0
-            self.curbit = self.rng.randint(0, (1 << 63) - 1)
-        ret = self.curbit & 1
-        self.curbit >>= 1
-        self.bitcount += 1
+        self.totalbits += 1
+        return self.bits.randbit()
+
+    def randbits(self, n):
+        """ Generates an n-bit random integer. """
+        ret = self.bits.randbits(n)
+        self.totalbits += n
         return ret
 
     def rndint_fastdiceroller(self, maxInclusive):
@@ -1090,17 +1504,24 @@ class RandomGen:
             return 0
         if maxInclusive == 1:
             return self.randbit()
-        # Lumbroso's fast dice roller method
+        # Lumbroso's fast dice roller method, drawing
+        # several bits at a time.  Invariant: y is uniform
+        # in [0, x).  Enough bits are drawn at once for x to
+        # exceed maxInclusive; y is accepted if it falls in one
+        # of the complete blocks of maxInclusive+1 values below x,
+        # and otherwise the leftover range is kept and extended.
+        m = maxInclusive + 1
         x = 1
         y = 0
         while True:
-            x = x * 2
-            y = y * 2 + self.randbit()
-            if x > maxInclusive:
-                if y <= maxInclusive:
-                    return y
-                x = x - maxInclusive - 1
-                y = y - maxInclusive - 1
+            k = (maxInclusive // x).bit_length()
+            x <<= k
+            y = (y << k) | self.randbits(k)
+            q = x // m
+            if y < q * m:
+                return y % m
+            x -= q * m
+            y -= q * m
 
     def rndint(self, maxInclusive):
         if maxInclusive < 0:
@@ -1109,6 +1530,9 @@ class RandomGen:
             return 0
         if maxInclusive == 1:
             return self.randbit()
+        if maxInclusive & (maxInclusive + 1) == 0:
+            # Power of 2 minus 1
+            return self.randbits(maxInclusive.bit_length())
         return self.rndint_fastdiceroller(maxInclusive)
 
     def rndintexc(self, maxExclusive):
@@ -1116,6 +1540,39 @@ class RandomGen:
             raise ValueError("maxExclusive 0 or less")
         return self.rndint(maxExclusive - 1)
 
+    def rndint_n(self, maxInclusive, n=1):
+        """Generates 'n' uniform random integers in [0, maxInclusive]
+        at once.  Returns an array (see rndu01_n), except that
+        a list is returned if maxInclusive is 2^63 or greater."""
+        if maxInclusive < 0:
+            raise ValueError("maxInclusive less than 0")
+        if maxInclusive >= (1 << 63):
+            return [self.rndint(maxInclusive) for i in range(n)]
+        if maxInclusive == 0:
+            return self._batcharray([0] * n, "q")
+        m = maxInclusive + 1
+        # Draw fixed-width words in bulk and reject those
+        # in the incomplete block of m values at the top,
+        # so every accepted word is uniform in [0, m)
+        width = 8
+        while (1 << width) < m * 2:
+            width *= 2
+        typecode = [t for t in "BHILQ" if array.array(t).itemsize * 8 == width][0]
+        lim = ((1 << width) // m) * m
+        ret = []
+        while len(ret) < n:
+            # Expected acceptance rate is at least 1/2
+            need = (n - len(ret)) * 2 + 8
+            words = array.array(typecode)
+            words.frombytes(self._randwords((need * width + 63) // 64).tobytes())
+            if m & (m - 1) == 0:
+                ret.extend(v & maxInclusive for v in words)
+            else:
+                ret.extend(v % m for v in words if v < lim)
+        del ret[n:]
+        return self._batcharray(ret, "q")
+
+
     def rndintrange(self, minInclusive, maxInclusive):
         # NOTE: Since Python integers are arbitrary-precision,
         # the naive approach will work well here
@@ -1124,10 +1581,6 @@ class RandomGen:
     def rndintexcrange(self, minInclusive, maxExclusive):
         return minInclusive + self.rndint(maxExclusive - minInclusive - 1)
 
-    def randbits(self, n):
-        """ Generates an n-bit random integer. """
-        return self.rndint((1 << n) - 1)
-
     def rndu01(self):
         e = -_SIGBITS
         while True:
@@ -1142,6 +1595,35 @@ class RandomGen:
         # NOTE: Multiply by 1.0 to coerce to floating-point
         return sig * 1.0 * (2.0 ** e)
 
+    def rndu01_n(self, n=1):
+        """Generates 'n' uniform random numbers in [0, 1] at once,
+        with the same distribution as rndu01.  Returns a NumPy
+        array if NumPy is installed, or an array.array otherwise."""
+        words = self._randwords(n * 2)
+        ret = [0.0] * n
+        mask = (1 << (_SIGBITS - 1)) - 1
+        for i in range(n):
+            g = words[i * 2]
+            e = -_SIGBITS
+            while g == 0:
+                # All 64 bits zero; keep counting zeros
+                e -= 64
+                g = self._randwords(1)[0]
+            e -= (g & -g).bit_length() - 1
+            s = words[i * 2 + 1]
+            sig = s & mask
+            if sig == 0 and (s >> (_SIGBITS - 1)) & 1 == 0:
+                e += 1
+            ret[i] = math.ldexp(sig + (1 << (_SIGBITS - 1)), e)
+        return self._batcharray(ret, "d")
+
+    def _rndu01zeroexc_n(self, n):
+        # List of n uniform random numbers in (0, 1]
+        ret = [x for x in self.rndu01_n(n) if x != 0.0]
+        while len(ret) < n:
+            ret.extend(x for x in self.rndu01_n(n - len(ret)) if x != 0.0)
+        return ret
+
     def rndu01oneexc(self):
         while True:
             ret = self.rndu01()
@@ -1161,8 +1643,8 @@ class RandomGen:
                 return ret
 
     def _rndrangehelper(self, lo, hi):
-        losgn = -1 if lo < 0 else 0
-        hisgn = -1 if hi < 0 else 0
+        losgn = -1 if lo < 0 else (1 if lo > 0 else 0)
+        hisgn = -1 if hi < 0 else (1 if hi > 0 else 0)
         loexp = self._fpExponent(lo)
         hiexp = self._fpExponent(hi)
         losig = self._fpSignificand(lo)
@@ -1174,7 +1656,7 @@ class RandomGen:
         if losgn == -1 and hisgn == 1:
             mabs = max(abs(lo), abs(hi))
             while True:
-                ret = self.rndrangehelper(0, mabs)
+                ret = self._rndrangehelper(0, mabs)
                 neg = self.rndint(1)
                 if neg == 0:
                     ret = -ret
@@ -1183,26 +1665,26 @@ class RandomGen:
         if lo == hi:
             return lo
         if losgn == -1:
-            return -rndrangehelper(abs(lo), abs(hi))
+            return -self._rndrangehelper(abs(hi), abs(lo))
         expdiff = hiexp - loexp
         if loexp == hiexp:
-            s = RNDINTRANGE(losig, hisig)
+            s = self.rndintrange(losig, hisig)
             return s * 1.0 * pow(2, loexp)
         while True:
             ex = hiexp
-            while ex > MINEXP:
+            while ex > self.MINEXPONENT:
                 v = self.rndint(2 - 1)
                 if v == 0:
                     ex = ex - 1
                 else:
                     break
             s = 0
-            if ex == MINEXP:
-                s = self.rndint(2 ** FPPRECISION - 1)
+            if ex == self.MINEXPONENT:
+                s = self.rndint(2 ** self.FPPRECISION - 1)
             else:
-                sm = 2 ** (FPPRECISION - 1)
+                sm = 2 ** (self.FPPRECISION - 1)
                 s = self.rndint(sm - 1) + sm
-            ret = s * 1.0 * FPRADIX ** (ex)
+            ret = s * 1.0 * self.FPRADIX ** (ex)
             if ret >= lo and ret <= hi:
                 return ret
 
@@ -1404,21 +1886,36 @@ class RandomGen:
             if numsum > 0:
                 return [(p / numsum) * sum for p in nums]
 
-    def zero_or_one(self, px, py):
-        """ Returns 1 at probability px/py, 0 otherwise. """
-        if py <= 0:
-            raise ValueError
-        if px == py:
-            return 1
-        z = px
-        while True:
-            z = z * 2
-            if z >= py:
-                if self.randbit() == 0:
-                    return 1
-                z = z - py
-            elif z == 0 or self.randbit() == 0:
-                return 0
+    def zero_or_one(self, px, py=None):
+        """Returns 1 at probability px/py, 0 otherwise.  'px' can
+        instead be a bitsource.FractionDigits (with 'py' omitted),
+        which is faster if the same fraction is used many times.
+        See bitsource.BitSource.zero_or_one."""
+        b = self.bits
+        bc = b.bitcount
+        if bc >= 8:
+            # Fast path: the result is decided by the next 8 bits
+            if py == None:
+                e = px.table[b.curbit & 255]
+                if e != 0:
+                    k = e >> 1
+                    b.curbit >>= k
+                    b.bitcount = bc - k
+                    self.totalbits += k
+                    return e & 1
+            elif 0 < px < py and isinstance(px, int) and isinstance(py, int):
+                k = _FIRSTZERO[b.curbit & 255]
+                if k != 0:
+                    # Remainder after the first k-1 digits of px/py
+                    r = (px << (k - 1)) % py
+                    if r != 0:
+                        b.curbit >>= k
+                        b.bitcount = bc - k
+                        self.totalbits += k
+                        return 1 if (r << 1) >= py else 0
+        ret, used = b._zero_or_one(px, py)
+        self.totalbits += used
+        return ret
 
     def bernoulli(self, p):
         """ Returns 1 at probability p, 0 otherwise. """
@@ -1438,46 +1935,52 @@ class RandomGen:
     def weighted_choice_n(self, weights, n=1):
         return self._weighted_choice_n(weights, n, 0)
 
+    def weightcachestats(self):
+        """Returns a dictionary with statistics on the cache of
+        prepared weight tables used by weighted_choice,
+        weighted_choice_n and binomial_many: 'hits', 'misses', 'size' (number of
+        cached tables) and 'maxsize' (the 'weightcachesize'
+        attribute)."""
+        return {
+            "hits": self._weightcachehits,
+            "misses": self._weightcachemisses,
+            "size": len(self._weightcache),
+            "maxsize": self.weightcachesize,
+        }
+
+    def clearweightcache(self):
+        """Empties the cache of prepared weight tables and resets
+        its statistics."""
+        self._weightcache.clear()
+        self._weightcachehits = 0
+        self._weightcachemisses = 0
+
+    def _weighttable(self, weights):
+        key = tuple(weights)
+        table = self._weightcache.get(key)
+        if table != None:
+            self._weightcachehits += 1
+            self._weightcache.move_to_end(key)
+            return table
+        self._weightcachemisses += 1
+        table = _WeightTable(key)
+        if self.weightcachesize > 0:
+            self._weightcache[key] = table
+            while len(self._weightcache) > self.weightcachesize:
+                self._weightcache.popitem(last=False)
+        return table
+
     def _weighted_choice_n(self, weights, n, addvalue):
         if len(weights) == 0:
             raise ValueError
-        msum = 0
-        i = 0
-        negweights = False
-        nonintweights = False
-        while i < len(weights):
-            negweights = negweights or weights[i] < 0
-            if int(weights[i]) != weights[i]:
-                nonintweights = True
-            msum += weights[i]
-            i += 1
-        if n > 100 and not negweights and not nonintweights:
-            aliasinfo = FastLoadedDiceRoller(weights)
-            return [aliasinfo.next(self) for k in range(n)]
-        ret = [0 for k in range(n)]
-        rv = [
-            randgen.rndintexc(msum)
-            if not nonintweights
-            else randgen.rndrangemaxexc(0, msum)
-            for k in range(n)
-        ]
-        k = 0
-        while k < n:
-            value = rv[k]
-            i = 0
-            lastItem = len(weights) - 1
-            runningValue = 0
-            while i < len(weights):
-                if weights[i] > 0:
-                    newValue = runningValue + weights[i]
-                    lastItem = i
-                    if value < newValue:
-                        break
-                    runningValue = newValue
-                i += 1
-            ret[k] = lastItem + addvalue
-            k += 1
-        return ret
+        table = self._weighttable(weights)
+        # Build an alias-style sampler once enough numbers
+        # were sampled from these weights, counting
+        # earlier calls with the same weights
+        table.draws += n
+        if table.sampler == None and table.canalias and table.draws > 100:
+            table.prepare()
+        return [table.next(self) + addvalue for k in range(n)]
 
     def weighted_choice_inclusion(self, weights, n):
         """
@@ -1603,6 +2106,25 @@ class RandomGen:
                 if b * b <= -4 * a * a * math.log(a):
                     return (b * sigma / a) + mu
 
+    def normal_n(self, mu=0.0, sigma=1.0, n=1):
+        """Generates 'n' normally-distributed random numbers at once,
+        using the same ratio-of-uniforms method as 'normal'.
+        Returns an array (see rndu01_n)."""
+        bmp = 0.8577638849607068  # sqrt(2/exp(1))
+        ret = []
+        while len(ret) < n:
+            # Acceptance rate is about 0.73
+            need = (n - len(ret)) * 11 // 8 + 8
+            av = self._rndu01zeroexc_n(need)
+            bv = self.rndu01_n(need)
+            for i in range(need):
+                a = av[i]
+                b = (bv[i] * 2 - 1) * bmp
+                if b * b <= -4 * a * a * math.log(a):
+                    ret.append((b * sigma / a) + mu)
+        del ret[n:]
+        return self._batcharray(ret, "d")
+
     def lognormal(self, mu=0.0, sigma=0.0):
         return math.exp(self.normal(mu, sigma))
 
@@ -1635,7 +2157,18 @@ class RandomGen:
         return x / (x + self.gamma(b))
 
     _aliastables = {}
-    _pascal = PascalTriangle()
+    _pascal = PascalTriangle(os.environ.get("RANDOMGEN_ALIASCACHE") or None)
+
+    @staticmethod
+    def setaliascache(cache):
+        """Sets the AliasTableCache (or the path of its directory) from
+        which the binomial samplers of all RandomGen objects load the
+        alias tables they use for large numbers of trials, or stops
+        using such a cache if 'cache' is None.  By default, the
+        directory named by the RANDOMGEN_ALIASCACHE environment
+        variable, if set, is used."""
+        RandomGen._pascal = PascalTriangle(cache)
+        RandomGen._aliastables.clear()
 
     def _getaliastable(self, n):
         if n in self._aliastables:
@@ -1679,6 +2212,85 @@ class RandomGen:
             pt /= 2
         return count
 
+    def binomial_n(self, trials, p, n=1):
+        """Generates 'n' binomial random numbers at once.
+        Returns an array (see rndu01_n)."""
+        if p == 0.5 and trials > 0 and trials <= 64:
+            # Count the set bits of 'trials'-bit words
+            mask = (1 << trials) - 1
+            return self._batcharray(
+                [bin(w & mask).count("1") for w in self._randwords(n)], "q"
+            )
+        return self._batcharray(self.binomial(trials, p, n), "q")
+
+    def binomial_many(self, ns, ps):
+        """Generates binomial random numbers for many pairs of
+        parameters at once: the i-th number has 'ns[i]' trials
+        and success probability 'ps[i]'.  Requests with the same
+        parameters are grouped together and share their setup;
+        for probabilities with a power-of-two denominator (such as
+        any float) and not too many trials, the setup is an
+        inversion table that is kept in the weight cache (see
+        weightcachestats) for later calls.
+        Returns an array (see rndu01_n)."""
+        if len(ns) != len(ps):
+            raise ValueError
+        groups = {}
+        for i in range(len(ns)):
+            # Python numbers, so that NumPy integer arrays
+            # don't overflow in the setup
+            p = ps[i]
+            if not isinstance(p, (int, Fraction)):
+                p = float(p)
+            key = (int(ns[i]), p)
+            g = groups.get(key)
+            if g == None:
+                groups[key] = [i]
+            else:
+                g.append(i)
+        ret = [0 for i in range(len(ns))]
+        for (trials, p), indices in groups.items():
+            count = len(indices)
+            if p == 0.5 and trials > 0 and trials <= 64:
+                values = self.binomial_n(trials, p, count)
+            else:
+                table = self._binomialtable(trials, p, count)
+                if table != None:
+                    values = table.next_n(self, count)
+                else:
+                    values = self._binomial(trials, p, count)
+            for i in range(count):
+                ret[indices[i]] = values[i]
+        return self._batcharray(ret, "q")
+
+    def _binomialtable(self, trials, p, count):
+        # Gets a cached _BinomialCdfTable for binomial(trials, p),
+        # or builds one if it's worth doing for 'count' numbers.
+        # Returns None if the distribution isn't suitable for one.
+        if trials <= 0 or p <= 0 or p >= 1:
+            return None
+        key = ("binomial", trials, p)
+        table = self._weightcache.get(key)
+        if table != None:
+            self._weightcachehits += 1
+            self._weightcache.move_to_end(key)
+            return table
+        pf = Fraction(p)
+        e = pf.denominator.bit_length() - 1
+        if (
+            count < 16
+            or pf.denominator != 1 << e
+            or e * trials > (1 << 14)
+            or self.weightcachesize <= 0
+        ):
+            return None
+        self._weightcachemisses += 1
+        table = _BinomialCdfTable(trials, pf.numerator, e)
+        self._weightcache[key] = table
+        while len(self._weightcache) > self.weightcachesize:
+            self._weightcache.popitem(last=False)
+        return table
+
     def binomial(self, trials, p, n=None):
         if n == None:
             return self._binomial(trials, p, 1)[0]
@@ -1840,6 +2452,60 @@ class RandomGen:
             if p <= pn:
                 return count - 1
 
+    def poisson_n(self, mean, n=1):
+        """Generates 'n' Poisson random numbers at once.
+        Returns an array (see rndu01_n)."""
+        if mean < 0:
+            raise ValueError
+        if mean == 0:
+            return self._batcharray([0] * n, "q")
+        ret = [0] * n
+        means = [mean] * n
+        if mean > 20:
+            # First step of the reduction in 'poisson', done for
+            # all variates at once since they share the same mean
+            m = math.ceil(mean - pow(mean, 0.7))
+            gs = self.gamma_n(m, n=n)
+            for i in range(n):
+                g = gs[i]
+                if g >= mean:
+                    ret[i] = m - 1 - self.binomial(m - 1, (g - mean) / g)
+                    means[i] = 0
+                else:
+                    ret[i] = m
+                    means[i] = mean - g
+                    while means[i] > 20:
+                        m2 = math.ceil(means[i] - pow(means[i], 0.7))
+                        g = self.gamma_n(m2)[0]
+                        if g >= means[i]:
+                            ret[i] += m2 - 1 - self.binomial(m2 - 1, (g - means[i]) / g)
+                            means[i] = 0
+                        else:
+                            means[i] -= g
+                            ret[i] += m2
+        # Multiply uniforms until the product falls to exp(-mean),
+        # taking the uniforms from a prefetched batch
+        us = []
+        ui = 0
+        for i in range(n):
+            if means[i] == 0:
+                continue
+            p = 1.0
+            pn = math.exp(-means[i])
+            count = 0
+            while True:
+                if ui >= len(us):
+                    us = [u for u in self.rndu01_n(int(mean) + 64) if u != 1.0]
+                    ui = 0
+                    continue
+                count += 1
+                p *= us[ui]
+                ui += 1
+                if p <= pn:
+                    break
+            ret[i] += count - 1
+        return self._batcharray(ret, "q")
+
     def rayleigh(self, a):
         """ Generates a random number following a Rayleigh distribution.  """
         return a * math.sqrt(2 * self.exponential())
@@ -1900,6 +2566,45 @@ class RandomGen:
             ret = ret * math.pow(self.rndu01(), 1.0 / mean)
         return ret ** (1.0 / c) * b + d
 
+    def gamma_n(self, mean, b=1.0, c=1.0, d=0.0, n=1):
+        """Generates 'n' gamma-distributed random numbers at once,
+        using the same method as 'gamma'.  Returns an array
+        (see rndu01_n)."""
+        if mean <= 0:
+            raise ValueError
+        if mean == 1:
+            ret = self.exponential_n(1.0, n)
+            if b == 1.0 and c == 1.0 and d == 0.0:
+                return ret
+            return self._batcharray([x ** (1.0 / c) * b + d for x in ret], "d")
+        dd = mean
+        if mean < 1:
+            dd += 1
+        dd -= 1.0 / 3
+        cc = 1.0 / math.sqrt(9 * dd)
+        ret = []
+        while len(ret) < n:
+            need = (n - len(ret)) * 5 // 4 + 8
+            xs = self.normal_n(0, 1, need)
+            us = self._rndu01zeroexc_n(need)
+            for i in range(need):
+                x = xs[i]
+                v = cc * x + 1
+                if v <= 0:
+                    continue
+                v = v * v * v
+                u = us[i]
+                x2 = x * x
+                if u < 1 - (0.0331 * x2 * x2) or math.log(u) < (0.5 * x2) + (
+                    dd * (1 - v + math.log(v))
+                ):
+                    ret.append(dd * v)
+        del ret[n:]
+        if mean < 1:
+            us = self.rndu01_n(n)
+            ret = [ret[i] * math.pow(us[i], 1.0 / mean) for i in range(n)]
+        return self._batcharray([x ** (1.0 / c) * b + d for x in ret], "d")
+
     def cauchy(self):
         return stable(1, 0)
 
@@ -2314,18 +3019,18 @@ class RandomGen:
     def _expovnbits(self, bits=53):
         count = 0
         while True:
-            y1 = psrn_new_01()
+            y1 = PSRN()
             y = y1
             accept = True
             while True:
-                z = psrn_new_01()
+                z = PSRN()
                 if psrn_less(self, y, z) == 0:
                     accept = not accept
                     y = z
                     continue
                 break
             if accept:
-                y1[1] = count
+                y1.ipart = count
                 return psrn_fill(self, y1, precision=bits)
             count += 1
 
@@ -2342,6 +3047,13 @@ class RandomGen:
         else:
             return -math.log1p(self.rndrangeminmaxexc(-0.5, 0)) / lamda
 
+    def exponential_n(self, lamda=1.0, n=1):
+        """Generates 'n' exponential random numbers at once.
+        Returns an array (see rndu01_n)."""
+        return self._batcharray(
+            [-math.log(u) / lamda for u in self._rndu01zeroexc_n(n)], "d"
+        )
+
     def _logisticexp(self, ln, ld, prec):
         denom = ld * 2 ** prec
         while True:
@@ -2913,7 +3625,7 @@ class RandomGen:
             i += 1
             cxm = c - xm
             xm += cxm * 1.0 / i
-            xs += cxm * (c - cxm)
+            xs += cxm * (c - xm)
         # Calculate the bounding volume
         volume = 1
         for a in bounds:
@@ -3512,17 +4224,17 @@ class RandomGen:
 
     def _fpExponent(self, x):  # The 'e' in s*2**e
         if x == 0:
-            return MINEXPONENT
-        return max(MINEXPONENT, math.frexp(x)[1] - FPPRECISION)
+            return self.MINEXPONENT
+        return max(self.MINEXPONENT, math.frexp(x)[1] - self.FPPRECISION)
 
     def _fpSignificand(self, x):  # The 's' in s*2**e
         if x == 0:
             return 0
         fre = math.frexp(x)
-        fexp = fre[1] - FPPRECISION
-        c = int((fre[0] - 0.5) * (1 << FPPRECISION)) | (1 << (FPPRECISION - 1))
-        if fexp < MINEXPONENT:
-            diff = -(fexp - MINEXPONENT)
+        fexp = fre[1] - self.FPPRECISION
+        c = int((fre[0] - 0.5) * (1 << self.FPPRECISION)) | (1 << (self.FPPRECISION - 1))
+        if fexp < self.MINEXPONENT:
+            diff = -(fexp - self.MINEXPONENT)
             if (c & ((1 << diff) - 1)) != 0:
                 raise ValueError
             c >>= diff
@@ -5238,6 +5950,99 @@ class AlmostRandom:
         self.index += 1
         return item
 
+def _streamseed(seed, stream):
+    # Seed of the 'stream'-th random number stream split
+    # from 'seed'.  Hashing makes the seeds of different
+    # streams unrelated to each other.
+    h = hashlib.sha256(("%s:%d" % (seed, stream)).encode("utf-8")).digest()
+    return int.from_bytes(h, "big")
+
+def _parallelchunk(method, args, kwargs, seed, stream, count):
+    # Runs in a worker process: calls a RandomGen method
+    # 'count' times using the given stream
+    rg = RandomGen(random.Random(_streamseed(seed, stream)))
+    f = getattr(rg, method)
+    return [f(*args, **kwargs) for i in range(count)]
+
+class ParallelSampler:
+    """Calls RandomGen methods many times over a pool of worker
+    processes.  The work is cut into chunks of 'chunksize' calls,
+    and each chunk uses its own RandomGen whose seed is derived
+    from 'seed' and the chunk's position, so that the results
+    depend only on 'seed', 'chunksize' and the calls made so far,
+    not on the number of workers or the order in which the
+    chunks finish.
+
+    - seed: Integer or string from which the seeds of all streams
+      are derived.
+    - workers: Maximum number of worker processes; None means
+      the number of processors.  If 1, everything runs in the
+      current process.
+    - chunksize: Number of method calls per chunk.
+
+    Method arguments must be picklable (for example, functions
+    must be defined at the top level of a module).  For a few
+    expensive calls, use a small chunk size.  Example:
+
+        with ParallelSampler(seed=2024, chunksize=1) as ps:
+            results = ps.sample("monte_carlo_integrate", 16, f, [[0, 1]], 100000)
+
+    Here, 'results' is a list of 16 independent [estimate, error]
+    pairs, which can be averaged.
+    """
+
+    def __init__(self, seed, workers=None, chunksize=1000):
+        if chunksize <= 0:
+            raise ValueError
+        self.seed = seed
+        self.workers = workers
+        self.chunksize = chunksize
+        self.nextstream = 0
+        self._pool = None
+
+    def sample(self, method, count, *args, **kwargs):
+        """Calls the RandomGen method named 'method' 'count' times
+        with the given arguments and returns a list of the results,
+        in order.  Each call of this method uses new streams."""
+        if count < 0:
+            raise ValueError
+        getattr(RandomGen, method)  # Fail early on a bad name
+        chunks = []
+        left = count
+        while left > 0:
+            c = min(left, self.chunksize)
+            chunks.append((self.nextstream, c))
+            self.nextstream += 1
+            left -= c
+        ret = []
+        if self.workers == 1:
+            for stream, c in chunks:
+                ret += _parallelchunk(method, args, kwargs, self.seed, stream, c)
+            return ret
+        if self._pool == None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        futures = [
+            self._pool.submit(
+                _parallelchunk, method, args, kwargs, self.seed, stream, c
+            )
+            for stream, c in chunks
+        ]
+        for f in futures:
+            ret += f.result()
+        return ret
+
+    def close(self):
+        """Shuts down the worker processes, if any."""
+        if self._pool != None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 # Examples of use
 if __name__ == "__main__":
     # Initialize random generator